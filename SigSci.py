@@ -6,17 +6,60 @@ Signal Sciences Python API Client
 
 from __future__ import print_function
 import argparse
+import asyncio
+import atexit
+import base64
+import concurrent.futures
+import copy
 import csv
 import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import time
 import calendar
+import codecs
+import collections
 import json
 import os
+import queue
 import sys
+import tempfile
+import threading
 import math
+import random
+import socket
+import sqlite3
 from configparser import ConfigParser
 from builtins import str
+from urllib.parse import parse_qsl, urlparse
 import requests
+import requests.adapters
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # API Query settings
 # For help with time search syntax see:
@@ -34,73 +77,2035 @@ FILE = None  # example: FILE = '/tmp/sigsci.json'
 FORMAT = None  # example: FORMAT = 'csv'
 PRETTY = None  # PRETTY = True
 SORT = None  # example: SORT = 'asc'
+POOL_SIZE = None  # example: POOL_SIZE = 10
+CONNECT_TIMEOUT = None  # example: CONNECT_TIMEOUT = 10
+READ_TIMEOUT = None  # example: READ_TIMEOUT = 60
 ###########################################
 
-# default for retrieving agent metrics
-AGENTS = False
-# default for feed requests
-FEED = False
-# default for feed requests version 2
-FEED2 = False
-# defaults for polling
-POLL_REQUESTS = False
-POLL_EVENTS = False
-# default for timeseries
-TIMESERIES = False
-ROLLUP = 60
-# list events
-LIST_EVENTS = False
-EVENT_BY_ID = None
-# default for custom alerts
-CUSTOM_ALERTS = False
-CUSTOM_ALERTS_ADD = False
-CUSTOM_ALERTS_DELETE = False
-# default for whitelist parameters
-WHITELIST_PARAMETERS = False
-WHITELIST_PARAMETERS_ADD = False
-WHITELIST_PARAMETERS_DELETE = False
-# default for whitelist paths
-WHITELIST_PATHS = False
-WHITELIST_PATHS_ADD = False
-WHITELIST_PATHS_DELETE = False
-# default for whitelist
-WHITELIST = False
-WHITELIST_ADD = False
-WHITELIST_DELETE = False
-# default for blacklist
-BLACKLIST = False
-BLACKLIST_ADD = False
-BLACKLIST_DELETE = False
-# default for request rules
-REQUEST_RULES = False
-REQUEST_RULES_ADD = False
-REQUEST_RULES_DELETE = False
-# default for signal rules
-SIGNAL_RULES = False
-SIGNAL_RULES_ADD = False
-SIGNAL_RULES_DELETE = False
-# default for redactions
-REDACTIONS = False
-REDACTIONS_ADD = False
-REDACTIONS_DELETE = False
-# default for integrations
-INTEGRATIONS = False
-# default for headerlinks
-HEADERLINKS = False
-# default for members
-MEMBERS = False
-MEMBERS_ADD = False
-MEMBERS_DELETE = False
-# default for health
-HEALTH = False
-###########################################
+# default for retrieving agent metrics
+AGENTS = False
+# default for feed requests
+FEED = False
+# default for feed requests version 2
+FEED2 = False
+# defaults for polling
+POLL_REQUESTS = False
+POLL_EVENTS = False
+# default for timeseries
+TIMESERIES = False
+ROLLUP = 60
+# list events
+LIST_EVENTS = False
+EVENT_BY_ID = None
+# default for custom alerts
+CUSTOM_ALERTS = False
+CUSTOM_ALERTS_ADD = False
+CUSTOM_ALERTS_DELETE = False
+# default for whitelist parameters
+WHITELIST_PARAMETERS = False
+WHITELIST_PARAMETERS_ADD = False
+WHITELIST_PARAMETERS_DELETE = False
+# default for whitelist paths
+WHITELIST_PATHS = False
+WHITELIST_PATHS_ADD = False
+WHITELIST_PATHS_DELETE = False
+# default for whitelist
+WHITELIST = False
+WHITELIST_ADD = False
+WHITELIST_DELETE = False
+# default for blacklist
+BLACKLIST = False
+BLACKLIST_ADD = False
+BLACKLIST_DELETE = False
+# default for request rules
+REQUEST_RULES = False
+REQUEST_RULES_ADD = False
+REQUEST_RULES_DELETE = False
+# default for signal rules
+SIGNAL_RULES = False
+SIGNAL_RULES_ADD = False
+SIGNAL_RULES_DELETE = False
+# default for redactions
+REDACTIONS = False
+REDACTIONS_ADD = False
+REDACTIONS_DELETE = False
+# default for integrations
+INTEGRATIONS = False
+# default for headerlinks
+HEADERLINKS = False
+# default for members
+MEMBERS = False
+MEMBERS_ADD = False
+MEMBERS_DELETE = False
+# default for health
+HEALTH = False
+###########################################
+
+sys.dont_write_bytecode = True
+
+
+class Authn:
+    def __init__(self):
+        self.cookies = {}
+
+
+class AuthState:
+    """
+    AuthState()
+
+    Login state of a SigSciAPI client, shared with its for_site copies so a
+    token renewed by any of them (or the background refresher) is used by all.
+    """
+    def __init__(self):
+        self.authn = None
+        self.token = None
+        self.expires = None
+        self.refresher = None
+
+
+def background_iter(iterable, maxsize):
+    """
+    background_iter(iterable, maxsize)
+
+    Runs iterable on a daemon thread, at most maxsize items ahead of the
+    consumer. Every exception is raised in the consumer, and closing the
+    generator stops the thread at its next item.
+    """
+    q = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            # anything, KeyboardInterrupt or SystemExit too, ends the consumer
+            put((done, e))
+            return
+
+        put((done, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = q.get()
+
+            if error is not None:
+                raise error
+
+            if item is done:
+                return
+
+            yield item
+    finally:
+        stop.set()
+
+
+def write_json_atomic(path, value):
+    """
+    write_json_atomic(path, value)
+
+    Writes value as json to a temporary file next to path, syncs it and
+    renames it over path, so readers and restarts never see a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.%s-' % os.path.basename(path))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+        raise
+
+
+class JSONArrayStream:
+    """
+    JSONArrayStream(chunks)
+    Incremental decoder for a JSON object read from an iterable of byte
+    chunks (e.g. Response.iter_content()). iter_array() yields the elements
+    of one array field as soon as each is complete, so a page never has to
+    be held in memory as raw bytes, text and objects at once.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        # append the next chunk to the buffer, False at end of stream
+        if self.eof:
+            return False
+
+        # drop the text already decoded
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+
+            if text:
+                self.buf += text
+                return True
+
+        self.buf += self.utf8.decode(b'', True)
+        self.eof = True
+        return False
+
+    def char(self):
+        # next non-whitespace character, without consuming it
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if not self.more():
+                raise ValueError('Unexpected end of JSON response')
+
+    def expect(self, chars):
+        c = self.char()
+
+        if c not in chars:
+            raise ValueError('Expecting one of %s in JSON response, found %s' % (chars, c))
+
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.char()
+
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.more():
+                    raise
+
+                continue
+
+            # a number ending the buffer may continue in the next chunk
+            if end == len(self.buf) and self.more():
+                continue
+
+            self.pos = end
+            return obj
+
+    def iter_values(self):
+        """
+        JSONArrayStream.iter_values()
+
+        Yields the top-level values one at a time, skipping the brackets and
+        commas around them, for a json array of records, concatenated pages
+        or an array cut short.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n,[]':
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                yield self.value()
+            elif not self.more():
+                return
+
+    def iter_array(self, key='data', envelope=None):
+        """
+        JSONArrayStream.iter_array(key='data', envelope=None)
+
+        Yields the elements of the top-level key array one at a time. The
+        other top-level fields (next, message, ...) are stored in envelope.
+        """
+        if envelope is None:
+            envelope = {}
+
+        self.expect('{')
+
+        if self.char() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            name = self.value()
+            self.expect(':')
+
+            if name == key and self.char() == '[':
+                self.pos += 1
+
+                if self.char() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                envelope[name] = self.value()
+
+            if self.expect(',}') == '}':
+                return
+
+
+class JSONCodec:
+    """
+    JSONCodec(backend=None, compact=False)
+    JSON decoding and encoding through the fastest installed library:
+    orjson, then ujson, then the standard json module. backend forces one
+    of 'orjson', 'ujson' or 'json'.
+
+    The default settings match json.dumps() and are always encoded by the
+    standard library, so only compact output (no spaces after separators,
+    UTF-8 instead of \\u escapes), which is what the fast libraries write
+    natively, is encoded faster. Compact output is the same whichever
+    backend is used, except for floats: orjson and ujson may write an
+    equal number differently (1e16 for 1e+16, 1.5e-7 for 1.5e-07) and
+    orjson writes NaN and Infinity as null. Objects a fast library cannot
+    encode (integers over 64 bits, keys that are not strings) are encoded
+    by the standard library instead.
+    """
+    BACKENDS = ('orjson', 'ujson', 'json')
+
+    def __init__(self, backend=None, compact=False):
+        available = self.available()
+
+        if backend is None:
+            backend = available[0]
+        elif backend not in available:
+            raise ValueError('JSON backend not installed: %s' % backend)
+
+        self.backend = backend
+        self.compact = compact
+
+    @classmethod
+    def available(cls):
+        modules = {'orjson': orjson, 'ujson': ujson, 'json': json}
+        return [name for name in cls.BACKENDS if modules[name] is not None]
+
+    def loads(self, s):
+        if self.backend == 'orjson':
+            return orjson.loads(s)
+
+        if self.backend == 'ujson':
+            return ujson.loads(s)
+
+        return json.loads(s)
+
+    def dumps(self, obj):
+        if not self.compact:
+            return json.dumps(obj)
+
+        try:
+            if self.backend == 'orjson':
+                return orjson.dumps(obj).decode('utf-8')
+
+            if self.backend == 'ujson':
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            # big integers and non-string keys
+            pass
+
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+class FieldProjection:
+    """
+    FieldProjection(fields)
+    Selection of record fields, compiled once from a list (or comma
+    separated string) of dotted paths such as 'remoteIP', 'tags.*.type' or
+    'headersIn.User-Agent'. '*' matches every item of a list or every key
+    of an object, a number one item of a list, and a name the matching
+    [name, value] pairs of a header list (case insensitive).
+
+    project(record) keeps only the selected fields, nested as in the
+    record and in the order given. values(record) returns one flattened
+    CSV cell per path, see flatten(), with the values matched by a
+    wildcard joined by '|'.
+    """
+
+    def __init__(self, fields):
+        if isinstance(fields, str):
+            fields = fields.split(',')
+
+        self.fields = [field.strip() for field in fields if field.strip()]
+        self.paths = [tuple(field.split('.')) for field in self.fields]
+        self.tree = {}
+
+        # merge the paths into one tree, None marks a whole field
+        for path in self.paths:
+            node = self.tree
+
+            for key in path[:-1]:
+                if key in node and node[key] is None:
+                    break
+
+                node = node.setdefault(key, {})
+            else:
+                node[path[-1]] = None
+
+    def project(self, record):
+        return self.select(record, self.tree)
+
+    def select(self, value, node):
+        if node is None:
+            return value
+
+        if isinstance(value, dict):
+            result = {}
+
+            for key, child in node.items():
+                if key == '*':
+                    for k, v in value.items():
+                        result[k] = self.select(v, child)
+                elif key in value:
+                    result[key] = self.select(value[key], child)
+
+            return result
+
+        if isinstance(value, list):
+            if '*' in node:
+                return [self.select(item, node['*']) for item in value]
+
+            if all(key.isdigit() for key in node):
+                return [self.select(value[int(key)], child) for key, child in node.items() if int(key) < len(value)]
+
+            names = set(key.lower() for key in node)
+            return [item for item in value if self.is_header(item) and item[0].lower() in names]
+
+        return None
+
+    @staticmethod
+    def is_header(item):
+        return isinstance(item, list) and len(item) == 2 and isinstance(item[0], str)
+
+    def lookup(self, value, path):
+        # every value at path, several when it has a wildcard
+        if not path:
+            return [value]
+
+        key = path[0]
+
+        if isinstance(value, dict):
+            if key == '*':
+                return [match for v in value.values() for match in self.lookup(v, path[1:])]
+
+            return self.lookup(value[key], path[1:]) if key in value else []
+
+        if isinstance(value, list):
+            if key == '*':
+                return [match for item in value for match in self.lookup(item, path[1:])]
+
+            if key.isdigit():
+                return self.lookup(value[int(key)], path[1:]) if int(key) < len(value) else []
+
+            # a header by name
+            return [match for item in value if self.is_header(item) and item[0].lower() == key.lower() for match in self.lookup(item[1], path[1:])]
+
+        return []
+
+    @classmethod
+    def flatten(cls, value):
+        """
+        FieldProjection.flatten(value)
+
+        One CSV cell for a value: '' for null, header lists as
+        'Name: value' items, tags by their type and objects (such as event
+        reasons) by their keys, list items joined by '|'.
+        """
+        if value is None:
+            return ''
+
+        if isinstance(value, dict):
+            return '|'.join(str(key) for key in value)
+
+        if isinstance(value, list):
+            cells = []
+
+            for item in value:
+                if cls.is_header(item):
+                    cells.append('%s: %s' % (item[0], item[1]))
+                elif isinstance(item, dict) and 'type' in item:
+                    cells.append(str(item['type']))
+                else:
+                    cells.append(str(cls.flatten(item)))
+
+            return '|'.join(cells)
+
+        return value
+
+    def values(self, record):
+        row = []
+
+        for path in self.paths:
+            matches = self.lookup(record, path)
+
+            if '*' in path:
+                row.append('|'.join(str(self.flatten(m)) for m in matches))
+            else:
+                row.append(self.flatten(matches[0]) if matches else '')
+
+        return row
+
+
+class OutputSink:
+    """
+    OutputSink(path=None, mode='a', buffer_size=1048576)
+    Destination of exported records, opened once per run: the file at path
+    or stdout. Writes go through one large buffer instead of reopening the
+    file per record, are serialized so threads never interleave mid-record,
+    and reach the disk on flush() (called at page boundaries) or close().
+    sync() also waits until they are on disk.
+
+    Records written to stdout are newline terminated, as print() did.
+    """
+
+    def __init__(self, path=None, mode='a', buffer_size=1048576):
+        self.path = path
+        self.lock = threading.RLock()
+        self.csvwriter = None
+
+        if path is None:
+            self.stream = sys.stdout
+            self.terminator = '\n'
+        else:
+            self.stream = open(path, mode, buffering=buffer_size, encoding='utf-8', newline='')
+            self.terminator = ''
+
+    def write(self, text):
+        with self.lock:
+            self.stream.write(text)
+
+    def write_record(self, text, record=None):
+        with self.lock:
+            self.stream.write(text + self.terminator)
+
+    def write_lines(self, lines, records=None):
+        # newline terminated lines in one write
+        with self.lock:
+            self.stream.write(''.join(line + '\n' for line in lines))
+
+    def writerow(self, row, record=None):
+        with self.lock:
+            # one csv writer per run, bound to the open stream
+            if self.csvwriter is None:
+                self.csvwriter = csv.writer(self.stream)
+
+            self.csvwriter.writerow(row)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def sync(self):
+        # flush() and wait until the file is on disk
+        with self.lock:
+            self.stream.flush()
+
+            if self.path is not None:
+                os.fsync(self.stream.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.path is None:
+                self.stream.flush()
+            elif not self.stream.closed:
+                self.stream.close()
+
+
+class ForwarderSink:
+    """
+    ForwarderSink(address, batch_size=65536, spill=None, spill_size=104857600, version='')
+    Sends records to a log collector (SIEM, syslog daemon) at address:
+
+        tcp://host:port or udp://host:port[?format=...][&spill=...][&spill_size=...]
+
+    format frames every record as a newline terminated line (line, the
+    default), an RFC 5424 syslog message (rfc5424, octet counted over TCP
+    per RFC 6587) or an ArcSight CEF event (cef). Only records are sent,
+    raw output such as JSON array brackets is not.
+
+    Messages are sent in batches of up to batch_size bytes, at page
+    boundaries (flush()) or when a batch is full, over one persistent
+    connection. While a TCP collector is unreachable, batches are kept, up
+    to spill_size bytes, in memory or appended to the spill file, and sent
+    ahead of new ones after reconnecting (retried with backoff). A spill
+    file left by an earlier run is sent first too. Delivery is at least
+    once: a batch that failed part way is resent whole. UDP is best
+    effort. sync() fsyncs the spill file and raises ValueError while
+    records are only kept in memory or were dropped.
+    """
+    FORMATS = ('line', 'rfc5424', 'cef')
+    # syslog local0.info
+    PRIORITY = 16 * 8 + 6
+    CEF_FIELDS = (('externalId', 'id'), ('src', 'remoteIP'), ('src', 'source'), ('dhost', 'serverName'), ('requestMethod', 'method'),
+                  ('request', 'uri'), ('app', 'protocol'), ('requestClientApplication', 'userAgent'), ('cn1', 'responseCode'), ('act', 'action'))
+
+    def __init__(self, address, batch_size=65536, spill=None, spill_size=104857600, version=''):
+        url = urlparse(address)
+        params = dict(parse_qsl(url.query))
+
+        if url.scheme not in ('tcp', 'udp') or url.port is None:
+            raise ValueError('Invalid forwarder address: %s' % address)
+
+        if params.get('format', 'line') not in self.FORMATS:
+            raise ValueError('Unknown forwarder format: %s' % params['format'])
+
+        self.path = address
+        self.lock = threading.RLock()
+        self.transport = url.scheme
+        self.address = (url.hostname, url.port)
+        self.framing = params.get('format', 'line')
+        self.spill = params.get('spill', spill)
+        self.spill_size = int(params.get('spill_size', spill_size))
+        self.batch_size = batch_size
+        self.version = version
+        self.hostname = socket.gethostname()
+        self.batch = []
+        self.batch_bytes = 0
+        self.backlog = collections.deque()
+        self.backlog_bytes = 0
+        self.socket = None
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.dropped = 0
+        # spill file written since the last sync(), drops seen by it
+        self.spilled = False
+        self.synced_dropped = 0
+        self.csvbuffer = io.StringIO()
+        self.csvwriter = csv.writer(self.csvbuffer)
+
+    @staticmethod
+    def cef_escape(value, header=False):
+        value = str(value).replace('\\', '\\\\')
+
+        if header:
+            return value.replace('|', '\\|')
+
+        return value.replace('=', '\\=').replace('\r', '\\r').replace('\n', '\\n')
+
+    def cef(self, record):
+        # CEF:Version|Device Vendor|Device Product|Device Version|Signature ID|Name|Severity|Extension
+        signals = [tag['type'] for tag in record.get('tags') or []] or list(record.get('reasons') or [])
+        kind = 'event' if 'reasons' in record else 'request'
+        severity = 7 if record.get('agentResponseCode') == 406 or record.get('action') == 'flagged' else 5 if signals else 3
+        header = ['CEF:0', 'Signal Sciences', 'SigSciApiPy', self.version, signals[0] if signals else kind,
+                  '%s %s' % (kind, ' '.join(signals)) if signals else kind, str(severity)]
+        extension = ['rt=%d' % (ArchiveSink.record_time(record) * 1000)]
+
+        for key, field in self.CEF_FIELDS:
+            if record.get(field) not in (None, ''):
+                extension.append('%s=%s' % (key, self.cef_escape(record[field])))
+
+        if signals:
+            extension.append('cs1Label=signals cs1=%s' % self.cef_escape(','.join(signals)))
+
+        return '|'.join(self.cef_escape(h, True) for h in header) + '|' + ' '.join(extension)
+
+    def message(self, text, record):
+        record = record if isinstance(record, dict) else {}
+
+        if self.framing == 'cef':
+            body = self.cef(record)
+        elif self.framing == 'rfc5424':
+            timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ArchiveSink.record_time(record)))
+            msgid = 'event' if 'reasons' in record else 'request' if record else '-'
+            body = '<%d>1 %s %s sigsci %d %s - %s' % (self.PRIORITY, timestamp, self.hostname, os.getpid(), msgid, text)
+        else:
+            body = text
+
+        data = body.encode('utf-8')
+
+        if self.transport == 'udp':
+            return data
+
+        if self.framing == 'rfc5424':
+            return b'%d %s' % (len(data), data)
+
+        return data + b'\n'
+
+    def add(self, text, record):
+        data = self.message(text, record)
+        self.batch.append(data)
+        self.batch_bytes += len(data)
+
+        if self.batch_bytes >= self.batch_size:
+            self.send()
+
+    def write(self, text):
+        pass
+
+    def write_record(self, text, record=None):
+        with self.lock:
+            self.add(text.rstrip('\n'), record)
+
+    def write_lines(self, lines, records=None):
+        with self.lock:
+            for line, record in zip(lines, records if records is not None else itertools.repeat(None)):
+                self.add(line, record)
+
+    def writerow(self, row, record=None):
+        with self.lock:
+            self.csvwriter.writerow(row)
+            text = self.csvbuffer.getvalue().rstrip('\r\n')
+            self.csvbuffer.seek(0)
+            self.csvbuffer.truncate()
+            self.add(text, record)
+
+    def connect(self):
+        if self.socket is not None:
+            return True
+
+        if time.monotonic() < self.retry_at:
+            return False
+
+        try:
+            if self.transport == 'udp':
+                family, kind, proto, _, sockaddr = socket.getaddrinfo(self.address[0], self.address[1], type=socket.SOCK_DGRAM)[0]
+                self.socket = socket.socket(family, kind, proto)
+                self.socket.connect(sockaddr)
+            else:
+                self.socket = socket.create_connection(self.address, timeout=30)
+
+        except OSError:
+            # collector down, back off before the next attempt
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(60, 2 ** self.failures)
+            return False
+
+        self.failures = 0
+        return True
+
+    def disconnect(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def send(self):
+        with self.lock:
+            batch = self.batch
+            self.batch = []
+            self.batch_bytes = 0
+
+            if self.transport == 'udp':
+                for data in batch:
+                    try:
+                        if self.connect():
+                            self.socket.send(data)
+                            self.sent += 1
+                        else:
+                            self.dropped += 1
+                    except OSError:
+                        self.dropped += 1
+
+                return
+
+            if self.connect():
+                try:
+                    self.replay()
+
+                    if batch:
+                        self.socket.sendall(b''.join(batch))
+                        self.sent += len(batch)
+
+                    return
+
+                except OSError:
+                    self.disconnect()
+                    self.retry_at = time.monotonic() + 1
+
+            self.store(batch)
+
+    def store(self, batch):
+        # keep a batch the collector could not take, within spill_size
+        if not batch:
+            return
+
+        data = b''.join(batch)
+
+        if self.spill is not None:
+            size = os.path.getsize(self.spill) if os.path.exists(self.spill) else 0
+
+            if size + len(data) <= self.spill_size:
+                with open(self.spill, 'ab') as f:
+                    f.write(data)
+
+                self.spilled = True
+                return
+
+        elif self.backlog_bytes + len(data) <= self.spill_size:
+            self.backlog.append((data, len(batch)))
+            self.backlog_bytes += len(data)
+            return
+
+        self.dropped += len(batch)
+
+    def replay(self):
+        # resend what was kept while the collector was down, oldest first
+        if self.spill is not None and os.path.exists(self.spill) and os.path.getsize(self.spill) > 0:
+            with open(self.spill, 'rb') as f:
+                for chunk in iter(functools.partial(f.read, self.batch_size), b''):
+                    self.socket.sendall(chunk)
+
+            os.remove(self.spill)
+
+        while self.backlog:
+            data, count = self.backlog[0]
+            self.socket.sendall(data)
+            self.backlog.popleft()
+            self.backlog_bytes -= len(data)
+            self.sent += count
+
+    def flush(self):
+        self.send()
+
+    def sync(self):
+        # sent, or fsynced to the spill file, records only kept in memory or dropped cannot be synced
+        with self.lock:
+            self.send()
+
+            if self.spilled and os.path.exists(self.spill):
+                with open(self.spill, 'ab') as f:
+                    os.fsync(f.fileno())
+
+            self.spilled = False
+
+            if self.backlog:
+                raise ValueError('Forwarder %s: collector unreachable, %d records only kept in memory (set a spill file)' % (self.path, sum(count for _, count in self.backlog)))
+
+            if self.dropped > self.synced_dropped:
+                self.synced_dropped = self.dropped
+                raise ValueError('Forwarder %s: %d records dropped' % (self.path, self.dropped))
+
+    def close(self):
+        with self.lock:
+            # one last attempt, spilled records are resent by the next run
+            self.retry_at = 0
+            self.send()
+            self.disconnect()
+
+            if self.backlog or self.dropped:
+                print('Forwarder %s: %d records not delivered' % (self.path, self.dropped + sum(count for _, count in self.backlog)), file=sys.stderr)
+
+            if self.spill is not None and os.path.exists(self.spill):
+                print('Forwarder %s: undelivered records kept in %s' % (self.path, self.spill), file=sys.stderr)
+
+
+class SQLiteSink:
+    """
+    SQLiteSink(address)
+    Local store of request and event records in the SQLite database at
+    address ('sqlite:///path/to/file.db'). Records are upserted by id, so
+    exporting overlapping time ranges again leaves one row per record, and
+    are committed in one transaction per page (flush()).
+
+    Tables:
+        records (id, kind, timestamp, remoteIP, path, responseCode,
+                 siteName, record)   kind is 'request' or 'event',
+                                     timestamp in epoch seconds, record
+                                     the whole record as JSON
+        tags    (tag, id)            signals of requests, reasons of events
+
+    Indexed on timestamp, remoteIP, path, responseCode and tag. Output
+    calls without a record (JSON array brackets, configuration) are
+    ignored.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            id TEXT PRIMARY KEY, kind TEXT, timestamp INTEGER, remoteIP TEXT, path TEXT,
+            responseCode INTEGER, siteName TEXT, record TEXT);
+        CREATE TABLE IF NOT EXISTS tags (tag TEXT, id TEXT, PRIMARY KEY (tag, id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS records_timestamp ON records (timestamp);
+        CREATE INDEX IF NOT EXISTS records_remoteIP ON records (remoteIP);
+        CREATE INDEX IF NOT EXISTS records_path ON records (path);
+        CREATE INDEX IF NOT EXISTS records_responseCode ON records (responseCode);
+        CREATE INDEX IF NOT EXISTS tags_id ON tags (id);
+    """
+
+    def __init__(self, address):
+        self.path = address
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.stored = 0
+        # the writer thread of a FanoutSink may use it, serialized by lock
+        self.db = sqlite3.connect(address[len('sqlite://'):], check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def write_records(self, records):
+        with self.lock:
+            for record in records:
+                if isinstance(record, dict) and 'id' in record:
+                    # the last copy of a record in a page wins
+                    self.pending[record['id']] = record
+
+    def write(self, text):
+        pass
+
+    def write_record(self, text, record=None):
+        # a record, a list of them or an API page
+        if record is not None:
+            self.write_records(SigSciAPI.records_of(record))
+
+    def write_lines(self, lines, records=None):
+        if records is not None:
+            self.write_records(records)
+
+    def writerow(self, row, record=None):
+        self.write_record(None, record)
+
+    def rows(self, records):
+        for record in records:
+            kind = 'event' if 'reasons' in record else 'request'
+            yield (record['id'], kind, ArchiveSink.record_time(record), record.get('remoteIP', record.get('source')),
+                   record.get('path'), record.get('responseCode'), record.get('siteName'), json.dumps(record))
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+
+            records = list(self.pending.values())
+            self.pending = {}
+            tags = [(tag['type'] if isinstance(tag, dict) else tag, record['id'])
+                    for record in records for tag in record.get('tags') or record.get('reasons') or []]
+
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.rows(records))
+                self.db.executemany('DELETE FROM tags WHERE id = ?', [(record['id'],) for record in records])
+                self.db.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)', tags)
+
+            self.stored += len(records)
+
+    def sync(self):
+        # every transaction is committed by flush()
+        self.flush()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+
+class FanoutSink:
+    """
+    FanoutSink(sinks, queue_size=0, batch_size=1000)
+    Writes every output call to each of sinks (OutputSink, ArchiveSink,
+    ForwarderSink, ParquetSink), with the interface of the first one.
+
+    With queue_size set, the sinks are written on a background thread so
+    slow disks or consumers do not hold up fetching. Calls are batched per
+    page (up to flush() or batch_size calls) and at most queue_size batches
+    wait in the queue; beyond that the fetching threads block. stats()
+    reports the queue depth and how long they were stalled. An error in
+    the writer thread is raised by the next call, and by close() after
+    every sink is closed. sync() is a barrier: it returns once the writer
+    thread has written and synced every call before it.
+    """
+
+    def __init__(self, sinks, queue_size=0, batch_size=1000):
+        self.sinks = sinks
+        self.path = sinks[0].path
+        self.lock = threading.RLock()
+        self.batch_size = batch_size
+        self.pending = []
+        self.error = None
+        self.calls = 0
+        self.max_depth = 0
+        self.stalled = 0.0
+        self.queue = None
+        self.thread = None
+
+        if queue_size > 0:
+            self.queue = queue.Queue(queue_size)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def apply(self, calls):
+        for name, args in calls:
+            for sink in self.sinks:
+                getattr(sink, name)(*args)
+
+    def run(self):
+        while True:
+            calls = self.queue.get()
+
+            if calls is None:
+                return
+
+            if isinstance(calls, threading.Event):
+                # sync() barrier, everything before it is written
+                calls.set()
+                continue
+
+            # keep draining after an error so fetching threads never block on it
+            if self.error is None:
+                try:
+                    self.apply(calls)
+                except Exception as e:
+                    self.error = e
+
+    def submit(self, name, *args):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+
+            self.calls += 1
+
+            if self.thread is None:
+                self.apply([(name, args)])
+                return
+
+            self.pending.append((name, args))
+
+            if name in ('flush', 'sync', 'close') or len(self.pending) >= self.batch_size:
+                self.put(self.pending)
+                self.pending = []
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # backpressure, the writer is behind
+            start = time.monotonic()
+            self.queue.put(item)
+            self.stalled += time.monotonic() - start
+
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def stats(self):
+        return {'calls': self.calls, 'queued': self.queue.qsize() if self.queue is not None else 0,
+                'max_depth': self.max_depth, 'stalled': self.stalled}
+
+    def write(self, text):
+        self.submit('write', text)
+
+    def write_record(self, text, record=None):
+        self.submit('write_record', text, record)
+
+    def write_lines(self, lines, records=None):
+        self.submit('write_lines', lines, records)
+
+    def writerow(self, row, record=None):
+        self.submit('writerow', row, record)
+
+    def write_records(self, records):
+        self.submit('write_records', records)
+
+    def flush(self):
+        self.submit('flush')
+
+    def sync(self):
+        # returns once the writer thread has written and synced every earlier call
+        barrier = threading.Event()
+
+        with self.lock:
+            self.submit('sync')
+
+            if self.thread is None:
+                return
+
+            self.put(barrier)
+
+        barrier.wait()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # stop the writer and close every sink even after an error, then raise the first error
+        with self.lock:
+            if self.thread is not None:
+                # dropped by the writer thread after an error
+                if self.pending:
+                    self.put(self.pending)
+                    self.pending = []
+
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except Exception as e:
+                    if self.error is None:
+                        self.error = e
+
+            if self.error is not None:
+                raise self.error
+
+
+class ArchiveSink(OutputSink):
+    """
+    ArchiveSink(path, compress=None, rotate_size=None, rotate_interval=None, buffer_size=1048576)
+    OutputSink writing finished, optionally compressed files for archiving.
+    Each file is written to a .tmp file next to it and renamed into place
+    once complete, so readers never see a partial file, and is then listed
+    as one JSON line in path + '.manifest'.
+
+    Settings:
+        compress        None, 'gzip' or 'zstd' (requires zstandard)
+        rotate_size     start a new file after this many bytes of output,
+                        counted before compression
+        rotate_interval seconds per file, by the timestamp of the records
+                        (3600 for hourly files)
+
+    Manifest entries give the file, its record count, size in bytes, the
+    start of its interval and the epochs of its first and last records.
+
+    Files are named <path stem>-[<interval start>-]<n><ext>, n counting
+    up past files left by earlier runs, with or without rotation. Records are never split
+    across files. flush() is a no-op: output becomes visible a file at a
+    time.
+    """
+    EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, compress=None, rotate_size=None, rotate_interval=None, buffer_size=1048576):
+        if compress not in self.EXTENSIONS:
+            raise ValueError('Unknown compression: %s' % compress)
+
+        if compress == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+
+        self.path = path
+        self.lock = threading.RLock()
+        self.csvwriter = None
+        self.terminator = ''
+        self.compress = compress
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.buffer_size = buffer_size
+        self.manifest = path + '.manifest'
+        self.stream = None
+
+    @staticmethod
+    def record_time(record):
+        # epoch of the record's timestamp, now when it has none
+        try:
+            return calendar.timegm(time.strptime(record['timestamp'], '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, TypeError, ValueError):
+            return int(time.time())
+
+    def file_name(self, interval):
+        # numbered even without rotation, so a new run never replaces an earlier archive
+        root, ext = os.path.splitext(self.path)
+        stamp = '' if interval is None else time.strftime('%Y%m%dT%H%M%SZ-', time.gmtime(interval))
+
+        for n in itertools.count(1):
+            name = '%s-%s%04d%s%s' % (root, stamp, n, ext, self.EXTENSIONS[self.compress])
+
+            if not os.path.exists(name) and not os.path.exists(name + '.tmp'):
+                return name
+
+    def select(self, record):
+        # rotate before a record that belongs in the next file
+        if self.stream is not None and record is not None:
+            interval = None
+
+            if self.rotate_interval:
+                epoch = self.record_time(record)
+                interval = epoch - epoch % self.rotate_interval
+
+            if interval != self.interval or (self.rotate_size and self.size >= self.rotate_size):
+                self.finish()
+
+        if self.stream is None:
+            interval = None
+
+            if self.rotate_interval:
+                epoch = self.record_time(record) if record is not None else int(time.time())
+                interval = epoch - epoch % self.rotate_interval
+
+            self.start(interval)
+
+    def start(self, interval):
+        self.name = self.file_name(interval)
+        self.interval = interval
+        self.size = 0
+        self.records = 0
+        self.first = None
+        self.last = None
+        self.raw = open(self.name + '.tmp', 'wb', buffering=self.buffer_size)
+
+        if self.compress == 'gzip':
+            self.writer = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw)
+        elif self.compress == 'zstd':
+            self.writer = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.writer = self.raw
+
+        self.stream = io.TextIOWrapper(self.writer, encoding='utf-8', newline='')
+        self.csvwriter = None
+
+    def finish(self):
+        # complete the current file, move it into place and list it
+        self.stream.detach()
+        self.stream = None
+
+        if self.writer is not self.raw:
+            self.writer.close()
+
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.name + '.tmp', self.name)
+
+        entry = {'file': self.name, 'records': self.records, 'bytes': os.path.getsize(self.name),
+                 'start': self.interval, 'first': self.first, 'last': self.last, 'finished': int(time.time())}
+
+        with open(self.manifest, 'a') as manifest:
+            manifest.write(json.dumps(entry) + '\n')
+
+    def write(self, text):
+        with self.lock:
+            self.select(None)
+            self.stream.write(text)
+            self.size += len(text.encode('utf-8'))
+
+    def write_record(self, text, record=None):
+        with self.lock:
+            self.select(record)
+            self.stream.write(text)
+            self.size += len(text.encode('utf-8'))
+            self.count(record)
+
+    def write_lines(self, lines, records=None):
+        with self.lock:
+            for line, record in zip(lines, records if records is not None else itertools.repeat(None)):
+                self.write_record(line + '\n', record)
+
+    def writerow(self, row, record=None):
+        with self.lock:
+            self.select(record)
+
+            if self.csvwriter is None:
+                self.csvwriter = csv.writer(self.stream)
+
+            self.csvwriter.writerow(row)
+            self.size += sum(len(str(v).encode('utf-8')) + 1 for v in row)
+            self.count(record)
+
+    def count(self, record):
+        # records and their time range in the current file, for the manifest
+        self.records += 1
+
+        if isinstance(record, dict) and 'timestamp' in record:
+            epoch = self.record_time(record)
+            self.first = epoch if self.first is None else min(self.first, epoch)
+            self.last = epoch if self.last is None else max(self.last, epoch)
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        raise ValueError('Archive output is only complete once its file is closed, it cannot be synced')
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.finish()
+
+
+class ParquetSink:
+    """
+    ParquetSink(path, compression='snappy', batch_size=65536)
+    Columnar output of request records (search, feed and polling) as a
+    Parquet file, with the same flush()/close() interface as OutputSink.
+    Records are collected per page and written as one row group on
+    flush(), or once batch_size records are pending. Requires pyarrow.
+
+    The schema is fixed whatever fields a record has: scalar fields as
+    typed columns, timestamp as a UTC timestamp, tags as the list of tag
+    types and headersIn/headersOut as string maps. Repetitive strings (ip,
+    country, path, ...) are dictionary encoded. The file is written under
+    a .tmp name and renamed on close(), as Parquet files are only readable
+    once complete.
+    """
+    STRINGS = ('serverHostname', 'remoteHostname', 'userAgent', 'uri')
+    DICTIONARY_STRINGS = ('remoteIP', 'remoteCountryCode', 'method', 'serverName', 'protocol', 'path', 'siteName')
+    INTEGERS = ('responseCode', 'responseSize', 'responseMillis', 'agentResponseCode')
+    HEADERS = ('headersIn', 'headersOut')
+
+    def __init__(self, path, compression='snappy', batch_size=65536):
+        if pyarrow is None:
+            raise ValueError('parquet output requires the pyarrow package')
+
+        if path is None:
+            raise ValueError('parquet output requires a file')
+
+        self.path = path
+        self.lock = threading.RLock()
+        self.compression = compression
+        self.batch_size = batch_size
+        self.rows = []
+        self.writer = None
+
+    @classmethod
+    def schema(cls):
+        dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        fields = [('id', pyarrow.string()), ('timestamp', pyarrow.timestamp('s', tz='UTC'))]
+        fields += [(name, pyarrow.string()) for name in cls.STRINGS]
+        fields += [(name, dictionary) for name in cls.DICTIONARY_STRINGS]
+        fields += [(name, pyarrow.int64()) for name in cls.INTEGERS]
+        fields += [('tags', pyarrow.list_(pyarrow.string()))]
+        fields += [(name, pyarrow.map_(pyarrow.string(), pyarrow.string())) for name in cls.HEADERS]
+
+        return pyarrow.schema(fields)
+
+    def table(self, rows):
+        schema = self.schema()
+        columns = []
+
+        for field in schema:
+            name = field.name
+
+            if name == 'timestamp':
+                column = pyarrow.array([row.get(name) for row in rows], pyarrow.string()).cast(field.type)
+            elif name in self.DICTIONARY_STRINGS:
+                column = pyarrow.array([row.get(name) for row in rows], pyarrow.string()).dictionary_encode()
+            elif name == 'tags':
+                column = pyarrow.array([[tag['type'] for tag in row.get(name) or []] for row in rows], field.type)
+            elif name in self.HEADERS:
+                column = pyarrow.array([[tuple(header) for header in row[name]] if row.get(name) is not None else None for row in rows], field.type)
+            else:
+                column = pyarrow.array([row.get(name) for row in rows], field.type)
+
+            columns.append(column)
+
+        return pyarrow.Table.from_arrays(columns, schema=schema)
+
+    def write_records(self, records):
+        with self.lock:
+            self.rows.extend(records)
+
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+    def open_writer(self):
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path + '.tmp', self.schema(), compression=self.compression)
+
+        return self.writer
+
+    def flush(self):
+        with self.lock:
+            if self.rows:
+                self.open_writer().write_table(self.table(self.rows))
+                self.rows = []
+
+    def sync(self):
+        raise ValueError('Parquet output is only complete once its file is closed, it cannot be synced')
+
+    def close(self):
+        with self.lock:
+            self.flush()
+
+            # an export without records still leaves a file with the schema
+            self.open_writer().close()
+            self.writer = None
+            os.replace(self.path + '.tmp', self.path)
+
+
+class OfflineQuery:
+    """
+    OfflineQuery(query)
+    A request search in the API search syntax, as built by
+    SigSciAPI.build_search_query(), run over local data instead of the
+    API. Supported terms: from: and until: (epochs or relative such as
+    -6h, until exclusive), ip:, server:, agentcode: (any of the given
+    values), tag: (any of them), -tag: (none of them) and
+    sort:time-asc/time-desc. Other terms raise ValueError.
+
+    run(sources, workers=None) yields the matching requests in time order,
+    each id once, from any mix of:
+        sqlite:///path.db  a SQLiteSink store, prefiltered through its indexes
+        *.parquet          ParquetSink files, time and ip filters pushed into the scan
+        *.ndjson, *.jsonl, *.json, also gzip (.gz) or zstd (.zst) compressed
+        *.manifest         the files listed in an ArchiveSink manifest whose
+                           records overlap the time range
+        directories        every such file below them
+    Sources are scanned in parallel on up to workers processes (default:
+    one per CPU). Each worker spools the matches of its source to
+    temporary files, sorted in chunks of chunk_size records, and the
+    chunks are merged lazily, at most merge_fan_in files at a time, so
+    neither memory nor open files grow with the result.
+    """
+    ARCHIVE_EXTENSIONS = ('.ndjson', '.jsonl', '.json', '.parquet')
+    # records sorted in memory at a time by a worker
+    chunk_size = 100000
+    # spools open at once while merging
+    merge_fan_in = 64
+
+    def __init__(self, query):
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        self.query = query
+        self.from_time = None
+        self.until_time = None
+        self.ips = set()
+        self.servers = set()
+        self.agentcodes = set()
+        self.tags = set()
+        self.not_tags = set()
+        self.descending = False
+
+        for term in query.split():
+            key, _, value = term.partition(':')
+
+            if key == 'from' and value:
+                self.from_time = int(SigSciAPI.to_epoch(now, value))
+            elif key == 'until' and value:
+                self.until_time = int(SigSciAPI.to_epoch(now, value))
+            elif key == 'ip' and value:
+                self.ips.add(value)
+            elif key == 'server' and value:
+                self.servers.add(value)
+            elif key == 'agentcode' and value:
+                self.agentcodes.add(value)
+            elif key == 'tag' and value:
+                self.tags.add(value)
+            elif key == '-tag' and value:
+                self.not_tags.add(value)
+            elif key == 'sort' and value in ('time-asc', 'time-desc'):
+                self.descending = value == 'time-desc'
+            else:
+                raise ValueError('Unsupported search term: %s' % term)
+
+    @staticmethod
+    def record_epoch(record):
+        try:
+            return calendar.timegm(time.strptime(record['timestamp'], '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, TypeError, ValueError):
+            return 0
+
+    def matches(self, record):
+        epoch = self.record_epoch(record)
+
+        if self.from_time is not None and epoch < self.from_time:
+            return False
+
+        if self.until_time is not None and epoch >= self.until_time:
+            return False
+
+        if self.ips and record.get('remoteIP') not in self.ips:
+            return False
+
+        if self.servers and record.get('serverName') not in self.servers:
+            return False
+
+        if self.agentcodes and str(record.get('agentResponseCode')) not in self.agentcodes:
+            return False
+
+        if self.tags or self.not_tags:
+            # full tag objects, or tag types as stored in parquet
+            tags = set(tag if isinstance(tag, str) else tag.get('type') for tag in record.get('tags') or [])
+
+            if self.tags and not tags & self.tags:
+                return False
+
+            if tags & self.not_tags:
+                return False
+
+        return True
+
+    def overlaps(self, first, last):
+        if self.from_time is not None and last is not None and last < self.from_time:
+            return False
+
+        if self.until_time is not None and first is not None and first >= self.until_time:
+            return False
+
+        return True
+
+    @classmethod
+    def is_archive(cls, name):
+        for ext in ('.gz', '.zst'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+
+        return name.endswith(cls.ARCHIVE_EXTENSIONS)
+
+    def files(self, sources):
+        for source in sources:
+            if source.startswith('sqlite://'):
+                yield source
+
+            elif os.path.isdir(source):
+                for root, dirs, names in os.walk(source):
+                    dirs.sort()
+
+                    for name in sorted(names):
+                        if self.is_archive(name):
+                            yield os.path.join(root, name)
+
+            elif source.endswith('.manifest'):
+                with open(source) as manifest:
+                    for line in manifest:
+                        entry = json.loads(line)
+
+                        # archives are kept next to their manifest
+                        if self.overlaps(entry.get('first'), entry.get('last')):
+                            yield os.path.join(os.path.dirname(source), os.path.basename(entry['file']))
+
+            else:
+                yield source
+
+    @staticmethod
+    def open_binary(path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError('zstd archives require the zstandard package')
+
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+        return open(path, 'rb')
+
+    def read_records(self, path):
+        with self.open_binary(path) as f:
+            if path.endswith(('.ndjson', '.jsonl', '.ndjson.gz', '.jsonl.gz', '.ndjson.zst', '.jsonl.zst')):
+                for line in io.TextIOWrapper(f, encoding='utf-8'):
+                    if line.strip():
+                        yield json.loads(line)
+
+                return
+
+            # a json array (search), concatenated pages or records (feed), or a truncated array
+            for value in JSONArrayStream(iter(functools.partial(f.read, 65536), b'')).iter_values():
+                for record in SigSciAPI.records_of(value):
+                    yield record
+
+    def read_parquet(self, path):
+        if pyarrow is None:
+            raise ValueError('parquet archives require the pyarrow package')
+
+        filters = []
+
+        if self.from_time is not None:
+            filters.append(('timestamp', '>=', datetime.datetime.fromtimestamp(self.from_time, datetime.timezone.utc)))
+
+        if self.until_time is not None:
+            filters.append(('timestamp', '<', datetime.datetime.fromtimestamp(self.until_time, datetime.timezone.utc)))
+
+        if self.ips:
+            filters.append(('remoteIP', 'in', sorted(self.ips)))
+
+        for record in pyarrow.parquet.read_table(path, filters=filters or None).to_pylist():
+            if record['timestamp'] is not None:
+                record['timestamp'] = record['timestamp'].strftime('%Y-%m-%dT%H:%M:%SZ')
+
+            yield record
+
+    def read_sqlite(self, path):
+        sql = "SELECT record FROM records WHERE kind = 'request'"
+        args = []
+
+        if self.from_time is not None:
+            sql += ' AND timestamp >= ?'
+            args.append(self.from_time)
+
+        if self.until_time is not None:
+            sql += ' AND timestamp < ?'
+            args.append(self.until_time)
+
+        if self.ips:
+            sql += ' AND remoteIP IN (%s)' % ', '.join('?' * len(self.ips))
+            args += sorted(self.ips)
+
+        if self.tags:
+            sql += ' AND id IN (SELECT id FROM tags WHERE tag IN (%s))' % ', '.join('?' * len(self.tags))
+            args += sorted(self.tags)
+
+        db = sqlite3.connect('file:%s?mode=ro' % path[len('sqlite://'):], uri=True)
+
+        try:
+            for row in db.execute(sql, args):
+                yield json.loads(row[0])
+        finally:
+            db.close()
+
+    def spool(self, records, spool_dir):
+        # write records in time order to a new file in spool_dir, one per line
+        fd, path = tempfile.mkstemp(dir=spool_dir, suffix='.ndjson')
+
+        with io.open(fd, 'w', encoding='utf-8') as spool:
+            for record in sorted(records, key=self.record_epoch, reverse=self.descending):
+                spool.write(json.dumps(record) + '\n')
+
+        return path
+
+    def scan(self, path, spool_dir):
+        # spool the matching records of one source in sorted chunks, returns the chunk files
+        if path.startswith('sqlite://'):
+            records = self.read_sqlite(path)
+        elif path.endswith(('.parquet', '.parquet.gz', '.parquet.zst')):
+            records = self.read_parquet(path)
+        else:
+            records = self.read_records(path)
+
+        chunks = []
+        chunk = []
+
+        for record in records:
+            if self.matches(record):
+                chunk.append(record)
+
+                if len(chunk) >= self.chunk_size:
+                    chunks.append(self.spool(chunk, spool_dir))
+                    chunk = []
+
+        if chunk:
+            chunks.append(self.spool(chunk, spool_dir))
+
+        return chunks
+
+    @staticmethod
+    def read_spool(path):
+        with open(path, encoding='utf-8') as spool:
+            for line in spool:
+                yield json.loads(line)
+
+    def merge(self, chunks):
+        # lazily merge sorted spools, each one is an open file
+        return heapq.merge(*[self.read_spool(chunk) for chunk in chunks], key=self.record_epoch, reverse=self.descending)
+
+    def merge_spools(self, chunks, spool_dir):
+        # merge sorted spools into a new one in spool_dir and remove them
+        fd, path = tempfile.mkstemp(dir=spool_dir, suffix='.ndjson')
+
+        with io.open(fd, 'w', encoding='utf-8') as spool:
+            for record in self.merge(chunks):
+                spool.write(json.dumps(record) + '\n')
+
+        for chunk in chunks:
+            os.remove(chunk)
+
+        return path
+
+    def run(self, sources, workers=None):
+        paths = list(self.files(sources))
+        workers = min(workers or os.cpu_count() or 1, len(paths))
+
+        with tempfile.TemporaryDirectory(prefix='sigsci-offline-') as spool_dir:
+            if workers > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunks = list(itertools.chain.from_iterable(executor.map(self.scan, paths, [spool_dir] * len(paths))))
+            else:
+                chunks = [chunk for path in paths for chunk in self.scan(path, spool_dir)]
+
+            # merge passes of at most merge_fan_in spools, to stay within the open file limit
+            while len(chunks) > self.merge_fan_in:
+                groups = [chunks[i:i + self.merge_fan_in] for i in range(0, len(chunks), self.merge_fan_in)]
+                chunks = [self.merge_spools(group, spool_dir) if len(group) > 1 else group[0] for group in groups]
+
+            last_epoch = None
+            seen = set()
+
+            for record in self.merge(chunks):
+                # the same request kept in several archives, only ids of the current second are kept
+                epoch = self.record_epoch(record)
+
+                if epoch != last_epoch:
+                    last_epoch = epoch
+                    seen.clear()
+
+                if record.get('id') not in seen:
+                    seen.add(record.get('id'))
+                    yield record
+
+
+class SeenIds:
+    """
+    SeenIds()
+    Ids of the records a poller has output, for skipping them when they
+    come again in an overlapping window. Only 64-bit fingerprints of the
+    ids are kept, in one bucket per minute, and whole buckets are dropped
+    with expire(), so memory depends on the overlap, not on traffic.
+    """
+
+    def __init__(self, buckets=None):
+        # {minute epoch: set of fingerprints}
+        self.buckets = buckets or {}
+
+    @staticmethod
+    def fingerprint(record_id):
+        return int.from_bytes(hashlib.blake2b(str(record_id).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, record_id, epoch):
+        # True the first time an id is added
+        fingerprint = self.fingerprint(record_id)
+
+        for bucket in self.buckets.values():
+            if fingerprint in bucket:
+                return False
+
+        self.buckets.setdefault(epoch - epoch % 60, set()).add(fingerprint)
+        return True
+
+    def expire(self, before):
+        # forget the ids of minutes before this epoch
+        for minute in [minute for minute in self.buckets if minute < before]:
+            del self.buckets[minute]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+
+class FeedCursor:
+    """
+    FeedCursor(path=None)
+    Position of a poller: the until epoch of the last window written out,
+    and the SeenIds of the records in its last minute, which the next
+    window fetches again. With a path the cursor is loaded on start and
+    saved after every window with write_json_atomic(), so a restarted
+    poller resumes exactly where it stopped.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.until = None
+        self.seen = SeenIds()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as cursor_file:
+                state = json.load(cursor_file)
+
+            self.until = state['until']
+            self.seen = SeenIds(dict((int(minute), set(bucket)) for minute, bucket in state['seen'].items()))
+
+    def save(self, until):
+        # only the last minute is fetched again
+        self.until = until
+        self.seen.expire(until - 60)
+
+        if self.path is None:
+            return
+
+        seen = dict((str(minute), sorted(bucket)) for minute, bucket in self.seen.buckets.items())
+        write_json_atomic(self.path, {'until': until, 'seen': seen, 'saved': int(time.time())})
+
+
+class PollScheduler:
+    """
+    PollScheduler(delay=300, interval=60, max_interval=480)
+    When a poller runs its next window. Cycles start on wall-clock minute
+    boundaries, so the time spent fetching and writing is taken off the
+    wait instead of added to it. A poller with a full minute of data
+    waiting (lag of 60 seconds or more) starts its next, larger window at
+    once. After a window without records the wait doubles, up to
+    max_interval, and it is back to interval as soon as records come in.
+
+    lag is the seconds of data that could be fetched but was not yet: from
+    the end of the last window to now less the feed delay.
+    """
+
+    def __init__(self, delay=300, interval=60, max_interval=480):
+        self.delay = delay
+        self.interval = interval
+        self.max_interval = max_interval
+        self.current = interval
+        self.cycles = 0
+        self.idle = 0
+        self.lag = None
+        self.until = None
+
+    def done(self, records, until):
+        # account for a finished window
+        now = int(time.time())
+        self.cycles += 1
+        self.until = until
+        self.lag = max(0, now - now % 60 - self.delay - until)
+
+        if records:
+            self.current = self.interval
+        else:
+            self.idle += 1
+            self.current = min(self.current * 2, self.max_interval)
+
+    def behind(self):
+        # a full minute of data is waiting
+        return self.lag is not None and self.lag >= 60
+
+    def next_run(self, now):
+        # epoch of the next cycle
+        return now - now % 60 + self.current
+
+    def wait(self):
+        # sleep until the next cycle, returns the seconds slept
+        now = time.time()
+        seconds = self.next_run(now) - now
+        time.sleep(seconds)
+        return seconds
+
+    def stats(self):
+        return {'lag': self.lag, 'until': self.until, 'interval': self.current, 'cycles': self.cycles, 'idle': self.idle}
+
+
+class PollSite:
+    """
+    PollSite(api, kind='requests', checkpoint=None)
+    One site of SigSciAPI.poll_sites(): the client of the site, its
+    FeedCursor and PollScheduler, and when its next window is due. A
+    window that fails is reported on stderr and retried after a backoff
+    that doubles with every failure in a row, up to backoff_max seconds.
+    """
+    backoff = 30
+    backoff_max = 600
+
+    def __init__(self, api, kind='requests', checkpoint=None):
+        if kind not in ('requests', 'events'):
+            raise ValueError('Unknown poll kind: %s' % kind)
+
+        self.api = api
+        self.kind = kind
+        self.name = '%s/%s' % (api.corp, api.site)
+        self.cursor = FeedCursor(checkpoint)
+        self.scheduler = PollScheduler(api.poll_delay)
+        self.api.scheduler = self.scheduler
+        self.due = 0
+        self.failures = 0
+
+    def run(self):
+        # one window, then set when the next one is due
+        try:
+            if self.kind == 'requests':
+                records = self.api.poll_requests_window(self.cursor)
+            else:
+                records = self.api.poll_events_window(self.cursor)
+
+            self.failures = 0
+        except Exception as e:
+            self.failures += 1
+            delay = min(self.backoff_max, self.backoff * 2 ** (self.failures - 1))
+            sys.stderr.write('Error: %s: %s (retrying in %ds)\n' % (self.name, str(e), delay))
+            self.due = time.time() + delay
+            return
 
-sys.dont_write_bytecode = True
+        now = time.time()
 
+        if records is not None:
+            self.scheduler.done(records, self.api.until_time)
+
+            if self.scheduler.behind():
+                self.due = now
+                return
+
+        self.due = self.scheduler.next_run(now)
+
+
+class RetryPolicy:
+    """
+    RetryPolicy()
+    Retry settings shared by every SigSciAPI call: exponential backoff with
+    full jitter, honoring Retry-After on 429/503.
+
+    POST and PATCH are only resent when the API cannot have processed them
+    (429/503 or a failed connect), everything else is retried on 5xx,
+    timeouts and dropped connections too.
+
+    Settings:
+        max_retries    = 5    (retries after the first attempt)
+        backoff_factor = 0.5  (seconds, doubled every attempt)
+        backoff_max    = 60   (cap on a single backoff, seconds)
+    """
+    max_retries = 5
+    backoff_factor = 0.5
+    backoff_max = 60
+    retry_statuses = (429, 500, 502, 503, 504)
+    # the API did not process the request, safe to resend any method
+    throttle_statuses = (429, 503)
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def retry_status(self, method, status_code):
+        if status_code in self.throttle_statuses:
+            return True
+
+        return status_code in self.retry_statuses and method.upper() in self.idempotent_methods
+
+    def retry_exception(self, method, e):
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            # never reached the server
+            return True
+
+        if method.upper() not in self.idempotent_methods:
+            return False
+
+        return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def delay(self, attempt, r=None):
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+        retry_after = self.retry_after(r)
+
+        if retry_after is not None:
+            return max(retry_after, backoff)
+
+        return backoff
+
+    @staticmethod
+    def retry_after(r):
+        # Retry-After is either delay seconds or an HTTP date
+        if r is None or r.headers.get('Retry-After') is None:
+            return None
+
+        value = r.headers.get('Retry-After')
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = email.utils.parsedate_tz(value)
+
+            if parsed is None:
+                return None
+
+            return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class TokenBucket:
+    """
+    TokenBucket(rate, burst=None)
+    Thread-safe token bucket, rate in requests per second. Callers that find
+    the bucket empty reserve a token and are told how long to wait for it,
+    so waiting threads are served in order instead of racing.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # reserve one token, returns the seconds to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0.0
+
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    RateLimiter()
+    Client-side rate limits keyed by corp and endpoint class, shared by every
+    thread and SigSciAPI instance in the process (SigSciAPI.rate_limiter).
+
+    Endpoint classes:
+        search   requests search (query_api)
+        feed     requests feed and the pollers
+        config   configuration writes (POST/PATCH/PUT/DELETE)
+        default  everything else
+
+    Example:
+        SigSciAPI.rate_limiter.set_rate('feed', 5)                 # all corps
+        SigSciAPI.rate_limiter.set_rate('config', 0.5, corp='foo')  # one corp
+    """
+    ENDPOINT_CLASSES = ('search', 'feed', 'config', 'default')
 
-class Authn:
     def __init__(self):
-        self.cookies = {}
+        self.rates = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def set_rate(self, endpoint_class, rate, burst=None, corp=None):
+        """
+        RateLimiter.set_rate(endpoint_class, rate, burst=None, corp=None)
+
+        rate is in requests per second and must be above 0, None removes the
+        limit. Without a corp the rate applies to every corp that has no
+        rate of its own.
+        """
+        if endpoint_class not in self.ENDPOINT_CLASSES:
+            raise ValueError('Unknown endpoint class: %s' % endpoint_class)
+
+        if rate is not None and rate <= 0:
+            raise ValueError('Rate must be above 0: %s' % rate)
+
+        if burst is not None and burst <= 0:
+            raise ValueError('Burst must be above 0: %s' % burst)
+
+        with self.lock:
+            if rate is None:
+                self.rates.pop((corp, endpoint_class), None)
+            else:
+                self.rates[(corp, endpoint_class)] = (rate, burst)
+
+            # buckets are rebuilt with the new rate on next use
+            self.buckets = {}
+
+    def configure(self, spec):
+        # parse [corp:]class=rate[/burst], e.g. feed=5 or foo:config=0.5/2, rate none removes the limit
+        if '=' not in spec:
+            raise ValueError('Expecting [corp:]class=rate[/burst]: %s' % spec)
+
+        key, value = spec.split('=', 1)
+        corp = None
+
+        if ':' in key:
+            corp, key = key.split(':', 1)
+
+        burst = None
+
+        if '/' in value:
+            value, burst = value.split('/', 1)
+            burst = float(burst)
+
+        self.set_rate(key, None if value.lower() == 'none' else float(value), burst, corp)
+
+    def bucket(self, corp, endpoint_class):
+        with self.lock:
+            if (corp, endpoint_class) not in self.buckets:
+                limit = self.rates.get((corp, endpoint_class), self.rates.get((None, endpoint_class)))
+                self.buckets[(corp, endpoint_class)] = TokenBucket(*limit) if limit is not None else None
+
+            return self.buckets[(corp, endpoint_class)]
+
+    def acquire(self, corp, endpoint_class):
+        # block until a request may be sent, returns the seconds waited
+        bucket = self.bucket(corp, endpoint_class)
+
+        if bucket is None:
+            return 0.0
+
+        wait = bucket.take()
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
 
 
 class SigSciAPI():
@@ -132,8 +2137,8 @@ class SigSciAPI():
     url = base + '/api/'
     version = 'v0'
     base_url = None
-    authn = None
-    token = None
+    # AuthState, holds authn, token, token_expires and token_refresher
+    auth = None
     email = None
     pword = None
     api_token = None
@@ -162,6 +2167,55 @@ class SigSciAPI():
     ua = None
     xheaders = {}
     event_by_id = None
+    session = None
+    pool_size = 10
+    keep_alive = True
+    connect_timeout = 10
+    read_timeout = 60
+    retry = None
+    codec = None
+    # directory for cached login tokens, None disables the cache
+    token_cache = None
+    token_ttl = 3600
+    token_refresh_margin = 300
+    auth_lock = None
+    parallel = 1
+    prefetch = 1
+    stream = False
+    stream_chunk_size = 65536
+    site_workers = 4
+    tag_site = False
+    # FieldProjection, or dotted paths compiled to one on first use
+    fields = None
+    # default csv columns
+    REQUEST_CSV_FIELDS = FieldProjection('timestamp,id,remoteIP,remoteCountryCode,path,tags.*.type,responseCode,agentResponseCode')
+    EVENT_CSV_FIELDS = FieldProjection('timestamp,id,source,remoteHostname,remoteCountryCode,action,type,reasons,tagCount,window,detectedTimestamp,expires')
+    sink = None
+    output_buffer_size = 1048576
+    outputs = None
+    writer_queue_size = 0
+    offline_workers = None
+    # file keeping records for collectors that are down
+    forward_spill = None
+    # archive files: None/'gzip'/'zstd', rotation by size or seconds of record time
+    compress = None
+    rotate_size = None
+    rotate_interval = None
+    # poller cursor file, None keeps the cursor in memory only
+    checkpoint = None
+    # feed windows: data complete after poll_delay, up to poll_catchup seconds per window when behind
+    poll_delay = 300
+    poll_window = 120
+    poll_catchup = 3600
+    feed_retention = 86400
+    # PollScheduler of a running poller, and a file its stats are written to after every window
+    scheduler = None
+    poll_status = None
+    poll_url = None
+    # events poller: from the newest event seen instead of fixed windows
+    events_incremental = False
+    # shared by every instance in the process
+    rate_limiter = RateLimiter()
 
     # api end points
     LOGIN_EP = '/auth'
@@ -195,57 +2249,426 @@ class SigSciAPI():
     REPORTS_EP = '/reports/attacks'
     CONFIGURED_TEMPLATES_EP = '/configuredtemplates'
 
-    def authenticate(self):
-        """
-        SigSciAPI.authenticate()
+    # login state lives in the shared SigSciAPI.auth, see AuthState
+    @property
+    def authn(self):
+        return self.auth.authn
+
+    @authn.setter
+    def authn(self, value):
+        self.auth.authn = value
+
+    @property
+    def token(self):
+        return self.auth.token
+
+    @token.setter
+    def token(self, value):
+        self.auth.token = value
+
+    @property
+    def token_expires(self):
+        return self.auth.expires
+
+    @token_expires.setter
+    def token_expires(self, value):
+        self.auth.expires = value
+
+    @property
+    def token_refresher(self):
+        return self.auth.refresher
+
+    @token_refresher.setter
+    def token_refresher(self, value):
+        self.auth.refresher = value
+
+    def authenticate(self, refresh=False):
+        """
+        SigSciAPI.authenticate(refresh=False)
+
+        Before calling, set:
+            SigSciAPI.email
+            SigSciAPI.pword or SigSciAPI.api_token
+
+        Stores auth token in:
+            SigSciAPI.token (shared with for_site copies)
+
+        With SigSciAPI.token_cache set to a directory, the login token is
+        cached there per corp and user and reused until shortly before it
+        expires. refresh=True skips the cached token if it is the one in use.
+        """
+
+        if self.api_token is not None:
+            self.authn = Authn()
+            return True
+
+        elif self.token_cache is not None and self.load_cached_token(None if not refresh else self.token):
+            return True
+
+        else:
+            self.authn = self.get_session().post(self.base_url + self.LOGIN_EP,
+                                                 data={'email': self.email, 'password': self.pword},
+                                                 headers={'User-Agent': self.ua},
+                                                 timeout=(self.connect_timeout, self.read_timeout),
+                                                 allow_redirects=False)
+
+        if self.authn.status_code == 401:
+            print(self.authn.json()['message'])
+            return False
+        elif self.authn.status_code == 403:
+            print(self.authn.json()['message'])
+            return False
+        elif self.authn.status_code != 200:
+            print('Unexpected status: %s response: %s' % (self.authn.status_code, self.authn.text))
+            return False
+
+        self.token = self.authn.json()['token']
+        self.token_expires = self.token_expiry(self.token)
+
+        if self.token_cache is not None:
+            self.save_cached_token()
+
+        return True
+
+    def token_expiry(self, token):
+        # expiry epoch from the token's exp claim if it is a JWT, else login time + token_ttl
+        try:
+            payload = token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+            return int(claims['exp'])
+        except Exception:
+            return int(time.time()) + self.token_ttl
+
+    def token_cache_file(self):
+        # one cache file per api host, corp and user
+        key = '{}\n{}\n{}'.format(self.base_url, self.corp, self.email)
+        return os.path.join(self.token_cache, 'token-%s.json' % hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+    def load_cached_token(self, stale_token=None):
+        # use the cached token unless it is about to expire or known to be stale
+        try:
+            with open(self.token_cache_file()) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if cached.get('token') in (None, stale_token):
+            return False
+
+        if cached.get('expires', 0) - self.token_refresh_margin <= time.time():
+            return False
+
+        self.authn = Authn()
+        self.token = cached['token']
+        self.token_expires = cached['expires']
+        return True
+
+    def save_cached_token(self):
+        # written to a private temp file and renamed, readers never see a partial file
+        try:
+            if not os.path.isdir(self.token_cache):
+                os.makedirs(self.token_cache, 0o700)
+
+            fd, tmp = tempfile.mkstemp(dir=self.token_cache, prefix='.token-')
+
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({'token': self.token, 'expires': self.token_expires, 'corp': self.corp, 'email': self.email}, cache_file)
+
+            os.replace(tmp, self.token_cache_file())
+        except (IOError, OSError) as e:
+            sys.stderr.write('Warning: could not cache token: %s\n' % str(e))
+
+    def refresh_token(self):
+        """
+        SigSciAPI.refresh_token()
+
+        Logs in again (or picks up a newer cached token) if the login token
+        expires within SigSciAPI.token_refresh_margin seconds.
+        """
+        with self.auth_lock:
+            if self.token_expires is None or time.time() < self.token_expires - self.token_refresh_margin:
+                return True
+
+            return self.authenticate(refresh=True)
+
+    def start_token_refresher(self):
+        """
+        SigSciAPI.start_token_refresher()
+
+        Starts a daemon thread that renews the login token in the background
+        before it expires, so long-running pollers never wait on a login.
+        """
+        if self.token_expires is None or self.token_refresher is not None:
+            return
+
+        def run():
+            while True:
+                wait = self.token_expires - self.token_refresh_margin - time.time()
+                time.sleep(max(wait, 1))
+
+                if not self.refresh_token():
+                    # try again shortly, requests still log in on a 401
+                    time.sleep(60)
+
+        self.token_refresher = threading.Thread(target=run)
+        self.token_refresher.daemon = True
+        self.token_refresher.start()
+
+    def get_headers(self):
+        headers = {'Content-type': 'application/json', 'User-Agent': self.ua}
+
+        if self.token is not None:
+            headers['Authorization'] = 'Bearer %s' % self.token
+
+        if self.api_token is not None:
+            headers['X-Api-User'] = self.email
+            headers['X-Api-Token'] = self.api_token
+
+        if self.xheaders:
+            headers.update(self.xheaders)
+
+        return headers
+
+    def set_headers(self, headers):
+        self.xheaders.update(headers)
+
+    def get_session(self):
+        """
+        SigSciAPI.get_session()
+
+        Returns the pooled HTTP session shared by every API call, creating it
+        on first use so pool_size and keep_alive can be set after __init__.
+        A pool_size raised after that takes effect on the next call.
+
+        Optional settings:
+            SigSciAPI.pool_size       (default: 10)
+            SigSciAPI.keep_alive      (default: True)
+            SigSciAPI.connect_timeout (default: 10 seconds)
+            SigSciAPI.read_timeout    (default: 60 seconds)
+        """
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.pool_size = 0
+
+            if not self.keep_alive:
+                self.session.headers['Connection'] = 'close'
+
+        if self.pool_size > getattr(self.session, 'pool_size', 0):
+            # a bigger pool for more threads, replaces the smaller one
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session.pool_size = self.pool_size
+
+        return self.session
+
+    def close(self):
+        # flush pending output, release pooled connections
+        self.close_output()
+
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open_output(self, mode='a'):
+        """
+        SigSciAPI.open_output(mode='a')
+
+        Returns the OutputSink for SigSciAPI.file (stdout when None). The
+        file is opened on first use and kept open until close_output() or
+        close(); changing SigSciAPI.file switches to a new sink. Copies made
+        by for_site() share the sink once it is open.
+
+        With SigSciAPI.compress, rotate_size or rotate_interval set, the file
+        is written as an ArchiveSink instead, and with SigSciAPI.format
+        'parquet' as a ParquetSink (compress picks its codec).
+
+        SigSciAPI.outputs adds destinations written alongside the file: more
+        files, '-' for stdout, a collector ('tcp://host:port',
+        'udp://host:port', see ForwarderSink) or a local database
+        ('sqlite:///path', see SQLiteSink). With it or with
+        SigSciAPI.writer_queue_size set the sinks are wrapped in a
+        FanoutSink, written on a background thread for a queue size > 0.
+
+        Optional settings:
+            SigSciAPI.output_buffer_size (default: 1 MiB)
+            SigSciAPI.compress           (None, 'gzip' or 'zstd')
+            SigSciAPI.rotate_size        (bytes per file before compression)
+            SigSciAPI.rotate_interval    (seconds of record time per file)
+            SigSciAPI.outputs            (more destinations)
+            SigSciAPI.writer_queue_size  (pages queued for the writer thread, default: 0)
+        """
+        if self.sink is not None and self.sink.path != self.file:
+            self.close_output()
+
+        if self.sink is None:
+            if not self.outputs and not self.writer_queue_size:
+                self.sink = self.make_sink(self.file, mode)
+            else:
+                sinks = [self.make_sink(self.file, mode)]
+                sinks += [self.make_sink(None if output == '-' else output, mode) for output in self.outputs or []]
+                self.sink = FanoutSink(sinks, self.writer_queue_size)
+
+        return self.sink
+
+    def make_sink(self, path, mode='a'):
+        # the sink for one destination: stdout (None), a collector, a database or a file
+        if path is not None and path.startswith(('tcp://', 'udp://')):
+            return ForwarderSink(path, spill=self.forward_spill, version=self.agent_version or '')
+
+        if path is not None and path.startswith('sqlite://'):
+            return SQLiteSink(path)
+
+        if self.format == 'parquet':
+            return ParquetSink(path, self.compress or 'snappy')
+
+        if path is not None and (self.compress or self.rotate_size or self.rotate_interval):
+            return ArchiveSink(path, self.compress, self.rotate_size, self.rotate_interval, self.output_buffer_size)
+
+        return OutputSink(path, mode, self.output_buffer_size)
+
+    def flush_output(self):
+        if self.sink is not None:
+            self.sink.flush()
+
+    def sync_output(self):
+        # flush and wait until the output is durable, before recording progress
+        if self.sink is not None:
+            self.sink.sync()
+
+    def close_output(self):
+        if self.sink is not None:
+            sink, self.sink = self.sink, None
+            sink.close()
+
+            if isinstance(sink, FanoutSink) and self.writer_queue_size:
+                print('Writer: %(calls)d writes, max queue depth %(max_depth)d, stalled %(stalled).2fs' % sink.stats(), file=sys.stderr)
+
+    def for_site(self, site, corp=None):
+        """
+        SigSciAPI.for_site(site, corp=None)
+
+        Returns a copy of this client for another site (and optionally corp)
+        that shares the authenticated session, login token and connection
+        pool.
+        """
+        self.get_session()
+        api = copy.copy(self)
+        api.site = site
+
+        if corp is not None:
+            api.corp = corp
+
+        return api
+
+    def api_request(self, method, url, **kwargs):
+        """
+        SigSciAPI.api_request(method, url, **kwargs)
+
+        Sends an API request through the pooled session with the auth
+        headers, cookies and connect/read timeouts applied.
+
+        Every attempt first waits on SigSciAPI.rate_limiter. Failed requests
+        are retried with SigSciAPI.retry (see RetryPolicy), and a 401 logs in
+        again once before resending.
+        """
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        reauthenticated = False
+        attempt = 0
+
+        while True:
+            # headers are rebuilt every attempt in case the token was refreshed
+            request_kwargs = dict(kwargs)
+            request_kwargs.setdefault('headers', self.get_headers())
+
+            if self.authn is not None:
+                request_kwargs.setdefault('cookies', self.authn.cookies)
+
+            if self.token_expires is not None and time.time() >= self.token_expires - self.token_refresh_margin:
+                self.refresh_token()
+
+            self.rate_limiter.acquire(self.corp, self.endpoint_class(method, url))
+
+            try:
+                r = self.get_session().request(method, url, **request_kwargs)
+            except requests.exceptions.RequestException as e:
+                if attempt >= self.retry.max_retries or not self.retry.retry_exception(method, e):
+                    raise
+
+                time.sleep(self.retry.delay(attempt))
+                attempt += 1
+                continue
 
-        Before calling, set:
-            SigSciAPI.email
-            SigSciAPI.pword or SigSciAPI.api_token
+            if r.status_code == 401 and not reauthenticated and self.api_token is None and self.pword is not None:
+                # Reauthenticate if token expires early
+                reauthenticated = True
 
-        Stores auth token in:
-            SigSciAPI.authn.token
-        """
+                with self.auth_lock:
+                    if self.authenticate(refresh=True):
+                        continue
 
-        if self.api_token is not None:
-            self.authn = Authn()
-            return True
+            elif attempt < self.retry.max_retries and self.retry.retry_status(method, r.status_code):
+                time.sleep(self.retry.delay(attempt, r))
+                attempt += 1
+                continue
 
-        else:
-            self.authn = requests.post(self.base_url + self.LOGIN_EP,
-                                       data={'email': self.email, 'password': self.pword},
-                                       allow_redirects=False)
+            return r
 
-        if self.authn.status_code == 401:
-            print(self.authn.json()['message'])
-            return False
-        elif self.authn.status_code == 403:
-            print(self.authn.json()['message'])
-            return False
-        elif self.authn.status_code != 200:
-            print('Unexpected status: %s response: %s' % (self.authn.status_code, self.authn.text))
-            return False
+    def endpoint_class(self, method, url):
+        # rate limit class of an API call, see RateLimiter
+        if method.upper() in ('POST', 'PATCH', 'PUT', 'DELETE'):
+            return 'config'
 
-        self.token = self.authn.json()['token']
-        return True
+        path = urlparse(url).path
 
-    def get_headers(self):
-        headers = {'Content-type': 'application/json', 'User-Agent': self.ua}
+        if path.endswith(self.FEED_EP):
+            return 'feed'
 
-        if self.token is not None:
-            headers['Authorization'] = 'Bearer %s' % self.token
+        if path.endswith(self.REQEUSTS_EP) and not path.endswith(self.TIMESERIES_EP):
+            return 'search'
 
-        if self.api_token is not None:
-            headers['X-Api-User'] = self.email
-            headers['X-Api-Token'] = self.api_token
+        return 'default'
 
-        if self.xheaders:
-            headers.update(self.xheaders)
+    def request_json(self, method, url, **kwargs):
+        # send an API request and decode the JSON response
+        r = self.api_request(method, url, **kwargs)
+        return self.codec.loads(r.text)
 
-        return headers
+    def fetch_page(self, url, envelope):
+        """
+        SigSciAPI.fetch_page(url, envelope)
 
-    def set_headers(self, headers):
-        self.xheaders.update(headers)
+        Yields the data records of one API page and stores its other fields
+        (next, ...) in envelope. With SigSciAPI.stream set the records are
+        decoded from the socket as they arrive instead of after the whole
+        body has been read. Raises ValueError on an API error message.
+        """
+        if self.stream:
+            r = self.api_request('GET', url, stream=True)
+
+            try:
+                for record in JSONArrayStream(r.iter_content(chunk_size=self.stream_chunk_size)).iter_array('data', envelope):
+                    yield record
+            finally:
+                r.close()
+        else:
+            j = self.request_json('GET', url)
+
+            if 'message' not in j:
+                for record in j['data']:
+                    yield record
+
+            envelope.update(j)
+
+        # check for API call error
+        if 'message' in envelope:
+            raise ValueError(envelope['message'])
 
     def build_search_query(self):
         """
@@ -292,10 +2715,88 @@ class SigSciAPI():
         # force sort time-asc so we can properly capture last_epoch
         self.query += 'sort:time-asc'
 
+    def corp_url(self, EP=''):
+        # /corps/{corpName}{EP}
+        return self.base_url + self.CORPS_EP + self.corp + EP
+
+    def site_url(self, EP=''):
+        # /corps/{corpName}/sites/{siteName}{EP}
+        return self.corp_url(self.SITES_EP + self.site + EP)
+
+    def config_url(self, EP, level='site'):
+        if level == 'site':
+            return self.site_url(EP)
+
+        return self.corp_url(EP)
+
+    def next_url(self, next_ref):
+        # absolute url of the next page, None on the last page
+        if not next_ref or next_ref.get('uri', '').strip() == '':
+            return None
+
+        return self.base + next_ref['uri']
+
+    def search_url(self):
+        # builds the search query and returns the requests search url
+        self.build_search_query()
+        url = self.site_url(self.REQEUSTS_EP) + '?q=' + str(self.query).strip()
+
+        if self.limit is not None:
+            url += '&limit=' + str(self.limit)
+
+        return url
+
+    def feed_url(self):
+        # /corps/{corpName}/sites/{siteName}/feed/requests
+        self.query_params = 'from=%s' % str(self.from_time)
+        self.query_params += '&until=%s' % str(self.until_time)
+
+        if self.tags is not None:
+            self.query_params += '&tags='
+            self.query_params += ','.join(self.tags)
+
+        if self.ctags is not None:
+            if self.tags is None:
+                self.query_params += '&tags='
+
+            self.query_params += ','.join(self.ctags)
+
+        return self.site_url(self.FEED_EP) + '?' + str(self.query_params).strip()
+
+    def events_url(self, tag=None):
+        # /corps/{corpName}/sites/{siteName}/events
+        query_params = '?limit=' + str(self.limit)
+
+        if self.from_time is not None:
+            query_params += '&from=%s' % str(self.from_time)
+
+        if self.until_time is not None:
+            query_params += '&until=%s' % str(self.until_time)
+
+        if tag is not None:
+            query_params += '&tag=%s' % (str(tag).strip())
+
+        return self.site_url(self.EVENTS_EP) + query_params
+
+    def timeseries_url(self, tags, rollup=60):
+        # /corps/{corpName}/sites/{siteName}/timeseries/requests
+        self.query_params = '?rollup={}'.format(str(rollup).strip())
+
+        if self.from_time is not None:
+            self.query_params += '&from={}'.format(str(self.from_time))
+
+        if self.until_time is not None:
+            self.query_params += '&until={}'.format(str(self.until_time))
+
+        for tag in tags:
+            self.query_params += '&tag={}'.format(tag)
+
+        return self.site_url(self.TIMESERIES_EP) + self.query_params
+
     def get_requests(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__requests_get
         # /corps/{corpName}/sites/{siteName}/requests
-        self.query_api()
+        return self.query_api()
 
     def query_api(self):
         """
@@ -310,6 +2811,7 @@ class SigSciAPI():
                 SigSciAPI.query
                 SigSciAPI.limit
                 SigSciAPI.file
+                SigSciAPI.parallel
 
         """
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__requests_get
@@ -324,95 +2826,39 @@ class SigSciAPI():
                 now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
                 now_epoch = calendar.timegm(now.utctimetuple())
 
-                if self.file is not None:
-                    outfile = open(self.file, 'w')
-
-                    if self.format == 'json':
-                        outfile.write('[')
-
-                while last_epoch <= self.until_time and get_next:
-                    self.build_search_query()
-                    url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.REQEUSTS_EP + '?q=' + str(self.query).strip()
+                self.begin_search_output()
 
-                    if self.limit is not None:
-                        url += '&limit=' + str(self.limit)
+                if self.parallel > 1:
+                    # fetch sub-windows concurrently, merged back in time order
+                    get_next = False
 
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    j = json.loads(r.text)
+                    for record in self.iter_parallel_search():
+                        self.output_search_record(record, loop_count == 0)
+                        loop_count += 1
 
-                    # check for API call error
-                    if 'message' in j:
-                        raise ValueError(j['message'])
+                while last_epoch <= self.until_time and get_next:
+                    url = self.search_url()
 
                     # get timestamp of last record
                     record_count = 0
 
-                    for record in j['data']:
+                    for record in self.fetch_page(url, {}):
                         record_count += 1
-                        last_timestamp = datetime.datetime.strptime(record['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-                        last_epoch = calendar.timegm(last_timestamp.utctimetuple())
+                        last_epoch = self.record_epoch(record)
 
                         # output to file or stdout
-                        if self.format == 'json':
-                            if loop_count == 0:
-                                if self.file is not None:
-                                    outfile.write('{}'.format(json.dumps(record)))
-                                else:
-                                    print('{}'.format(json.dumps(record)))
-                            else:
-                                if self.file is not None:
-                                    outfile.write(',{}'.format(json.dumps(record)))
-                                else:
-                                    print(',{}'.format(json.dumps(record)))
-                        elif self.format == 'csv':
-                            if self.file is not None:
-                                csvwriter = csv.writer(outfile)
-                            else:
-                                csvwriter = csv.writer(sys.stdout)
-
-                            tag_list = ''
-                            detector = record['tags']
-
-                            for t in detector:
-                                tag_list = tag_list + t['type'] + '|'
-
-                            # default, output fields for requests
-                            csvwriter.writerow([str(record['timestamp']), str(record['id']), str(record['remoteIP']), str(record['remoteCountryCode']), str(record['path']).encode('utf8'), str(tag_list[:-1]), str(record['responseCode']), str(record['agentResponseCode'])])
-
-                        else:
-                            print('Error: Invalid output format!')
-
+                        self.output_search_record(record, loop_count == 0)
                         loop_count += 1
 
-                    # set from_time for next iteration
-                    if record_count < 1000:
-                        # shift to next window
-                        self.from_time = int(self.from_time) + (86400 * 7)
-                        self.until_time = int(self.from_time) + (86400 * 7)
-                    else:
-                        self.from_time = last_epoch
-
-                    if self.from_time > self.until_time or self.from_time > now_epoch:
-                        get_next = False
-
-                    # force limit to 1000 on subsequent iterations to reduce the number of api calls
-                    self.limit = 1000
+                    self.flush_output()
+                    get_next = self.next_search_window(record_count, last_epoch, now_epoch)
 
-                if self.file is not None:
-                    if self.format == 'json':
-                        outfile.write(']')
-
-                    outfile.close()
+                self.end_search_output()
 
             else:
-                self.build_search_query()
-                url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.REQEUSTS_EP + '?q=' + str(self.query).strip()
-
-                if self.limit is not None:
-                    url += '&limit=' + str(self.limit)
-
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                j = json.loads(r.text)
+                url = self.search_url()
+                r = self.api_request('GET', url)
+                j = self.codec.loads(r.text)
 
                 # output the results
                 self.output_results(j[self.field])
@@ -422,6 +2868,205 @@ class SigSciAPI():
             print('Query: %s ' % url)
             sys.exit()
 
+    def split_search_windows(self):
+        """
+        SigSciAPI.split_search_windows()
+
+        Splits from_time..until_time into at least SigSciAPI.parallel
+        contiguous sub-windows of at most 7 days each.
+        """
+        from_time = int(self.from_time)
+        until_time = int(self.until_time)
+        span = max(until_time - from_time, 1)
+        count = max(self.parallel, int(math.ceil(span / float(86400 * 7))))
+        step = int(math.ceil(span / float(count)))
+        windows = []
+
+        for start in range(from_time, until_time, step):
+            windows.append((start, min(start + step, until_time)))
+
+        return windows or [(from_time, until_time)]
+
+    def iter_search_window(self, from_time, until_time):
+        """
+        SigSciAPI.iter_search_window(from_time, until_time)
+
+        Yields the request records of one search window, oldest first.
+        Works on a copy of the client so windows can be fetched from
+        several threads.
+        """
+        api = copy.copy(self)
+        api.from_time = from_time
+        api.until_time = until_time
+        api.limit = 1000
+
+        while True:
+            record_count = 0
+
+            for record in api.fetch_page(api.search_url(), {}):
+                record_count += 1
+                yield record
+
+            if record_count < api.limit:
+                return
+
+            last_epoch = self.record_epoch(record)
+
+            if last_epoch >= until_time:
+                return
+
+            # a full page within one second would otherwise be fetched forever
+            api.from_time = last_epoch if last_epoch > api.from_time else api.from_time + 1
+
+    def spool_search_window(self, window, stop):
+        # fetch every page of a window into a temporary file, one record per line
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+
+        try:
+            for record in self.iter_search_window(*window):
+                if stop.is_set():
+                    break
+
+                spool.write(self.codec.dumps(record) + '\n')
+
+            spool.seek(0)
+            return spool
+
+        except BaseException:
+            spool.close()
+            raise
+
+    def iter_parallel_search(self):
+        """
+        SigSciAPI.iter_parallel_search()
+
+        Fetches the sub-windows of split_search_windows() on up to
+        SigSciAPI.parallel threads. Every thread fetches all pages of its
+        window into a temporary file, whether or not earlier windows have
+        been written yet, so memory does not grow with the result. At most
+        parallel + 1 windows are fetched ahead of the one being yielded.
+        The windows do not overlap and are yielded one after another in
+        time order. Records repeated across page or window boundaries are
+        yielded once.
+        """
+        stop = threading.Event()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel)
+        windows = iter(self.split_search_windows())
+        futures = collections.deque()
+
+        def close_stopped(future):
+            # a window finishing after the search was abandoned
+            if stop.is_set() and not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+        def submit(count):
+            for window in itertools.islice(windows, count):
+                future = executor.submit(self.spool_search_window, window, stop)
+                future.add_done_callback(close_stopped)
+                futures.append(future)
+
+        submit(self.parallel + 1)
+
+        try:
+            last_epoch = None
+            last_ids = set()
+
+            while futures:
+                future = futures.popleft()
+                submit(1)
+
+                with future.result() as spool:
+                    for line in spool:
+                        record = self.codec.loads(line)
+                        epoch = self.record_epoch(record)
+
+                        if epoch != last_epoch:
+                            last_epoch = epoch
+                            last_ids = set()
+
+                        if record['id'] not in last_ids:
+                            last_ids.add(record['id'])
+                            yield record
+
+        finally:
+            # windows still being fetched stop at their next record, their spool is closed when they finish
+            stop.set()
+
+            for future in futures:
+                future.cancel()
+
+            executor.shutdown(wait=False)
+
+            for future in futures:
+                if future.done():
+                    close_stopped(future)
+
+    @staticmethod
+    def record_epoch(record):
+        # epoch of a request record's timestamp
+        timestamp = datetime.datetime.strptime(record['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+        return calendar.timegm(timestamp.utctimetuple())
+
+    def next_search_window(self, record_count, last_epoch, now_epoch):
+        """
+        SigSciAPI.next_search_window(record_count, last_epoch, now_epoch)
+
+        Moves from_time/until_time on to the next search page and returns
+        False once the time range is exhausted.
+        """
+        # set from_time for next iteration
+        if record_count < 1000:
+            # shift to next window
+            self.from_time = int(self.from_time) + (86400 * 7)
+            self.until_time = int(self.from_time) + (86400 * 7)
+        else:
+            self.from_time = last_epoch
+
+        # force limit to 1000 on subsequent iterations to reduce the number of api calls
+        self.limit = 1000
+
+        return not (self.from_time > self.until_time or self.from_time > now_epoch)
+
+    def output_search_record(self, record, first):
+        # output a search record to file or stdout, as part of a json array
+        sink = self.open_output()
+
+        if self.format == 'json':
+            if first:
+                sink.write_record('{}'.format(self.codec.dumps(self.project(record))), record)
+            else:
+                sink.write_record(',{}'.format(self.codec.dumps(self.project(record))), record)
+        elif self.format == 'csv':
+            sink.writerow(self.csv_row(record), record)
+
+        elif self.format == 'ndjson':
+            self.output_ndjson(record)
+
+        elif self.format == 'parquet':
+            sink.write_records([record])
+
+        else:
+            print('Error: Invalid output format!')
+
+    def begin_search_output(self):
+        # start a search written to file as a fresh json array, ndjson appends
+        if self.file is not None:
+            self.close_output()
+            sink = self.open_output('a' if self.format == 'ndjson' else 'w')
+
+            if self.format == 'json':
+                sink.write('[')
+
+    def end_search_output(self):
+        # close the json array of a search written to file
+        if self.file is not None:
+            if self.format == 'json':
+                self.open_output().write(']')
+
+            self.close_output()
+        else:
+            self.flush_output()
+
     def raw_query_api(self, raw_query):
         """
         SigSciAPI.raw_query_api()
@@ -453,11 +3098,7 @@ class SigSciAPI():
                 now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
                 now_epoch = calendar.timegm(now.utctimetuple())
 
-                if self.file is not None:
-                    outfile = open(self.file, 'w')
-
-                    if self.format == 'json':
-                        outfile.write('[')
+                self.begin_search_output()
 
                 while last_epoch <= self.until_time and get_next:
                     self.build_search_query()
@@ -467,8 +3108,8 @@ class SigSciAPI():
                     if self.limit is not None:
                         url += '&limit=' + str(self.limit)
 
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    j = json.loads(r.text)
+                    r = self.api_request('GET', url)
+                    j = self.codec.loads(r.text)
 
                     # check for API call error
                     if 'message' in j:
@@ -483,35 +3124,7 @@ class SigSciAPI():
                         last_epoch = calendar.timegm(last_timestamp.utctimetuple())
 
                         # output to file or stdout
-                        if self.format == 'json':
-                            if loop_count == 0:
-                                if self.file is not None:
-                                    outfile.write('{}'.format(json.dumps(record)))
-                                else:
-                                    print('{}'.format(json.dumps(record)))
-                            else:
-                                if self.file is not None:
-                                    outfile.write(',{}'.format(json.dumps(record)))
-                                else:
-                                    print(',{}'.format(json.dumps(record)))
-                        elif self.format == 'csv':
-                            if self.file is not None:
-                                csvwriter = csv.writer(outfile)
-                            else:
-                                csvwriter = csv.writer(sys.stdout)
-
-                            tag_list = ''
-                            detector = record['tags']
-
-                            for t in detector:
-                                tag_list = tag_list + t['type'] + '|'
-
-                            # default, output fields for requests
-                            csvwriter.writerow([str(record['timestamp']), str(record['id']), str(record['remoteIP']), str(record['remoteCountryCode']), str(record['path']).encode('utf8'), str(tag_list[:-1]), str(record['responseCode']), str(record['agentResponseCode'])])
-
-                        else:
-                            print('Error: Invalid output format!')
-
+                        self.output_search_record(record, loop_count == 0)
                         loop_count += 1
 
                     # set from_time for next iteration
@@ -527,12 +3140,9 @@ class SigSciAPI():
 
                     # force limit to 1000 on subsequent iterations to reduce the number of api calls
                     self.limit = 1000
+                    self.flush_output()
 
-                if self.file is not None:
-                    if self.format == 'json':
-                        outfile.write(']')
-
-                    outfile.close()
+                self.end_search_output()
 
             else:
                 print("what")
@@ -543,8 +3153,8 @@ class SigSciAPI():
                 if self.limit is not None:
                     url += '&limit=' + str(self.limit)
 
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                j = json.loads(r.text)
+                r = self.api_request('GET', url)
+                j = self.codec.loads(r.text)
 
                 # output the results
                 self.output_results(j[self.field])
@@ -554,6 +3164,34 @@ class SigSciAPI():
             print('Query: %s ' % url)
             sys.exit()
 
+    def query_offline(self, sources, query=None):
+        """
+        SigSciAPI.query_offline(sources, query=None)
+
+        Runs a request search over local archives, Parquet files and SQLite
+        stores instead of the API and outputs the matches like
+        get_search_results(). The query defaults to the one
+        build_search_query() makes from the search options. See
+        OfflineQuery for the supported sources and terms.
+        """
+        try:
+            if query is None:
+                self.build_search_query()
+                query = self.query
+
+            engine = OfflineQuery(str(query).strip())
+            self.begin_search_output()
+
+            for count, record in enumerate(engine.run(sources, self.offline_workers)):
+                self.output_search_record(record, count == 0)
+
+            self.end_search_output()
+
+        except Exception as e:
+            print('Error: %s ' % str(e))
+            print('Query: %s ' % query)
+            sys.exit()
+
     def get_feed_requests(self):
         """
         SigSciAPI.get_feed_requests()
@@ -574,155 +3212,197 @@ class SigSciAPI():
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
         # /corps/{corpName}/sites/{siteName}/feed/requests
         try:
-            self.query_params = 'from=%s' % str(self.from_time)
-            self.query_params += '&until=%s' % str(self.until_time)
+            url = self.feed_url()
+            j = self.request_json('GET', url)
 
-            if self.tags is not None:
-                self.query_params += '&tags='
-                self.query_params += ','.join(self.tags)
+            if 'message' in j:
+                raise ValueError(j['message'])
 
-            if self.ctags is not None:
-                if self.tags is None:
-                    self.query_params += '&tags='
+            self.output_results(j['data'])
+            self.flush_output()
 
-                self.query_params += ','.join(self.ctags)
+            # get all next
+            url = self.next_url(j['next'])
+            while url is not None:
+                j = self.request_json('GET', url)
 
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.FEED_EP + '?' + str(self.query_params).strip()
+                if 'message' in j:
+                    raise ValueError(j['message'])
 
-            try:
-                # try block attempts to handle unexpected connection issues
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            except Exception:
-                # try again
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
+                self.output_results(j)
+                self.flush_output()
 
-            j = json.loads(r.text)
+                url = self.next_url(j['next'])
 
-            if 'message' in j:
-                raise ValueError(j['message'])
+        except Exception as e:
+            print('Error: %s ' % str(e))
+            print('Query: %s ' % url)
 
-            self.output_results(j['data'])
+    def get_feed_requests2(self):
+        """
+        SigSciAPI.get_feed_requests2()
 
-            # get all next
-            next_ref = j['next']
-            while next_ref['uri'].strip() != '':
-                url = self.base + next_ref['uri']
+        Version 2 of Feed Output
 
-                try:
-                    # try block attempts to handle unexpected connection issues
-                    r = requests.get(url, headers=self.get_headers())
-                except Exception:
-                    # try again
-                    r = requests.get(url, headers=self.get_headers())
+        Before calling, set:
+            (Required):
+                SigSciAPI.corp
+                SigSciAPI.site
 
-                j = json.loads(r.text)
+            (Optional):
+                SigSciAPI.from_time
+                SigSciAPI.until_time
+                SigSciAPI.tags
+                SigSciAPI.file
+                SigSciAPI.format
+                SigSciAPI.prefetch
 
-                if 'message' in j:
-                    raise ValueError(j['message'])
+        """
+        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
+        # /corps/{corpName}/sites/{siteName}/feed/requests
+        try:
+            url = self.feed_url()
+            page_end = object()
 
-                self.output_results(j)
+            # get all pages, downloading ahead while records are written
+            for x in self.iter_records(url, page_end):
+                if x is page_end:
+                    self.flush_output()
+                    continue
 
-                next_ref = j['next']
+                if self.tag_site:
+                    x['siteName'] = self.site
+
+                self.output_results(x)
 
         except Exception as e:
             print('Error: %s ' % str(e))
             print('Query: %s ' % url)
 
-    def get_feed_requests2(self):
+    def iter_pages(self, url):
+        """
+        SigSciAPI.iter_pages(url)
+
+        Yields every decoded page of a paged API response, following the
+        next uri of each page. As soon as a page is parsed the next one is
+        downloaded in the background, up to SigSciAPI.prefetch pages ahead
+        of the consumer (0 disables prefetching).
+        """
+        def pages(url):
+            while url is not None:
+                j = self.request_json('GET', url)
+
+                if 'message' in j:
+                    raise ValueError(j['message'])
+
+                yield j
+
+                url = self.next_url(j.get('next'))
+
+        if self.prefetch < 1:
+            return pages(url)
+
+        return background_iter(pages(url), self.prefetch)
+
+    def iter_records(self, url, page_end=None):
+        """
+        SigSciAPI.iter_records(url, page_end=None)
+
+        Yields the data records of every page starting at url. Pages are
+        prefetched as in iter_pages(), or with SigSciAPI.stream set, decoded
+        incrementally with up to SigSciAPI.prefetch pages worth of records
+        buffered ahead of the consumer. A page_end marker, when given, is
+        yielded after the last record of each page.
+        """
+        if not self.stream:
+            def page_records(pages):
+                for j in pages:
+                    for record in j['data']:
+                        yield record
+
+                    if page_end is not None:
+                        yield page_end
+
+            return page_records(self.iter_pages(url))
+
+        def records(url):
+            while url is not None:
+                envelope = {}
+
+                for record in self.fetch_page(url, envelope):
+                    yield record
+
+                if page_end is not None:
+                    yield page_end
+
+                url = self.next_url(envelope['next']) if 'next' in envelope else None
+
+        if self.prefetch < 1:
+            return records(url)
+
+        return background_iter(records(url), self.prefetch * 1000)
+
+    def get_multi_site_feed(self, sites=None):
         """
-        SigSciAPI.get_feed_requests2()
+        SigSciAPI.get_multi_site_feed(sites=None)
 
-        Version 2 of Feed Output
+        Version 2 of Feed Output for several sites of a corp at once, fetched
+        concurrently over this client's session and login. Every record gets a
+        siteName field.
 
         Before calling, set:
             (Required):
                 SigSciAPI.corp
-                SigSciAPI.site
 
             (Optional):
                 SigSciAPI.from_time
                 SigSciAPI.until_time
                 SigSciAPI.tags
-                SigSciAPI.file
+                SigSciAPI.file          (a {site} placeholder writes one file per site)
                 SigSciAPI.format
+                SigSciAPI.site_workers  (default: 4)
 
+        Without sites, every site of the corp is exported.
         """
-        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
-        # /corps/{corpName}/sites/{siteName}/feed/requests
-        try:
-            self.query_params = 'from=%s' % str(self.from_time)
-            self.query_params += '&until=%s' % str(self.until_time)
+        if sites is None:
+            sites = self.list_sites()
 
-            if self.tags is not None:
-                self.query_params += '&tags='
-                self.query_params += ','.join(self.tags)
-
-            if self.ctags is not None:
-                if self.tags is None:
-                    self.query_params += '&tags='
-
-                self.query_params += ','.join(self.ctags)
-
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.FEED_EP + '?' + str(self.query_params).strip()
+        per_site = self.file is not None and '{site}' in self.file
 
-            try:
-                # try block attempts to handle unexpected connection issues
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            except Exception:
-                # try again
-                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-
-            j = json.loads(r.text)
-
-            if 'message' in j:
-                raise ValueError(j['message'])
+        if not per_site:
+            # one sink shared by every site
+            self.open_output()
 
-            d = j['data']
-            for x in d:
-                self.output_results(x)
+        def export(site):
+            api = self.for_site(site)
+            api.tag_site = True
 
-            # get all next
-            next_ref = j['next']
-            while next_ref['uri'].strip() != '':
-                url = self.base + next_ref['uri']
+            if per_site:
+                api.file = api.file.replace('{site}', site)
+                api.sink = None
 
-                try:
-                    # try block attempts to handle unexpected connection issues
-                    r = requests.get(url, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, headers=self.get_headers())
-                except Exception:
-                    # try again
-                    r = requests.get(url, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, headers=self.get_headers())
-
-                j = json.loads(r.text)
+            # errors are reported per site by get_feed_requests2
+            api.get_feed_requests2()
 
-                if 'message' in j:
-                    raise ValueError(j['message'])
+            if per_site:
+                api.close_output()
 
-                d = j['data']
-                for x in d:
-                    self.output_results(x)
+        self.pool_size = max(self.pool_size, self.site_workers)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.site_workers, len(sites))))
 
-                next_ref = j['next']
+        with executor:
+            for future in [executor.submit(export, site) for site in sites]:
+                future.result()
 
-        except Exception as e:
-            print('Error: %s ' % str(e))
-            print('Query: %s ' % url)
+        self.flush_output()
 
     def get_overview_report(self):
         # https://docs.signalsciences.net/api/#get-overview-report-data
         # GET /corps/{corpName}/reports/attacks
         try:
-            url = self.base_url + self.CORPS_EP + self.corp + self.REPORTS_EP
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.corp_url(self.REPORTS_EP)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -737,97 +3417,131 @@ class SigSciAPI():
 
         Polling with Version 2 of Feed Output
 
+        Runs poll_requests_window() on the windows of a PollScheduler
+        (SigSciAPI.scheduler). The position is kept in a FeedCursor saved
+        after each window, in SigSciAPI.checkpoint if set. A poller that is
+        behind, after a restart or a stall, catches up in windows of up to
+        SigSciAPI.poll_catchup seconds.
+
         Before calling, set:
             (Required):
                 SigSciAPI.corp
                 SigSciAPI.site
 
+            (Optional):
+                SigSciAPI.checkpoint
+                SigSciAPI.poll_status
+
         """
 
-        prev_set = {}
-        curr_set = {}
+        self.start_token_refresher()
         try:
+            cursor = FeedCursor(self.checkpoint)
+            self.scheduler = PollScheduler(self.poll_delay)
+
             while True:
-                # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
-                # /corps/{corpName}/sites/{siteName}/feed/requests
-                self.from_time = '-7m'
-                self.until_time = '-5m'
-                self.parse_init_time()
-                self.query_params = 'from=%s' % str(self.from_time)
-                self.query_params += '&until=%s' % str(self.until_time)
+                self.end_poll_window(self.poll_requests_window(cursor))
+
+        except Exception as e:
+            print('Error: %s ' % str(e))
+            print('Query: %s ' % self.poll_url)
+            sys.exit()
 
-                url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.FEED_EP + '?' + str(self.query_params).strip()
+    def poll_requests_window(self, cursor):
+        """
+        SigSciAPI.poll_requests_window(cursor)
 
-                try:
-                    # try block attempts to handle unexpected connection issues
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                except Exception:
-                    # try again
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-
-                j = json.loads(r.text)
+        Writes the feed window after cursor and saves the cursor. Returns
+        the number of requests written, or None if no new minute is ready.
 
-                if 'message' in j:
-                    raise ValueError(j['message'])
+        Every window starts with the last minute of the previous one, whose
+        requests are skipped by id. Records are written as they arrive, only
+        the ids of a window's first and last minute are kept.
+        """
+        window = self.next_poll_window(cursor, int(time.time()))
 
-                d = j['data']
-                for x in d:
-                    curr_set[x['id']] = x
+        if window is None:
+            return None
 
-                # get all next
-                next_ref = j['next']
-                while next_ref['uri'].strip() != '':
-                    url = self.base + next_ref['uri']
+        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
+        # /corps/{corpName}/sites/{siteName}/feed/requests
+        self.from_time, self.until_time = window
+        self.query_params = 'from=%s' % str(self.from_time)
+        self.query_params += '&until=%s' % str(self.until_time)
 
-                    try:
-                        # try block attempts to handle unexpected connection issues
-                        r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                        # Reauthenticate if token expires early
-                        if r.status_code == 401:
-                            if sigsci.authenticate():
-                                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    except Exception:
-                        # try again
-                        r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                        # Reauthenticate if token expires early
-                        if r.status_code == 401:
-                            if sigsci.authenticate():
-                                r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-
-                    j = json.loads(r.text)
+        self.poll_url = self.site_url(self.FEED_EP) + '?' + str(self.query_params).strip()
+        page_end = object()
+        records = 0
 
-                    if 'message' in j:
-                        raise ValueError(j['message'])
+        # get all pages
+        for x in self.iter_records(self.poll_url, page_end):
+            if x is page_end:
+                self.flush_output()
+                continue
 
-                    d = j['data']
-                    for x in d:
-                        curr_set[x['id']] = x
+            epoch = self.record_epoch(x)
 
-                    next_ref = j['next']
+            # only the first and last minute overlap other windows
+            if epoch < self.from_time + 60 or epoch >= self.until_time - 60:
+                if not cursor.seen.add(x['id'], epoch):
+                    continue
 
-                for id in curr_set:
-                    if id not in prev_set:
-                        # we've haven't seen this request, output it
-                        self.output_results(curr_set[id])
+            if self.tag_site:
+                x['siteName'] = self.site
 
-                # swap curr to prev
-                prev_set = curr_set
-                curr_set = {}
+            records += 1
+            self.output_results(x)
 
-                time.sleep(60)
+        # only move on once the window is written out, and on disk when the cursor is kept
+        self.end_cursor_window(cursor, self.until_time)
+        return records
 
-        except Exception as e:
-            print('Error: %s ' % str(e))
-            print('Query: %s ' % url)
-            sys.exit()
+    def end_cursor_window(self, cursor, until):
+        if cursor.path is not None:
+            self.sync_output()
+        else:
+            self.flush_output()
+
+        cursor.save(until)
+
+    def end_poll_window(self, records):
+        # account for a finished window and wait for the next one
+        if records is not None:
+            self.scheduler.done(records, self.until_time)
+
+            if self.poll_status is not None:
+                write_json_atomic(self.poll_status, self.scheduler.stats())
+
+            if self.scheduler.behind():
+                return
+
+        self.scheduler.wait()
+
+    def next_poll_window(self, cursor, now_epoch):
+        """
+        SigSciAPI.next_poll_window(cursor, now_epoch)
+
+        Returns the from/until epochs of the next feed window after cursor,
+        or None until a new minute is past SigSciAPI.poll_delay. A cursor
+        older than the feed retention resumes at the oldest minute still
+        available, after a warning on stderr.
+        """
+        end = now_epoch - now_epoch % 60 - self.poll_delay
+
+        if cursor.until is None:
+            start = end - self.poll_window
+        elif cursor.until >= end:
+            return None
+        else:
+            start = cursor.until - 60
+
+        oldest = now_epoch - now_epoch % 60 - self.feed_retention + 60
+
+        if start < oldest:
+            sys.stderr.write('Warning: cursor is past the feed retention, requests before %d are skipped\n' % oldest)
+            start = oldest
+
+        return start, min(end, start + self.poll_catchup)
 
     def poll_ev_continuously(self):
         """
@@ -835,65 +3549,207 @@ class SigSciAPI():
 
         Polling events
 
+        Runs poll_events_window() on the windows of a PollScheduler
+        (SigSciAPI.scheduler), as poll_req_continuously() does for requests.
+
         Before calling, set:
             (Required):
                 SigSciAPI.corp
                 SigSciAPI.site
 
+            (Optional):
+                SigSciAPI.events_incremental
+                SigSciAPI.checkpoint
+                SigSciAPI.poll_status
+
         """
 
-        prev_set = {}
-        curr_set = {}
+        self.start_token_refresher()
         try:
+            cursor = FeedCursor(self.checkpoint)
+            self.scheduler = PollScheduler(self.poll_delay)
+
             while True:
-                self.from_time = '-7m'
-                self.until_time = '-5m'
-                self.parse_init_time()
-                query_params = '?limit=1000'
-                query_params += '&from=%s' % str(self.from_time)
-                query_params += '&until=%s' % str(self.until_time)
+                self.end_poll_window(self.poll_events_window(cursor))
 
-                url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.EVENTS_EP + query_params
+        except Exception as e:
+            print('Error: %s ' % str(e))
+            print('Query: %s ' % self.poll_url)
+            sys.exit()
 
-                try:
-                    # try block attempts to handle unexpected connection issues
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                except Exception:
-                    # try again
-                    r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-                    # Reauthenticate if token expires early
-                    if r.status_code == 401:
-                        if sigsci.authenticate():
-                            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-
-                j = json.loads(r.text)
+    def poll_events_window(self, cursor):
+        """
+        SigSciAPI.poll_events_window(cursor)
 
-                if 'message' in j:
-                    raise ValueError(j['message'])
+        Writes the events of the window after cursor and moves the cursor.
+        Returns the number of events written, or None if no new minute is
+        ready.
 
-                d = j['data']
-                for x in d:
-                    curr_set[x['id']] = x
+        Each window starts with the last minute of the previous one. Every
+        page is fetched, following next, and events are written as they
+        arrive. Events repeated by the overlap are skipped by their SeenIds.
 
-                for id in curr_set:
-                    if id not in prev_set:
-                        # we've haven't seen this event, output it
-                        self.output_results(curr_set[id])
+        With SigSciAPI.events_incremental set, the window instead starts at
+        the newest detectedTimestamp seen so far (timestamp for events
+        without one) and runs up to now, so a cycle only fetches events it
+        has not seen yet.
+        """
+        now_epoch = int(time.time())
 
-                # swap curr to prev
-                prev_set = curr_set
-                curr_set = {}
+        if self.events_incremental:
+            self.until_time = now_epoch - now_epoch % 60
+            self.from_time = cursor.until if cursor.until is not None else self.until_time - self.poll_delay - self.poll_window
+            query_params = '?limit=1000'
+            query_params += '&from=%s' % str(self.from_time)
+        else:
+            window = self.next_poll_window(cursor, now_epoch)
 
-                time.sleep(60)
+            if window is None:
+                return None
 
-        except Exception as e:
-            print('Error: %s ' % str(e))
-            print('Query: %s ' % url)
-            sys.exit()
+            self.from_time, self.until_time = window
+            query_params = '?limit=1000'
+            query_params += '&from=%s' % str(self.from_time)
+            query_params += '&until=%s' % str(self.until_time)
+
+        self.poll_url = self.site_url(self.EVENTS_EP) + query_params
+        newest = self.from_time
+        records = 0
+
+        for x in self.iter_records(self.poll_url):
+            if self.events_incremental:
+                epoch = self.detected_epoch(x)
+                newest = max(newest, epoch)
+            else:
+                epoch = self.until_time
+
+            if cursor.seen.add(x['id'], epoch):
+                # we've haven't seen this event, output it
+                if self.tag_site:
+                    x['siteName'] = self.site
+
+                records += 1
+                self.output_results(x)
+
+        self.end_cursor_window(cursor, newest if self.events_incremental else self.until_time)
+        return records
+
+    @staticmethod
+    def detected_epoch(event):
+        # epoch an event was detected at, its start for events without detectedTimestamp
+        timestamp = datetime.datetime.strptime(event.get('detectedTimestamp') or event['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+        return calendar.timegm(timestamp.utctimetuple())
+
+    @staticmethod
+    def poll_targets(config):
+        """
+        SigSciAPI.poll_targets(config)
+
+        Returns the poll_sites() targets of the [poll:<name>] sections of a
+        ConfigParser. The site defaults to the section name.
+        """
+        targets = []
+
+        for section in config.sections():
+            if not section.startswith('poll:'):
+                continue
+
+            target = dict(config.items(section))
+            target.setdefault('site', section[len('poll:'):])
+            targets.append(target)
+
+        return targets
+
+    def poll_sites(self, targets):
+        """
+        SigSciAPI.poll_sites(targets)
+
+        Polls the request feed or events of many sites, of one or several
+        corps, in one process. Every site has its own cursor and
+        PollScheduler, and windows that are due run on up to
+        SigSciAPI.site_workers threads over this client's session and
+        login. A site has one request in flight at a time and the
+        SigSciAPI.rate_limiter buckets serve waiting requests in turn, so
+        busy sites take no more than their share of a corp's rate limit.
+        A site whose window fails is reported on stderr and retried after a
+        backoff while the others go on.
+
+        targets is a list of dicts (see poll_targets()):
+            site        (required)
+            corp        (default: SigSciAPI.corp)
+            kind        requests or events (default: requests)
+            incremental events from the newest one seen (default:
+                        SigSciAPI.events_incremental)
+            file        output of the site (default: SigSciAPI.file)
+            checkpoint  cursor file of the site
+        {corp} and {site} in file and checkpoint are replaced. Records
+        written to a shared output get a siteName field. With
+        SigSciAPI.poll_status set, the scheduler stats of every site are
+        written to it after every window.
+        """
+        if not targets:
+            raise ValueError('No sites to poll')
+
+        sites = []
+        self.pool_size = max(self.pool_size, self.site_workers)
+
+        def expand(value, api):
+            if value is None:
+                return None
+
+            return value.replace('{corp}', api.corp).replace('{site}', api.site)
+
+        if any(target.get('file', self.file) == self.file and '{' not in str(self.file) for target in targets):
+            # one sink shared by these sites
+            self.open_output()
+
+        for target in targets:
+            api = self.for_site(target['site'], target.get('corp'))
+            file = expand(target.get('file', self.file), api)
+
+            if file != self.file:
+                api.file = file
+                api.sink = None
+            else:
+                api.tag_site = True
+
+            if 'incremental' in target:
+                api.events_incremental = str(target['incremental']).lower() in ('1', 'true', 'yes', 'on')
+
+            sites.append(PollSite(api, target.get('kind', 'requests'), expand(target.get('checkpoint'), api)))
+
+        self.start_token_refresher()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.site_workers, len(sites))))
+        running = {}
+
+        try:
+            while True:
+                now = time.time()
+
+                for site in sorted(sites, key=lambda site: site.due):
+                    if site not in running.values() and site.due <= now:
+                        running[executor.submit(site.run)] = site
+
+                waiting = [site.due for site in sites if site not in running.values()]
+                timeout = max(0, min(waiting) - now) if waiting else None
+                done, _ = concurrent.futures.wait(list(running), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    del running[future]
+                    # window errors are handled by the site, anything else stops the daemon
+                    future.result()
+
+                if done and self.poll_status is not None:
+                    write_json_atomic(self.poll_status, dict((site.name, site.scheduler.stats()) for site in sites))
+
+        finally:
+            executor.shutdown(wait=False)
+
+            for site in sites:
+                if site.api.sink is not self.sink:
+                    site.api.close_output()
+
+            self.flush_output()
 
     def get_timeseries(self, tags, rollup=60):
         """
@@ -916,20 +3772,9 @@ class SigSciAPI():
         # /corps/{corpName}/sites/{siteName}/timeseries/requests
 
         try:
-            self.query_params = '?rollup={}'.format(str(rollup).strip())
-
-            if self.from_time is not None:
-                self.query_params += '&from={}'.format(str(self.from_time))
-
-            if self.until_time is not None:
-                self.query_params += '&until={}'.format(str(self.until_time))
-
-            for tag in tags:
-                self.query_params += '&tag={}'.format(tag)
-
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.TIMESERIES_EP + self.query_params
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.timeseries_url(tags, rollup)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             if 'message' in j:
                 raise ValueError(j['message'])
@@ -945,6 +3790,9 @@ class SigSciAPI():
         """
         SigSciAPI.get_list_events(tag)
 
+        Follows next to the last page of events, writing each page as it
+        arrives.
+
         Before calling, set:
             (Required):
                 SigSciAPI.corp
@@ -961,25 +3809,11 @@ class SigSciAPI():
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__events_get
         # /corps/{corpName}/sites/{siteName}/events
         try:
-            query_params = '?limit=' + str(self.limit)
-
-            if self.from_time is not None:
-                query_params += '&from=%s' % str(self.from_time)
-
-            if self.until_time is not None:
-                query_params += '&until=%s' % str(self.until_time)
-
-            if tag is not None:
-                query_params += '&tag=%s' % (str(tag).strip())
-
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.EVENTS_EP + query_params
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.events_url(tag)
 
-            if 'message' in j:
-                raise ValueError(j['message'])
-
-            self.output_results(j)
+            for j in self.iter_pages(url):
+                self.output_results(j)
+                self.flush_output()
 
         except Exception as e:
             print('Error: %s ' % str(e))
@@ -1004,9 +3838,9 @@ class SigSciAPI():
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__events__eventID__get
         # /corps/{corpName}/sites/{siteName}/events/{eventID}
         try:
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.EVENTS_EP + '/' + self.event_by_id
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.site_url(self.EVENTS_EP + '/' + self.event_by_id)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -1017,8 +3851,8 @@ class SigSciAPI():
 
     def get_list(self, url):
         try:
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -1030,7 +3864,7 @@ class SigSciAPI():
     def get_agent_metrics(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__agents_get
         # /corps/{corpName}/sites/{siteName}/agents
-        url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.AGENTS_EP
+        url = self.site_url(self.AGENTS_EP)
         return self.get_list(url)
 
     def get_agent_logs(self, agent_name):
@@ -1038,9 +3872,9 @@ class SigSciAPI():
         # /corps/{corpName}/sites/{siteName}/agents/{agentName}/logs
 
         try:
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.AGENTS_EP + '/' + agent_name + '/logs'
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.site_url(self.AGENTS_EP + '/' + agent_name + '/logs')
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -1052,31 +3886,41 @@ class SigSciAPI():
         if self.corp is None:
             url = self.base_url + self.CORPS_EP[:-1]
         else:
-            url = self.base_url + self.CORPS_EP + self.corp
+            url = self.corp_url()
 
         return self.get_list(url)
 
     def get_sites(self):
-        url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP[:-1]
+        url = self.corp_url(self.SITES_EP[:-1])
         return self.get_list(url)
 
+    def list_sites(self):
+        # names of every site in the corp
+        url = self.corp_url(self.SITES_EP[:-1])
+        j = self.request_json('GET', url)
+
+        if 'message' in j:
+            raise ValueError(j['message'])
+
+        return [site['name'] for site in j['data']]
+
     def get_members(self):
-        url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + self.MEMBERS_EP
+        url = self.site_url(self.MEMBERS_EP)
         return self.get_list(url)
 
     def post_members(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__members_post
         # POST /corps/{corpName}/sites/{siteName}/members
-        self.post_configuration(self.MEMBERS_EP)
+        return self.post_configuration(self.MEMBERS_EP)
 
     def post_member(self, email):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__members__siteMemberEmail__invite_post
         # POST /corps/{corpName}/sites/{siteName}/members/{siteMemberEmail}/invite
         endpoint = '{}/{}/invite'.format(self.MEMBERS_EP, email)
-        self.post_configuration(endpoint)
+        return self.post_configuration(endpoint)
 
     def get_users(self):
-        url = self.base_url + self.CORPS_EP + self.corp + self.USERS_EP
+        url = self.corp_url(self.USERS_EP)
         return self.get_list(url)
 
     def get_configuration(self, EP, level='site'):
@@ -1085,16 +3929,11 @@ class SigSciAPI():
             if self.limit is None:
                 self.limit = 100
 
-            url = self.base_url + self.CORPS_EP + self.corp
-
-            if level == 'site':
-                url += self.SITES_EP + self.site
-
-            url += EP
+            url = self.config_url(EP, level)
 
             url += '?limit=' + str(self.limit)
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -1103,46 +3942,48 @@ class SigSciAPI():
             print('Query: %s ' % url)
             sys.exit()
 
-    def post_configuration(self, EP, level='site'):
-        try:
-            url = self.base_url + self.CORPS_EP + self.corp
+    def load_configuration(self):
+        with open(self.file) as data_file:
+            return json.load(data_file)
 
-            if level == 'site':
-                url += self.SITES_EP + self.site
+    def config_items(self, EP, data):
+        """
+        SigSciAPI.config_items(EP, data)
 
-            url += EP
+        Yields (id, config) for every entry of a configuration export with the
+        read-only fields removed. Data without a data section is yielded as is.
+        """
+        if 'data' not in data:
+            # no data section, just send as is.
+            yield None, data
+            return
 
-            with open(self.file) as data_file:
-                data = json.load(data_file)
+        for config in data['data']:
+            if 'created' in config:
+                del config['created']
 
-            if 'data' not in data:
-                # no data section, just post as is.
-                r = requests.post(url, cookies=self.authn.cookies, headers=self.get_headers(), json=data)
-                j = json.loads(r.text)
+            if 'createdBy' in config:
+                del config['createdBy']
 
-                if 'message' in j:
-                    print('Data: %s ' % json.dumps(data))
-                    raise ValueError(j['message'])
-            else:
-                for config in data['data']:
-                    if 'created' in config:
-                        del config['created']
+            config_id = config.pop('id', None)
 
-                    if 'createdBy' in config:
-                        del config['createdBy']
+            if EP == self.TAGS_EP and 'tagName' in config:
+                del config['tagName']
 
-                    if 'id' in config:
-                        del config['id']
+            yield config_id, config
 
-                    if EP == self.TAGS_EP and 'tagName' in config:
-                        del config['tagName']
+    def post_configuration(self, EP, level='site'):
+        try:
+            url = self.config_url(EP, level)
+            data = self.load_configuration()
 
-                    r = requests.post(url, cookies=self.authn.cookies, headers=self.get_headers(), json=config)
-                    j = json.loads(r.text)
+            for _, config in self.config_items(EP, data):
+                r = self.api_request('POST', url, json=config)
+                j = self.codec.loads(r.text)
 
-                    if 'message' in j:
-                        print('Data: %s ' % json.dumps(config))
-                        raise ValueError(j['message'])
+                if 'message' in j:
+                    print('Data: %s ' % json.dumps(config))
+                    raise ValueError(j['message'])
 
             print("Post complete!")
 
@@ -1153,45 +3994,17 @@ class SigSciAPI():
 
     def patch_configuration(self, EP, level='site'):
         try:
-            url = self.base_url + self.CORPS_EP + self.corp
-
-            if level == 'site':
-                url += self.SITES_EP + self.site
-
-            url += EP
-
-            with open(self.file) as data_file:
-                data = json.load(data_file)
+            url = self.config_url(EP, level)
+            data = self.load_configuration()
 
-            if 'data' not in data:
-                # no data section, just post as is.
-                r = requests.patch(url, cookies=self.authn.cookies, headers=self.get_headers(), json=data)
-                j = json.loads(r.text)
+            for config_id, config in self.config_items(EP, data):
+                item_url = url if config_id is None else url + '/{}'.format(config_id)
+                r = self.api_request('PATCH', item_url, json=config)
+                j = self.codec.loads(r.text)
 
                 if 'message' in j:
-                    print('Data: %s ' % json.dumps(data))
+                    print('Data: %s ' % json.dumps(config))
                     raise ValueError(j['message'])
-            else:
-                for config in data['data']:
-                    if 'created' in config:
-                        del config['created']
-
-                    if 'createdBy' in config:
-                        del config['createdBy']
-
-                    if 'id' in config:
-                        url += '/{}'.format(config['id'])
-                        del config['id']
-
-                    if EP == self.TAGS_EP and 'tagName' in config:
-                        del config['tagName']
-
-                    r = requests.patch(url, cookies=self.authn.cookies, headers=self.get_headers(), json=config)
-                    j = json.loads(r.text)
-
-                    if 'message' in j:
-                        print('Data: %s ' % json.dumps(config))
-                        raise ValueError(j['message'])
 
             print("Patch complete!")
 
@@ -1202,13 +4015,12 @@ class SigSciAPI():
 
     def delete_configuration(self, EP):
         try:
-            url = self.base_url + self.CORPS_EP + self.corp + self.SITES_EP + self.site + EP
+            url = self.site_url(EP)
 
-            with open(self.file) as data_file:
-                data = json.load(data_file)
+            data = self.load_configuration()
 
             for config in data['data']:
-                requests.delete(url + "/" + config['id'], cookies=self.authn.cookies, headers=self.get_headers())
+                self.api_request('DELETE', url + "/" + config['id'])
 
             print("Delete complete!")
 
@@ -1220,251 +4032,251 @@ class SigSciAPI():
     def get_custom_alerts(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__alerts_get
         # /corps/{corpName}/sites/{siteName}/alerts
-        self.get_configuration(self.ALERTS_EP)
+        return self.get_configuration(self.ALERTS_EP)
 
     def post_custom_alerts(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__rules_post
         # /corps/{corpName}/sites/{siteName}/alerts
-        self.post_configuration(self.ALERTS_EP)
+        return self.post_configuration(self.ALERTS_EP)
 
     def delete_custom_alerts(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__alerts__alertID__delete
         # /corps/{corpName}/sites/{siteName}/alerts/{alertID}
-        self.delete_configuration(self.ALERTS_EP)
+        return self.delete_configuration(self.ALERTS_EP)
 
     def get_custom_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/advancedRules
-        self.get_configuration(self.RULES_EP)
+        return self.get_configuration(self.RULES_EP)
 
     def post_custom_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/advancedRules
-        self.post_configuration(self.RULES_EP)
+        return self.post_configuration(self.RULES_EP)
 
     def patch_custom_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/advancedRules
-        self.patch_configuration(self.RULES_EP)
+        return self.patch_configuration(self.RULES_EP)
 
     def get_corp_rule_lists(self):
         # /corps/{corpName}/lists
-        self.get_configuration(self.CORP_RULE_LISTS_EP, level='corp')
+        return self.get_configuration(self.CORP_RULE_LISTS_EP, level='corp')
 
     def get_site_rule_lists(self):
         # new method name for get_rule_lists()
-        self.get_configuration(self.RULE_LISTS_EP)
+        return self.get_configuration(self.RULE_LISTS_EP)
 
     def get_rule_lists(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/lists
-        self.get_configuration(self.RULE_LISTS_EP)
+        return self.get_configuration(self.RULE_LISTS_EP)
 
     def post_corp_rule_lists(self):
         # /corps/{corpName}/lists
-        self.post_configuration(self.CORP_RULE_LISTS_EP, level='corp')
+        return self.post_configuration(self.CORP_RULE_LISTS_EP, level='corp')
 
     def post_site_rule_lists(self):
         # new method name for post_rule_lists()
-        self.post_configuration(self.RULE_LISTS_EP)
+        return self.post_configuration(self.RULE_LISTS_EP)
 
     def post_rule_lists(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/lists
-        self.post_configuration(self.RULE_LISTS_EP)
+        return self.post_configuration(self.RULE_LISTS_EP)
 
     def delete_rule_lists(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/lists
-        self.delete_configuration(self.RULE_LISTS_EP)
+        return self.delete_configuration(self.RULE_LISTS_EP)
 
     def delete_custom_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/advancedRules/{ruleID}
-        self.delete_configuration(self.RULES_EP)
+        return self.delete_configuration(self.RULES_EP)
 
     def get_corp_signals(self):
         # /corps/{corpName}/tags
-        self.get_configuration(self.CORP_SIGNALS_EP, level='corp')
+        return self.get_configuration(self.CORP_SIGNALS_EP, level='corp')
 
     def get_site_signals(self):
         # New method name for get_custom_tags()
-        self.get_configuration(self.TAGS_EP)
+        return self.get_configuration(self.TAGS_EP)
 
     def get_custom_tags(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/tags
-        self.get_configuration(self.TAGS_EP)
+        return self.get_configuration(self.TAGS_EP)
 
     def post_corp_signals(self):
         # /corps/{corpName}/tags
-        self.post_configuration(self.CORP_SIGNALS_EP, level='corp')
+        return self.post_configuration(self.CORP_SIGNALS_EP, level='corp')
 
     def post_site_signals(self):
         # New method name for post_custom_tags()
-        self.post_configuration(self.TAGS_EP)
+        return self.post_configuration(self.TAGS_EP)
 
     def post_custom_tags(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/tags
-        self.post_configuration(self.TAGS_EP)
+        return self.post_configuration(self.TAGS_EP)
 
     def delete_custom_tags(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/tags/{tagID}
-        self.delete_configuration(self.TAGS_EP)
+        return self.delete_configuration(self.TAGS_EP)
 
     def get_configured_templates(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
-        self.get_configuration(self.CONFIGURED_TEMPLATES_EP)
+        return self.get_configuration(self.CONFIGURED_TEMPLATES_EP)
 
     def post_configured_templates(self, template):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
-        self.post_configuration(self.CONFIGURED_TEMPLATES_EP + '/' + template)
+        return self.post_configuration(self.CONFIGURED_TEMPLATES_EP + '/' + template)
 
     def get_whitelist_parameters(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__paramwhitelist_get
         # /corps/{corpName}/sites/{siteName}/paramwhitelist
-        self.get_configuration(self.WLPARAMS_EP)
+        return self.get_configuration(self.WLPARAMS_EP)
 
     def post_whitelist_parameters(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__paramwhitelist_post
         # /corps/{corpName}/sites/{siteName}/paramwhitelist
-        self.post_configuration(self.WLPARAMS_EP)
+        return self.post_configuration(self.WLPARAMS_EP)
 
     def delete_whitelist_parameters(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__paramwhitelist__paramID__delete
         # /corps/{corpName}/sites/{siteName}/paramwhitelist/{paramID}
-        self.delete_configuration(self.WLPARAMS_EP)
+        return self.delete_configuration(self.WLPARAMS_EP)
 
     def get_whitelist_paths(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathwhitelist_get
         # /corps/{corpName}/sites/{siteName}/pathwhitelist
-        self.get_configuration(self.WLPATHS_EP)
+        return self.get_configuration(self.WLPATHS_EP)
 
     def post_whitelist_paths(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathwhitelist_post
         # /corps/{corpName}/sites/{siteName}/pathwhitelist
-        self.post_configuration(self.WLPATHS_EP)
+        return self.post_configuration(self.WLPATHS_EP)
 
     def delete_whitelist_paths(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathwhitelist__pathID__delete
         # /corps/{corpName}/sites/{siteName}/pathwhitelist/{pathID}
-        self.delete_configuration(self.WLPATHS_EP)
+        return self.delete_configuration(self.WLPATHS_EP)
 
     def get_whitelist(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__whitelist_get
         # /corps/{corpName}/sites/{siteName}/whitelist
-        self.get_configuration(self.WHITELIST_EP)
+        return self.get_configuration(self.WHITELIST_EP)
 
     def post_whitelist(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathwhitelist_post
         # /corps/{corpName}/sites/{siteName}/whitelist
-        self.post_configuration(self.WHITELIST_EP)
+        return self.post_configuration(self.WHITELIST_EP)
 
     def delete_whitelist(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathwhitelist__pathID__delete
         # /corps/{corpName}/sites/{siteName}/whitelist/{source}
-        self.delete_configuration(self.WHITELIST_EP)
+        return self.delete_configuration(self.WHITELIST_EP)
 
     def get_blacklist(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__blacklist_get
         # /corps/{corpName}/sites/{siteName}/blacklist
-        self.get_configuration(self.BLACKLIST_EP)
+        return self.get_configuration(self.BLACKLIST_EP)
 
     def post_blacklist(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathblacklist_post
         # /corps/{corpName}/sites/{siteName}/blacklist
-        self.post_configuration(self.BLACKLIST_EP)
+        return self.post_configuration(self.BLACKLIST_EP)
 
     def delete_blacklist(self):
         # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__pathblacklist__pathID__delete
         # /corps/{corpName}/sites/{siteName}/blacklist/{source}
-        self.delete_configuration(self.BLACKLIST_EP)
+        return self.delete_configuration(self.BLACKLIST_EP)
 
     def get_corp_rules(self):
         # /corps/{corpName}/rules
-        self.get_configuration(self.CORP_RULES_EP, level='corp')
+        return self.get_configuration(self.CORP_RULES_EP, level='corp')
 
     def post_corp_rules(self):
         # /corps/{corpName}/rules
-        self.post_configuration(self.CORP_RULES_EP, level='corp')
+        return self.post_configuration(self.CORP_RULES_EP, level='corp')
 
     def get_site_request_rules(self):
         # New name for get_request_rules()
-        self.get_configuration(self.REQUEST_RULES_EP)
+        return self.get_configuration(self.REQUEST_RULES_EP)
 
     def get_request_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/requestRules
-        self.get_configuration(self.REQUEST_RULES_EP)
+        return self.get_configuration(self.REQUEST_RULES_EP)
 
     def post_site_request_rules(self):
         # New name for post_site_request_rules()
-        self.post_configuration(self.REQUEST_RULES_EP)
+        return self.post_configuration(self.REQUEST_RULES_EP)
 
     def post_request_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/whitelist
-        self.post_configuration(self.REQUEST_RULES_EP)
+        return self.post_configuration(self.REQUEST_RULES_EP)
 
     def delete_request_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/blacklist/{source}
-        self.delete_configuration(self.REQUEST_RULES_EP)
+        return self.delete_configuration(self.REQUEST_RULES_EP)
 
     def get_site_signal_rules(self):
         # New name for get_signal_rules()
-        self.get_configuration(self.SIGNAL_RULES_EP)
+        return self.get_configuration(self.SIGNAL_RULES_EP)
 
     def get_signal_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/signalRules
-        self.get_configuration(self.SIGNAL_RULES_EP)
+        return self.get_configuration(self.SIGNAL_RULES_EP)
 
     def post_site_signal_rules(self):
         # New name for post_signal_rules()
-        self.post_configuration(self.SIGNAL_RULES_EP)
+        return self.post_configuration(self.SIGNAL_RULES_EP)
 
     def post_signal_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/whitelist
-        self.post_configuration(self.SIGNAL_RULES_EP)
+        return self.post_configuration(self.SIGNAL_RULES_EP)
 
     def delete_signal_rules(self):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites/{siteName}/blacklist/{source}
-        self.delete_configuration(self.SIGNAL_RULES_EP)
+        return self.delete_configuration(self.SIGNAL_RULES_EP)
 
     def get_redactions(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__redactions_get
         # /corps/{corpName}/sites/{siteName}/redactions
-        self.get_configuration(self.REDACTIONS_EP)
+        return self.get_configuration(self.REDACTIONS_EP)
 
     def post_redactions(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__redactions_post
         # /corps/{corpName}/sites/{siteName}/redactions
-        self.post_configuration(self.REDACTIONS_EP)
+        return self.post_configuration(self.REDACTIONS_EP)
 
     def delete_redactions(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__redactions__field__delete
         # /corps/{corpName}/sites/{siteName}/redactions/{field}
-        self.delete_configuration(self.REDACTIONS_EP)
+        return self.delete_configuration(self.REDACTIONS_EP)
 
     def get_integrations(self):
         # https://dashboard.signalsciences-stage.net/documentation/api#_corps__corpName__sites__siteName__redactions_get
         # /corps/{corpName}/sites/{siteName}/redactions
-        self.get_configuration(self.INTEGRATIONS_EP)
+        return self.get_configuration(self.INTEGRATIONS_EP)
 
     def post_integrations(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__integrations_post
         # /corps/{corpName}/sites/{siteName}/integrations
-        self.post_configuration(self.INTEGRATIONS_EP)
+        return self.post_configuration(self.INTEGRATIONS_EP)
 
     def get_headerlinks(self):
         # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__headerLinks_get
         # /corps/{corpName}/sites/{siteName}/headerLinks
-        self.get_configuration(self.HEADERLINKS_EP)
+        return self.get_configuration(self.HEADERLINKS_EP)
 
     def get_health(self):
         # https://docs.signalsciences.net/api/#health
@@ -1474,9 +4286,9 @@ class SigSciAPI():
             if self.limit is None:
                 self.limit = 100
 
-            url = self.base_url + self.CORPS_EP + self.corp + self.HEALTH_EP
-            r = requests.get(url, cookies=self.authn.cookies, headers=self.get_headers())
-            j = json.loads(r.text)
+            url = self.corp_url(self.HEALTH_EP)
+            r = self.api_request('GET', url)
+            j = self.codec.loads(r.text)
 
             self.json_out(j)
 
@@ -1488,13 +4300,13 @@ class SigSciAPI():
     def create_site(self, name, displayName, agentLevel):
         # WARNING: This is an undocumented endpoint. No support provided, and the endpoint may change.
         # /corps/{corpName}/sites?expand=members
-        url = self.base_url + self.CORPS_EP + self.corp + '/sites?expand=members'
+        url = self.corp_url('/sites?expand=members')
 
         try:
             site = {'name': name, 'displayName': displayName, 'agentLevel': agentLevel}
 
-            r = requests.post(url, cookies=self.authn.cookies, headers=self.get_headers(), json=site)
-            j = json.loads(r.text)
+            r = self.api_request('POST', url, json=site)
+            j = self.codec.loads(r.text)
 
             if 'message' in j:
                 print('Data: %s ' % json.dumps(site))
@@ -1508,59 +4320,113 @@ class SigSciAPI():
             sys.exit()
 
     def output_results(self, j):
+        sink = self.open_output()
+
         if self.format == 'json':
-            if not self.file:
-                print('%s' % json.dumps(j))
-            else:
-                with open(self.file, 'a') as outfile:
-                    outfile.write('%s' % json.dumps(j))
+            sink.write_record('%s' % self.codec.dumps(self.project(j)), j)
 
         elif self.format == 'csv':
-            if not self.file:
-                csvwriter = csv.writer(sys.stdout)
-            else:
-                csvwriter = csv.writer(open(self.file, "wb+"))
+            for row in self.records_of(j):
+                sink.writerow(self.csv_row(row), row)
 
-            for row in j:
-                if sigsci.list_events:
-                    reason_list = ''
-                    for reason in row['reasons']:
-                        reason_list = reason_list + reason + '|'
+        elif self.format == 'ndjson':
+            self.output_ndjson(j)
 
-                    # output fields for list events
-                    csvwriter.writerow([str(row['timestamp']), str(row['id']), str(row['source']), str(row['remoteHostname']), str(row['remoteCountryCode']), str(row['action']), str(row['type']), str(reason_list[:-1]), str(row['tagCount']), str(row['window']), str(row['detectedTimestamp']), str(row['expires'])])
+        elif self.format == 'parquet':
+            sink.write_records(self.records_of(j))
 
-                else:
-                    tag_list = ''
-                    detector = row['tags']
+        else:
+            print('Error: Invalid output format!')
 
-                    for t in detector:
-                        tag_list = tag_list + t['type'] + '|'
+    @staticmethod
+    def records_of(j):
+        # the items of a list or of the data list of an API response, or j itself
+        if isinstance(j, dict) and isinstance(j.get('data'), list):
+            return j['data']
 
-                    # default, output fields for requests
-                    csvwriter.writerow([str(row['timestamp']), str(row['id']), str(row['remoteIP']), str(row['remoteCountryCode']), str(row['path']).encode('utf8'), str(tag_list[:-1]), str(row['responseCode']), str(row['agentResponseCode'])])
+        if isinstance(j, list):
+            return j
 
-        else:
-            print('Error: Invalid output format!')
+        return [j]
+
+    def output_ndjson(self, j):
+        """
+        SigSciAPI.output_ndjson(j)
+
+        Writes the records of j as newline delimited JSON, one record per
+        line. Lines are written in one call, so records from several
+        threads never interleave.
+        """
+        records = self.records_of(j)
+        self.open_output().write_lines([self.codec.dumps(self.project(record)) for record in records], records)
+
+    def csv_row(self, record):
+        """
+        SigSciAPI.csv_row(record)
+
+        The CSV cells of a record: the SigSciAPI.fields columns, or by
+        default REQUEST_CSV_FIELDS for requests and EVENT_CSV_FIELDS for
+        events (records with reasons).
+        """
+        projection = self.get_projection()
+
+        if projection is None:
+            projection = self.EVENT_CSV_FIELDS if 'reasons' in record else self.REQUEST_CSV_FIELDS
+
+        return projection.values(record)
+
+    def get_projection(self):
+        """
+        SigSciAPI.get_projection()
+
+        Returns SigSciAPI.fields compiled to a FieldProjection (once), or
+        None to output whole records.
+        """
+        if self.fields is not None and not isinstance(self.fields, FieldProjection):
+            self.fields = FieldProjection(self.fields)
+
+        return self.fields
+
+    def project(self, j):
+        # SigSciAPI.fields applied to a record, a list of records or the data of an API page
+        projection = self.get_projection()
+
+        if projection is None:
+            return j
+
+        if isinstance(j, list):
+            return [projection.project(record) for record in j]
+
+        if isinstance(j, dict) and isinstance(j.get('data'), list):
+            return dict(j, data=[projection.project(record) for record in j['data']])
+
+        return projection.project(j)
 
     def json_out(self, j):
         if 'message' in j:
             raise ValueError(j['message'])
 
         if self.format == 'json':
-            if not self.file:
-                if self.pretty:
-                    print('%s' % json.dumps(j, sort_keys=True, indent=4, separators=(',', ': ')))
-                else:
-                    print('%s' % json.dumps(j))
+            sink = self.open_output()
 
+            if not self.file and self.pretty:
+                sink.write_record('%s' % json.dumps(self.project(j), sort_keys=True, indent=4, separators=(',', ': ')))
             else:
-                with open(self.file, 'a') as outfile:
-                    outfile.write('%s' % json.dumps(j))
+                sink.write_record('%s' % self.codec.dumps(self.project(j)))
+
+            # a complete response, readable as soon as the call returns
+            sink.flush()
+
+        elif self.format == 'ndjson':
+            self.output_ndjson(j)
+            self.flush_output()
 
         elif self.format == 'csv':
             print("CSV output not available for this request.")
 
+        elif self.format == 'parquet':
+            print("Parquet output not available for this request.")
+
     def parse_init_time(self):
         # parse from/until time
         now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
@@ -1679,12 +4545,188 @@ class SigSciAPI():
 
     def __init__(self):
         self.base_url = self.url + self.version
+        self.retry = RetryPolicy()
+        self.auth = AuthState()
+        self.auth_lock = threading.RLock()
+        self.codec = JSONCodec()
         vfile = open(os.path.dirname(os.path.abspath(__file__)) + '/VERSION', 'r')
         self.agent_version = vfile.read().strip()
         vfile.close()
         self.ua = 'Signal Sciences API Client (Python/{})'.format(self.agent_version)
 
 
+class AsyncSigSciAPI(SigSciAPI):
+    """
+    AsyncSigSciAPI()
+    asyncio client with the same surface as SigSciAPI for the query, feed,
+    events, timeseries and configuration endpoints. Each of those methods
+    is a coroutine; API errors raise ValueError instead of exiting.
+
+    HTTP calls go through the inherited pooled session on a thread pool of
+    max_concurrency workers, which bounds how many requests are in flight.
+    Auth, headers and url building are shared with SigSciAPI.
+
+    Example:
+        api       = AsyncSigSciAPI()
+        api.email = 'foo@bar.com'
+        api.api_token = 'xxxx'
+        api.corp  = 'foo_bar'
+        api.max_concurrency = 16
+
+        async def export(sites):
+            await asyncio.gather(*[api.for_site(s).get_feed_requests2() for s in sites])
+
+        if api.authenticate():
+            api.feed2 = True
+            api.parse_init_time()
+            asyncio.get_event_loop().run_until_complete(export(['www.foo.com', 'www.bar.com']))
+    """
+    max_concurrency = 8
+    executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            self.pool_size = max(self.pool_size, self.max_concurrency)
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        return self.executor
+
+    def for_site(self, site, corp=None):
+        # site copies share the session and the bounded executor
+        self.get_executor()
+        return super(AsyncSigSciAPI, self).for_site(site, corp)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        super(AsyncSigSciAPI, self).close()
+
+    async def fetch_json(self, method, url, **kwargs):
+        """
+        AsyncSigSciAPI.fetch_json(method, url, **kwargs)
+
+        Sends an API request on the bounded executor and returns the decoded
+        JSON body. Raises ValueError if the API returned an error message.
+        """
+        # decoding runs on the executor thread too, off the event loop
+        executor = self.get_executor()
+        loop = asyncio.get_event_loop()
+        j = await loop.run_in_executor(executor, functools.partial(self.request_json, method, url, **kwargs))
+
+        if isinstance(j, dict) and 'message' in j:
+            raise ValueError(j['message'])
+
+        return j
+
+    async def query_api(self):
+        # https://docs.signalsciences.net/api/#_corps__corpName__sites__siteName__requests_get
+        # /corps/{corpName}/sites/{siteName}/requests
+        if self.field != 'data':
+            j = await self.fetch_json('GET', self.search_url())
+            self.output_results(j[self.field])
+            return j
+
+        self.limit = 1000
+        last_epoch = 0
+        loop_count = 0
+        get_next = True
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        now_epoch = calendar.timegm(now.utctimetuple())
+
+        self.begin_search_output()
+
+        try:
+            while last_epoch <= self.until_time and get_next:
+                j = await self.fetch_json('GET', self.search_url())
+                record_count = 0
+
+                for record in j['data']:
+                    record_count += 1
+                    last_epoch = self.record_epoch(record)
+                    self.output_search_record(record, loop_count == 0)
+                    loop_count += 1
+
+                self.flush_output()
+                get_next = self.next_search_window(record_count, last_epoch, now_epoch)
+
+        finally:
+            self.end_search_output()
+
+    async def get_feed_requests2(self):
+        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__feed_requests_get
+        # /corps/{corpName}/sites/{siteName}/feed/requests
+        url = self.feed_url()
+
+        while url is not None:
+            j = await self.fetch_json('GET', url)
+
+            for x in j['data']:
+                if self.tag_site:
+                    x['siteName'] = self.site
+
+                self.output_results(x)
+
+            self.flush_output()
+            url = self.next_url(j['next'])
+
+    async def get_list_events(self, tag=None):
+        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__events_get
+        # /corps/{corpName}/sites/{siteName}/events
+        # every page is written as it arrives, returns the last one
+        url = self.events_url(tag)
+
+        while url is not None:
+            j = await self.fetch_json('GET', url)
+            self.output_results(j)
+            self.flush_output()
+            url = self.next_url(j.get('next'))
+
+        return j
+
+    async def get_timeseries(self, tags, rollup=60):
+        # https://dashboard.signalsciences.net/documentation/api#_corps__corpName__sites__siteName__timeseries_requests_get
+        # /corps/{corpName}/sites/{siteName}/timeseries/requests
+        j = await self.fetch_json('GET', self.timeseries_url(tags, rollup))
+        self.json_out(j)
+        return j
+
+    async def get_configuration(self, EP, level='site'):
+        # default config limit to 100
+        if self.limit is None:
+            self.limit = 100
+
+        j = await self.fetch_json('GET', self.config_url(EP, level) + '?limit=' + str(self.limit))
+        self.json_out(j)
+        return j
+
+    async def post_configuration(self, EP, level='site'):
+        url = self.config_url(EP, level)
+        items = list(self.config_items(EP, self.load_configuration()))
+        await asyncio.gather(*[self.fetch_json('POST', url, json=config) for _, config in items])
+        print("Post complete!")
+
+    async def patch_configuration(self, EP, level='site'):
+        url = self.config_url(EP, level)
+        items = list(self.config_items(EP, self.load_configuration()))
+        await asyncio.gather(*[self.fetch_json('PATCH', url if config_id is None else url + '/{}'.format(config_id), json=config)
+                               for config_id, config in items])
+        print("Patch complete!")
+
+    async def delete_configuration(self, EP):
+        url = self.site_url(EP)
+        data = self.load_configuration()
+        await asyncio.gather(*[self.delete_item(url + "/" + config['id']) for config in data['data']])
+        print("Delete complete!")
+
+    async def delete_item(self, url):
+        # delete responses have no body
+        executor = self.get_executor()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(executor, functools.partial(self.api_request, 'DELETE', url))
+
+
 if __name__ == '__main__':
     TAGLIST = ('SQLI', 'XSS', 'CMDEXE', 'TRAVERSAL', 'USERAGENT', 'BACKDOOR', 'SCANNER', 'RESPONSESPLIT', 'CODEINJECTION',
                'HTTP4XX', 'HTTP403', 'HTTP404', 'HTTP5XX', 'HTTP500', 'HTTP503', 'SANS', 'DATACENTER', 'TORNODE', 'NOUA',
@@ -1705,7 +4747,7 @@ if __name__ == '__main__':
     parser.add_argument('--field', help='Specify fields to return (default: data).', type=str, default='data', choices=['all', 'totalCount', 'next', 'data'])
     parser.add_argument('--file', help='Output results to the specified file.', type=str, default=None)
     parser.add_argument('--list', help='List all supported tags', default=False, action='store_true')
-    parser.add_argument('--format', help='Specify output format (default: json).', type=str, default='json', choices=['json', 'csv'])
+    parser.add_argument('--format', help='Specify output format (default: json).', type=str, default='json', choices=['json', 'csv', 'ndjson', 'parquet'])
     parser.add_argument('--pretty', help='Pretty print the JSON ourput.', default=False, action='store_true')
     parser.add_argument('--sort', help='Specify sort order (default: asc).', type=str, default='asc', choices=['desc', 'asc'])
     parser.add_argument('--agents', help='Retrieve agent metrics.', default=False, action='store_true')
@@ -1744,6 +4786,33 @@ if __name__ == '__main__':
     parser.add_argument('--integrations', help='Retrieve integrations.', default=False, action='store_true')
     parser.add_argument('--headerlinks', help='Retrieve headerlinks.', default=False, action='store_true')
     parser.add_argument('--health', help='Retrieve health check data.', default=False, action='store_true')
+    parser.add_argument('--pool-size', help='Number of pooled keep-alive connections (default: 10).', type=int, default=None)
+    parser.add_argument('--connect-timeout', help='Connect timeout in seconds (default: 10).', type=float, default=None)
+    parser.add_argument('--read-timeout', help='Read timeout in seconds (default: 60).', type=float, default=None)
+    parser.add_argument('--sites', help='Export the feed (--feed2) of these sites concurrently.', nargs='*', default=None)
+    parser.add_argument('--all-sites', help='Export the feed (--feed2) of every site in the corp concurrently.', default=False, action='store_true')
+    parser.add_argument('--site-workers', help='Sites fetched at once with --sites/--all-sites or --poll-sites (default: 4).', type=int, default=None)
+    parser.add_argument('--prefetch', help='Feed pages downloaded ahead while the current page is written (default: 1, 0 disables).', type=int, default=None)
+    parser.add_argument('--stream', help='Decode API pages record by record as they arrive.', default=False, action='store_true')
+    parser.add_argument('--json-backend', help='JSON library for decoding and encoding (default: fastest installed).', type=str, default=None, choices=JSONCodec.BACKENDS)
+    parser.add_argument('--compact', help='Write compact JSON (no spaces, UTF-8), encoded by the fastest JSON library. Without it output is always encoded by the standard json module.', default=False, action='store_true')
+    parser.add_argument('--parallel', help='Fetch a search time range as this many concurrent sub-windows (default: 1).', type=int, default=None)
+    parser.add_argument('--rate-limit', help='Client-side rate limits as [corp:]class=requests_per_second[/burst], class is one of search, feed, config, default. The rate must be above 0, none removes a limit.', nargs='*', default=None)
+    parser.add_argument('--token-cache', help='Cache the login token in this directory between runs (default: ~/.cache/sigsci).', nargs='?', const=os.path.join(os.path.expanduser('~'), '.cache', 'sigsci'), default=None, metavar='DIR')
+    parser.add_argument('--max-retries', help='Retries for failed or throttled API calls (default: 5).', type=int, default=None)
+    parser.add_argument('--fields', help='Comma separated fields to output, as dotted paths with * for every list item (e.g. id,timestamp,tags.*.type).', type=str, default=None)
+    parser.add_argument('--compress', help='Compress the output file.', type=str, default=None, choices=['gzip', 'zstd'])
+    parser.add_argument('--rotate-size', help='Start a new output file after this many bytes of output, counted before compression.', type=int, default=None)
+    parser.add_argument('--rotate-interval', help='One output file per this many seconds of request time (3600 for hourly files).', type=int, default=None)
+    parser.add_argument('--output', help='Also write output to DEST: a file, - for stdout, tcp://host:port, udp://host:port or sqlite:///path.db. Can be repeated.', action='append', default=None, metavar='DEST')
+    parser.add_argument('--forward-spill', help='File keeping records for tcp:// collectors that are down, resent once they are back.', type=str, default=None, metavar='FILE')
+    parser.add_argument('--writer-queue', help='Write output on a background thread with up to this many pages queued (default: 0, off).', type=int, default=None)
+    parser.add_argument('--checkpoint', help='Cursor file of --poll-requests or --poll-events, saved after every window and resumed from on restart.', type=str, default=None, metavar='FILE')
+    parser.add_argument('--incremental', help='With --poll-events, fetch only events detected after the newest one seen.', default=False, action='store_true')
+    parser.add_argument('--poll-sites', help='Poll the sites of the [poll:<site>] sections of the --config file in one process.', default=False, action='store_true')
+    parser.add_argument('--poll-status', help='File the lag, interval and window of a poller are written to (as json) after every window.', type=str, default=None, metavar='FILE')
+    parser.add_argument('--offline', help='Run the search over local archives, Parquet files, sqlite:// stores or directories instead of the API.', nargs='+', default=None, metavar='SOURCE')
+    parser.add_argument('--offline-workers', help='Processes scanning --offline sources (default: one per CPU).', type=int, default=None)
     parser.add_argument('--version', help='Display version.', default=False, action='store_true')
 
     arguments = parser.parse_args()
@@ -1758,6 +4827,8 @@ if __name__ == '__main__':
 
     # create SigSciAPI object
     sigsci = SigSciAPI()
+    # buffered output reaches the file however the run ends
+    atexit.register(sigsci.close)
 
     if arguments.version:
         print('v{}'.format(sigsci.agent_version))
@@ -1824,6 +4895,9 @@ if __name__ == '__main__':
     sigsci.integrations = os.environ.get("SIGSCI_INTEGRATIONS") if os.environ.get('SIGSCI_INTEGRATIONS') is not None else INTEGRATIONS
     sigsci.headerlinks = os.environ.get("SIGSCI_HEADERLINKS") if os.environ.get('SIGSCI_HEADERLINKS') is not None else HEADERLINKS
     sigsci.health = os.environ.get("SIGSCI_HEALTH") if os.environ.get('SIGSCI_HEALTH') is not None else HEALTH
+    sigsci.pool_size = int(os.environ.get("SIGSCI_POOL_SIZE")) if os.environ.get('SIGSCI_POOL_SIZE') is not None else POOL_SIZE or sigsci.pool_size
+    sigsci.connect_timeout = float(os.environ.get("SIGSCI_CONNECT_TIMEOUT")) if os.environ.get('SIGSCI_CONNECT_TIMEOUT') is not None else CONNECT_TIMEOUT or sigsci.connect_timeout
+    sigsci.read_timeout = float(os.environ.get("SIGSCI_READ_TIMEOUT")) if os.environ.get('SIGSCI_READ_TIMEOUT') is not None else READ_TIMEOUT or sigsci.read_timeout
 
     # if command line arguments exist then override any previously set values.
     # note: there is no command line argument for EMAIL, PASSWORD, CORP, or SITE.
@@ -1876,6 +4950,55 @@ if __name__ == '__main__':
     sigsci.integrations = arguments.integrations if arguments.integrations is not None else sigsci.integrations
     sigsci.headerlinks = arguments.headerlinks if arguments.headerlinks is not None else sigsci.headerlinks
     sigsci.health = arguments.health if arguments.health is not None else sigsci.health
+    sigsci.pool_size = arguments.pool_size if arguments.pool_size is not None else sigsci.pool_size
+    sigsci.connect_timeout = arguments.connect_timeout if arguments.connect_timeout is not None else sigsci.connect_timeout
+    sigsci.read_timeout = arguments.read_timeout if arguments.read_timeout is not None else sigsci.read_timeout
+    sigsci.site_workers = arguments.site_workers if arguments.site_workers is not None else sigsci.site_workers
+    sigsci.prefetch = arguments.prefetch if arguments.prefetch is not None else sigsci.prefetch
+    sigsci.stream = arguments.stream or sigsci.stream
+    sigsci.codec = JSONCodec(arguments.json_backend, arguments.compact)
+    sigsci.parallel = arguments.parallel if arguments.parallel is not None else sigsci.parallel
+    sigsci.token_cache = arguments.token_cache if arguments.token_cache is not None else sigsci.token_cache
+    sigsci.retry.max_retries = arguments.max_retries if arguments.max_retries is not None else sigsci.retry.max_retries
+    sigsci.fields = FieldProjection(arguments.fields) if arguments.fields is not None else sigsci.fields
+    sigsci.compress = arguments.compress if arguments.compress is not None else sigsci.compress
+    sigsci.outputs = arguments.output if arguments.output is not None else sigsci.outputs
+    sigsci.writer_queue_size = arguments.writer_queue if arguments.writer_queue is not None else sigsci.writer_queue_size
+    sigsci.forward_spill = arguments.forward_spill if arguments.forward_spill is not None else sigsci.forward_spill
+    sigsci.rotate_size = arguments.rotate_size if arguments.rotate_size is not None else sigsci.rotate_size
+    sigsci.rotate_interval = arguments.rotate_interval if arguments.rotate_interval is not None else sigsci.rotate_interval
+    sigsci.offline_workers = arguments.offline_workers if arguments.offline_workers is not None else sigsci.offline_workers
+    sigsci.checkpoint = arguments.checkpoint if arguments.checkpoint is not None else sigsci.checkpoint
+    sigsci.poll_status = arguments.poll_status if arguments.poll_status is not None else sigsci.poll_status
+    sigsci.events_incremental = arguments.incremental or sigsci.events_incremental
+
+    if (sigsci.compress or sigsci.rotate_size or sigsci.rotate_interval) and not sigsci.file:
+        sys.exit('--compress, --rotate-size and --rotate-interval require --file.')
+
+    if sigsci.format == 'parquet' and not sigsci.file:
+        sys.exit('--format parquet requires --file.')
+
+    if sigsci.format == 'parquet' and pyarrow is None:
+        sys.exit('--format parquet requires the pyarrow package.')
+
+    if (sigsci.rotate_size or sigsci.rotate_interval) and sigsci.format in ('json', 'parquet'):
+        # a json array cannot be split across files
+        sys.exit('Rotated output requires --format ndjson or csv.')
+
+    if any(str(dest).startswith(('tcp://', 'udp://')) for dest in [sigsci.file] + (sigsci.outputs or [])) and sigsci.format not in ('ndjson', 'csv'):
+        # collectors take one message per record
+        sys.exit('Forwarding to a collector requires --format ndjson or csv.')
+
+    if sigsci.compress == 'zstd' and zstandard is None:
+        sys.exit('zstd compression requires the zstandard package.')
+
+    # offline search needs no credentials
+    if arguments.offline is not None:
+        sigsci.parse_init_time()
+        sigsci.query_offline(arguments.offline)
+        sys.exit()
+
+    poll_targets = []
 
     # if using configuration file
     if arguments.config is not None:
@@ -1890,8 +5013,26 @@ if __name__ == '__main__':
             sigsci.pword = agent_config_file.get('sigsci', 'password')
         if agent_config_file.has_option('sigsci', 'api-token'):
             sigsci.api_token = agent_config_file.get('sigsci', 'api-token')
+        if agent_config_file.has_option('sigsci', 'token-cache') and sigsci.token_cache is None:
+            sigsci.token_cache = os.path.expanduser(agent_config_file.get('sigsci', 'token-cache'))
         sigsci.corp = agent_config_file.get('sigsci', 'corp')
-        sigsci.site = agent_config_file.get('sigsci', 'site')
+        if agent_config_file.has_option('sigsci', 'site'):
+            sigsci.site = agent_config_file.get('sigsci', 'site')
+        poll_targets = sigsci.poll_targets(agent_config_file)
+
+    if arguments.poll_sites and not poll_targets:
+        sys.exit('--poll-sites requires a --config file with [poll:<site>] sections.')
+
+    if (sigsci.checkpoint or any(target.get('checkpoint') for target in poll_targets)) and (sigsci.compress or sigsci.rotate_size or sigsci.rotate_interval or sigsci.format == 'parquet'):
+        # the cursor may only move on once the records are on disk
+        sys.exit('--checkpoint cannot be used with archived or Parquet output, which is only complete once the file is closed.')
+
+    if arguments.rate_limit is not None:
+        for spec in arguments.rate_limit:
+            try:
+                sigsci.rate_limiter.configure(spec)
+            except ValueError as e:
+                sys.exit('Invalid --rate-limit %s: %s' % (spec, e))
 
     # authenticate before doing anything.
     if sigsci.authenticate():
@@ -1910,10 +5051,26 @@ if __name__ == '__main__':
             # get feed
             sigsci.get_feed_requests()
 
+        elif sigsci.feed2 and (arguments.all_sites or arguments.sites):
+            # get feed v2 for several sites
+            try:
+                sigsci.get_multi_site_feed(None if arguments.all_sites else arguments.sites)
+            except Exception as e:
+                print('Error: %s ' % str(e))
+                sys.exit()
+
         elif sigsci.feed2:
             # get feed v2
             sigsci.get_feed_requests2()
 
+        elif arguments.poll_sites:
+            # poll every configured site in one process
+            try:
+                sigsci.poll_sites(poll_targets)
+            except Exception as e:
+                print('Error: %s ' % str(e))
+                sys.exit()
+
         elif sigsci.poll_requests:
             # get continuously updating feed
             sigsci.poll_req_continuously()
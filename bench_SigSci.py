@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Records/sec of each installed JSON backend for decoding and encoding
+feed records, the per-record work done by the feed exports.
+
+    python bench_SigSci.py [records]
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+try:
+    from SigSciApiPy.SigSci import JSONCodec
+except ImportError:
+    from SigSci import JSONCodec
+
+
+def feed_record(i):
+    return {
+        'id': '5e6d1b2c3a4f5e0001%06d' % i,
+        'serverHostname': 'web-%d.example.com' % (i % 16),
+        'remoteIP': '203.0.113.%d' % (i % 254),
+        'remoteHostname': '',
+        'remoteCountryCode': 'US',
+        'userAgent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)',
+        'timestamp': '2020-03-14T15:%02d:%02dZ' % (i // 60 % 60, i % 60),
+        'method': 'GET',
+        'serverName': 'www.example.com',
+        'protocol': 'HTTP/1.1',
+        'path': '/search/café',
+        'uri': '/search/café?q=%27+or+1%3D1--',
+        'responseCode': 200,
+        'responseSize': 5120 + i,
+        'responseMillis': 12,
+        'agentResponseCode': 406,
+        'tags': [{'type': 'SQLI', 'location': 'QUERYSTRING', 'value': "' or 1=1--", 'detector': 'SQLiDetector', 'redacted': False}],
+        'headersIn': [['Host', 'www.example.com'], ['Accept', '*/*'], ['Accept-Encoding', 'gzip, deflate'], ['Cookie', 'session=abc123']],
+        'headersOut': [['Content-Type', 'text/html; charset=utf-8'], ['Cache-Control', 'no-cache']],
+    }
+
+
+def rate(func, items):
+    start = time.time()
+
+    for item in items:
+        func(item)
+
+    return len(items) / (time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    records = [feed_record(i) for i in range(count)]
+    reference = JSONCodec('json', compact=True)
+    encoded = [reference.dumps(record) for record in records]
+
+    print('%-8s %14s %14s %16s' % ('backend', 'loads rec/s', 'dumps rec/s', 'compact rec/s'))
+
+    for backend in JSONCodec.available():
+        codec = JSONCodec(backend)
+        compact = JSONCodec(backend, compact=True)
+
+        # float-free records encode the same whatever the backend
+        assert [compact.dumps(record) for record in records[:100]] == encoded[:100]
+
+        print('%-8s %14.0f %14.0f %16.0f' % (backend, rate(codec.loads, encoded), rate(codec.dumps, records), rate(compact.dumps, records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,33 @@
 from __future__ import print_function
 from builtins import str
+import asyncio
+import calendar
+import datetime
+import gzip
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
 import unittest
 import mock
+from configparser import ConfigParser
 
-from SigSciApiPy.SigSci import SigSciAPI
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from SigSciApiPy.SigSci import background_iter, SigSciAPI, AsyncSigSciAPI, RateLimiter, JSONArrayStream, JSONCodec, FieldProjection, FanoutSink, ForwarderSink, OfflineQuery, SeenIds, OutputSink, ArchiveSink, FeedCursor
 
 
 def mocked_requests_get(*args, **kwargs):
@@ -33,11 +57,18 @@ def mocked_requests_post(*args, **kwargs):
     return MockResponse({"token": "testtoken"}, 200)
 
 
+def mocked_session_request(method, url, **kwargs):
+    if method == 'POST':
+        return mocked_requests_post(url, **kwargs)
+
+    return mocked_requests_get(url, **kwargs)
+
+
 class TestSigSciAPI(unittest.TestCase):
 
-    @mock.patch("requests.get", side_effect=mocked_requests_get)
-    @mock.patch("requests.post", side_effect=mocked_requests_post)
-    def test_fetch(self, mock_get, mock_post):
+    @mock.patch("requests.Session.request", side_effect=mocked_session_request)
+    @mock.patch("requests.Session.post", side_effect=mocked_requests_post)
+    def test_fetch(self, mock_post, mock_request):
         # Assert requests.get calls
         sigsci = SigSciAPI()
         sigsci.email = "testemail"
@@ -48,6 +79,1242 @@ class TestSigSciAPI(unittest.TestCase):
         sigsci.get_feed_requests()
         sigsci.get_list_events()
 
+    @mock.patch("requests.Session.request", side_effect=mocked_session_request)
+    def test_session_reused(self, mock_request):
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.connect_timeout = 5
+        sigsci.read_timeout = 30
+        sigsci.authenticate()
+        session = sigsci.get_session()
+        sigsci.get_feed_requests()
+        sigsci.get_list_events()
+        self.assertIs(sigsci.get_session(), session)
+        self.assertEqual(mock_request.call_count, 2)
+        for call in mock_request.call_args_list:
+            self.assertEqual(call[1]['timeout'], (5, 30))
+
+        # a pool raised for more threads is remounted on the same session
+        self.assertEqual(session.get_adapter('https://example.com')._pool_maxsize, 10)
+        sigsci.pool_size = 25
+        self.assertIs(sigsci.get_session(), session)
+        self.assertEqual(session.get_adapter('https://example.com')._pool_maxsize, 25)
+
+    @mock.patch("requests.Session.request")
+    def test_async_feed_sites(self, mock_request):
+        def feed_page(method, url, **kwargs):
+            response = mock.Mock(status_code=200)
+            site = url.split('/sites/')[1].split('/')[0]
+            response.text = json.dumps({"next": {"uri": ""}, "data": [{"id": site}]})
+            return response
+
+        mock_request.side_effect = feed_page
+        sigsci = AsyncSigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.authenticate()
+
+        async def export():
+            await asyncio.gather(*[sigsci.for_site(site).get_feed_requests2() for site in ['site1', 'site2']])
+
+        with mock.patch.object(AsyncSigSciAPI, 'output_results') as output:
+            asyncio.run(export())
+
+        sigsci.close()
+        self.assertEqual(sorted(c[0][0]['id'] for c in output.call_args_list), ['site1', 'site2'])
+
+    @mock.patch("time.sleep")
+    @mock.patch("requests.Session.request")
+    def test_retry_throttled(self, mock_request, mock_sleep):
+        throttled = mock.Mock(status_code=429, headers={'Retry-After': '7'})
+        ok = mock.Mock(status_code=200, headers={}, text='{"data": []}')
+        mock_request.side_effect = [throttled, ok]
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.authenticate()
+        self.assertEqual(sigsci.request_json('GET', 'https://example.com/'), {"data": []})
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 7)
+
+        # a POST that may have been processed is not resent
+        mock_request.reset_mock()
+        mock_request.side_effect = [mock.Mock(status_code=500, headers={})]
+        self.assertEqual(sigsci.api_request('POST', 'https://example.com/').status_code, 500)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @mock.patch("time.sleep")
+    def test_rate_limiter(self, mock_sleep):
+        limiter = RateLimiter()
+        limiter.configure('feed=10/1')
+        limiter.configure('testcorp:feed=1/1')
+        self.assertEqual(limiter.acquire('othercorp', 'feed'), 0)
+        self.assertAlmostEqual(limiter.acquire('othercorp', 'feed'), 0.1, places=2)
+        self.assertAlmostEqual(limiter.acquire('othercorp', 'feed'), 0.2, places=2)
+        self.assertEqual(limiter.acquire('testcorp', 'feed'), 0)
+        self.assertAlmostEqual(limiter.acquire('testcorp', 'feed'), 1, places=2)
+        self.assertEqual(limiter.acquire('testcorp', 'search'), 0)
+
+        # a rate of 0 is refused, none means no limit
+        self.assertRaises(ValueError, limiter.configure, 'feed=0')
+        self.assertRaises(ValueError, limiter.configure, 'feed=5/0')
+        limiter.configure('feed=none')
+        self.assertEqual(limiter.acquire('othercorp', 'feed'), 0)
+        self.assertEqual(limiter.acquire('othercorp', 'feed'), 0)
+
+        sigsci = SigSciAPI()
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        self.assertEqual(sigsci.endpoint_class('GET', sigsci.feed_url()), 'feed')
+        self.assertEqual(sigsci.endpoint_class('GET', sigsci.search_url()), 'search')
+        self.assertEqual(sigsci.endpoint_class('GET', sigsci.timeseries_url(['SQLI'])), 'default')
+        self.assertEqual(sigsci.endpoint_class('POST', sigsci.site_url(sigsci.WHITELIST_EP)), 'config')
+
+    @mock.patch("requests.Session.request")
+    def test_parallel_query_order(self, mock_request):
+        start = calendar.timegm(datetime.datetime(2020, 1, 1).utctimetuple())
+        epochs = [start + i * 600 for i in range(200)]
+
+        def search_page(method, url, **kwargs):
+            # the fake API treats from and until as inclusive
+            query = dict(p.split(':', 1) for p in url.split('?q=')[1].split('&')[0].split(' '))
+            data = [{"id": "id%d" % e, "timestamp": datetime.datetime.utcfromtimestamp(e).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                    for e in epochs if int(query['from']) <= e <= int(query['until'])]
+            return mock.Mock(status_code=200, text=json.dumps({"data": data}))
+
+        mock_request.side_effect = search_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = epochs[0]
+        sigsci.until_time = epochs[-1]
+        sigsci.parallel = 4
+        sigsci.authenticate()
+
+        with mock.patch.object(SigSciAPI, 'output_search_record') as output:
+            sigsci.query_api()
+
+        self.assertEqual([c[0][0]['id'] for c in output.call_args_list], ["id%d" % e for e in epochs])
+        self.assertEqual(mock_request.call_count, 4)
+
+    def test_parallel_query_bounded(self):
+        started = []
+        spools = []
+        release = threading.Event()
+
+        def spool_window(window, stop):
+            started.append(window)
+
+            if window[0] == 3:
+                release.wait(5)
+
+            spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+            spool.write(json.dumps({"id": "id%d" % window[0], "timestamp": datetime.datetime.utcfromtimestamp(window[0] * 60).strftime('%Y-%m-%dT%H:%M:%SZ')}) + '\n')
+            spool.seek(0)
+            spools.append(spool)
+            return spool
+
+        sigsci = SigSciAPI()
+        sigsci.parallel = 2
+
+        with mock.patch.object(sigsci, 'split_search_windows', return_value=[(i, i + 1) for i in range(10)]), \
+                mock.patch.object(sigsci, 'spool_search_window', side_effect=spool_window):
+            # at most parallel + 1 windows ahead of the one being read
+            records = sigsci.iter_parallel_search()
+            self.assertEqual(next(records)['id'], 'id0')
+            time.sleep(0.1)
+            self.assertEqual(len(started), 4)
+
+            # abandoned windows still running close their spool when they finish
+            records.close()
+            release.set()
+
+            for _ in range(50):
+                if len(spools) == 4 and all(spool.closed for spool in spools):
+                    break
+
+                time.sleep(0.01)
+
+            self.assertEqual([spool.closed for spool in spools], [True] * 4)
+            self.assertEqual([r['id'] for r in sigsci.iter_parallel_search()], ['id%d' % i for i in range(10)])
+
+    @mock.patch("requests.Session.request")
+    def test_parallel_query_concurrent(self, mock_request):
+        start = calendar.timegm(datetime.datetime(2020, 1, 1).utctimetuple())
+        epochs = [start + i * 60 for i in range(6000)]
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        requests_done = []
+        all_fetched = threading.Event()
+
+        def search_page(method, url, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+
+            time.sleep(0.05)
+            query = dict(p.split(':', 1) for p in url.split('?q=')[1].split('&')[0].split(' '))
+            data = [{"id": "id%d" % e, "timestamp": datetime.datetime.utcfromtimestamp(e).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                    for e in epochs if int(query['from']) <= e <= int(query['until'])][:1000]
+
+            with lock:
+                in_flight[0] -= 1
+                requests_done.append(url)
+
+                # 4 windows of 2 pages each
+                if len(requests_done) == 8:
+                    all_fetched.set()
+
+            return mock.Mock(status_code=200, text=json.dumps({"data": data}))
+
+        written = []
+
+        def output(record, first):
+            # later windows fetch all their pages while the first is still being written
+            if first:
+                written.append(all_fetched.wait(5))
+
+            written.append(record['id'])
+
+        mock_request.side_effect = search_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = epochs[0]
+        sigsci.until_time = epochs[-1]
+        sigsci.parallel = 4
+        sigsci.authenticate()
+
+        with mock.patch.object(sigsci, 'output_search_record', side_effect=output):
+            sigsci.query_api()
+
+        self.assertEqual(written, [True] + ["id%d" % e for e in epochs])
+        self.assertEqual(in_flight[1], 4)
+        self.assertEqual(mock_request.call_count, 8)
+
+    @mock.patch("requests.Session.request")
+    def test_multi_site_feed(self, mock_request):
+        def api_page(method, url, **kwargs):
+            if url.endswith('/corps/testcorp/sites'):
+                data = {"data": [{"name": "site1"}, {"name": "site2"}]}
+            else:
+                data = {"next": {"uri": ""}, "data": [{"id": "a"}, {"id": "b"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        mock_request.side_effect = api_page
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.file = os.path.join(tmpdir, 'feed_{site}.json')
+        sigsci.authenticate()
+        sigsci.get_multi_site_feed()
+
+        for site in ['site1', 'site2']:
+            with open(os.path.join(tmpdir, 'feed_%s.json' % site)) as f:
+                self.assertEqual(f.read(), '{"id": "a", "siteName": "%s"}{"id": "b", "siteName": "%s"}' % (site, site))
+
+    @mock.patch("requests.Session.request")
+    def test_output_sink(self, mock_request):
+        def feed_page(method, url, **kwargs):
+            if 'page2' in url:
+                data = {"next": {"uri": ""}, "data": [{"id": "b"}]}
+            else:
+                data = {"next": {"uri": "/api/v0/page2"}, "data": [{"id": "a"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        mock_request.side_effect = feed_page
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.file = os.path.join(tmpdir, 'feed.json')
+        sigsci.authenticate()
+
+        with mock.patch('SigSciApiPy.SigSci.OutputSink.flush', autospec=True) as flush:
+            sigsci.get_feed_requests2()
+            sink = sigsci.sink
+            sigsci.get_feed_requests2()
+
+        # opened once for both runs, flushed after every page
+        self.assertIs(sigsci.sink, sink)
+        self.assertEqual(flush.call_count, 4)
+        sigsci.close()
+        self.assertIsNone(sigsci.sink)
+
+        with open(sigsci.file) as f:
+            self.assertEqual(f.read(), '{"id": "a"}{"id": "b"}' * 2)
+
+        # csv rows of later calls are appended, not truncated
+        row = {'timestamp': 't', 'id': 'a', 'remoteIP': 'ip', 'remoteCountryCode': 'US', 'path': '/', 'tags': [{'type': 'SQLI'}], 'responseCode': 200, 'agentResponseCode': 406}
+        sigsci.file = os.path.join(tmpdir, 'feed.csv')
+        sigsci.format = 'csv'
+
+        sigsci.output_results([row])
+        sigsci.output_results([dict(row, id='b')])
+
+        sigsci.close()
+
+        with open(sigsci.file) as f:
+            self.assertEqual([line.split(',')[1] for line in f.read().splitlines()], ['a', 'b'])
+
+    @mock.patch("requests.Session.request")
+    def test_ndjson_output(self, mock_request):
+        def feed_page(method, url, **kwargs):
+            if 'page2' in url:
+                data = {"next": {"uri": ""}, "data": [{"id": "c"}]}
+            else:
+                data = {"next": {"uri": "/api/v0/page2"}, "data": [{"id": "a"}, {"id": "b"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        mock_request.side_effect = feed_page
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.authenticate()
+
+        # whole pages (feed v1) and single records (feed v2) give one line per record
+        sigsci.get_feed_requests()
+        sigsci.get_feed_requests2()
+        sigsci.close()
+
+        with open(sigsci.file) as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], ['a', 'b', 'c'] * 2)
+
+    @mock.patch("requests.Session.request")
+    def test_archive_output(self, mock_request):
+        records = [{"id": "a", "timestamp": "2020-03-14T15:10:00Z"}, {"id": "b", "timestamp": "2020-03-14T15:50:00Z"}, {"id": "c", "timestamp": "2020-03-14T16:05:00Z"}]
+        mock_request.return_value = mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": records}))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.authenticate()
+
+        compressions = ['gzip', 'zstd'] if zstandard is not None else ['gzip']
+
+        for compress in compressions:
+            sigsci.compress = compress
+            sigsci.rotate_interval = 3600
+            sigsci.get_feed_requests2()
+            sigsci.close()
+
+        with open(sigsci.file + '.manifest') as f:
+            manifest = [json.loads(line) for line in f]
+
+        # one finished file per hour of request time, nothing left half written
+        ext = {'gzip': '.gz', 'zstd': '.zst'}
+        names = ['feed-20200314T%s0000Z-0001.ndjson%s' % (hour, ext[compress]) for compress in compressions for hour in ('15', '16')]
+        self.assertEqual([os.path.basename(entry['file']) for entry in manifest], names)
+        self.assertEqual([entry['records'] for entry in manifest], [2, 1] * len(compressions))
+        self.assertEqual(sorted(os.listdir(tmpdir)), sorted(names + ['feed.ndjson.manifest']))
+
+        with gzip.open(manifest[0]['file'], 'rt') as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], ['a', 'b'])
+
+        if zstandard is not None:
+            with open(manifest[3]['file'], 'rb') as f:
+                self.assertEqual(zstandard.ZstdDecompressor().stream_reader(f).read(), b'{"id": "c", "timestamp": "2020-03-14T16:05:00Z"}\n')
+
+    def test_archive_compress_only(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        # every run gets a file of its own
+        for text in ['{"id": "a"}', '{"id": "b"}']:
+            archive = ArchiveSink(os.path.join(tmpdir, 'feed.ndjson'), 'gzip')
+            archive.write_lines([text], [{}])
+            archive.close()
+
+        with open(archive.manifest) as f:
+            manifest = [json.loads(line) for line in f]
+
+        self.assertEqual([os.path.basename(entry['file']) for entry in manifest], ['feed-0001.ndjson.gz', 'feed-0002.ndjson.gz'])
+
+        for entry, text in zip(manifest, ['{"id": "a"}\n', '{"id": "b"}\n']):
+            with gzip.open(entry['file'], 'rt') as f:
+                self.assertEqual(f.read(), text)
+
+    def test_archive_rotate_size(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        archive = ArchiveSink(os.path.join(tmpdir, 'feed.ndjson'), rotate_size=100)
+
+        # 30 characters but 40 bytes per line, files rotate on bytes
+        archive.write_lines(['"%s"' % ('\u00e9' * 10 + 'x' * 17)] * 7, [{}] * 7)
+        archive.close()
+
+        with open(archive.manifest) as f:
+            manifest = [json.loads(line) for line in f]
+
+        self.assertEqual([entry['records'] for entry in manifest], [3, 3, 1])
+        self.assertEqual([entry['bytes'] for entry in manifest], [120, 120, 40])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    @mock.patch("requests.Session.request")
+    def test_parquet_output(self, mock_request):
+        records = [
+            {"id": "a", "timestamp": "2020-03-14T15:10:00Z", "remoteIP": "203.0.113.1", "path": "/login", "responseCode": 200,
+             "tags": [{"type": "SQLI", "location": "QUERYSTRING"}], "headersIn": [["Host", "example.com"]], "extra": "dropped"},
+            {"id": "b", "timestamp": "2020-03-14T15:11:00Z", "remoteIP": "203.0.113.1", "path": "/login", "responseCode": 406, "tags": []},
+        ]
+        mock_request.return_value = mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": records}))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'parquet'
+        sigsci.file = os.path.join(tmpdir, 'feed.parquet')
+        sigsci.authenticate()
+        sigsci.get_feed_requests2()
+        sigsci.close()
+
+        table = pyarrow.parquet.read_table(sigsci.file)
+        self.assertEqual(os.listdir(tmpdir), ['feed.parquet'])
+        self.assertNotIn('extra', table.column_names)
+        self.assertEqual(str(table.schema.field('remoteIP').type), 'dictionary<values=string, indices=int32, ordered=0>')
+        self.assertEqual(table.column('id').to_pylist(), ['a', 'b'])
+        self.assertEqual(table.column('tags').to_pylist(), [['SQLI'], []])
+        self.assertEqual(table.column('headersIn').to_pylist(), [[('Host', 'example.com')], None])
+        self.assertEqual(table.column('responseCode').to_pylist(), [200, 406])
+
+    def test_field_projection(self):
+        record = {"id": "a", "remoteIP": "203.0.113.1", "tags": [{"type": "SQLI", "value": "x"}, {"type": "XSS", "value": "y"}],
+                  "headersIn": [["Host", "example.com"], ["Accept", "*/*"]], "headersOut": []}
+        projection = FieldProjection('remoteIP, id,tags.*.type,headersIn.*.0,missing.field')
+
+        self.assertEqual(projection.project(record), {"remoteIP": "203.0.113.1", "id": "a", "tags": [{"type": "SQLI"}, {"type": "XSS"}], "headersIn": [["Host"], ["Accept"]]})
+        self.assertEqual(projection.values(record), ["203.0.113.1", "a", "SQLI|XSS", "Host|Accept", ""])
+
+        # a whole field wins over paths inside it
+        self.assertEqual(FieldProjection(['tags.*.type', 'tags']).project(record)['tags'], record['tags'])
+
+    @mock.patch("requests.Session.request")
+    def test_feed_fields(self, mock_request):
+        records = [{"id": "a", "remoteIP": "203.0.113.1", "tags": [{"type": "SQLI"}], "headersIn": [["Host", "example.com"]]}]
+        mock_request.return_value = mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": records}))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.fields = 'id,tags.*.type'
+        sigsci.authenticate()
+
+        for fmt in ['ndjson', 'csv']:
+            sigsci.format = fmt
+            sigsci.file = os.path.join(tmpdir, 'feed.' + fmt)
+            sigsci.get_feed_requests2()
+
+        sigsci.close()
+
+        with open(os.path.join(tmpdir, 'feed.ndjson')) as f:
+            self.assertEqual(f.read(), '{"id": "a", "tags": [{"type": "SQLI"}]}\n')
+
+        with open(os.path.join(tmpdir, 'feed.csv'), newline='') as f:
+            self.assertEqual(f.read(), 'a,SQLI\r\n')
+
+    @mock.patch("requests.Session.request")
+    def test_csv_output(self, mock_request):
+        request = {"timestamp": "2020-03-14T15:10:00Z", "id": "a", "remoteIP": "203.0.113.1", "remoteCountryCode": "DE", "path": "/caf\u00e9,\"x\"",
+                   "tags": [{"type": "SQLI"}, {"type": "XSS"}], "responseCode": 200, "agentResponseCode": None, "headersIn": [["Host", "example.com"], ["Accept", "*/*"]]}
+        event = {"timestamp": "2020-03-14T15:00:00Z", "id": "e", "source": "203.0.113.1", "remoteHostname": "", "remoteCountryCode": "DE", "action": "flagged",
+                 "type": "attack", "reasons": {"SQLI": 12, "XSS": 3}, "tagCount": 15, "window": 60, "detectedTimestamp": "2020-03-14T15:01:00Z", "expires": "2020-03-15T15:01:00Z"}
+        mock_request.return_value = mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": [request]}))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'csv'
+        sigsci.file = os.path.join(tmpdir, 'feed.csv')
+        sigsci.authenticate()
+
+        # feed v2 writes single records, events come as an API page
+        sigsci.get_feed_requests2()
+        sigsci.output_results({"totalCount": 1, "data": [event]})
+        sigsci.fields = 'id,headersIn,headersIn.host'
+        sigsci.output_results(request)
+        sigsci.close()
+
+        with open(sigsci.file, newline='', encoding='utf-8') as f:
+            self.assertEqual(f.read().split('\r\n'), [
+                '2020-03-14T15:10:00Z,a,203.0.113.1,DE,"/caf\u00e9,""x""",SQLI|XSS,200,',
+                '2020-03-14T15:00:00Z,e,203.0.113.1,,DE,flagged,attack,SQLI|XSS,15,60,2020-03-14T15:01:00Z,2020-03-15T15:01:00Z',
+                'a,Host: example.com|Accept: */*,example.com',
+                '',
+            ])
+
+    @mock.patch("requests.Session.request")
+    def test_writer_fanout(self, mock_request):
+        def feed_page(method, url, **kwargs):
+            if 'page2' in url:
+                data = {"next": {"uri": ""}, "data": [{"id": "c"}]}
+            else:
+                data = {"next": {"uri": "/api/v0/page2"}, "data": [{"id": "a"}, {"id": "b"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        mock_request.side_effect = feed_page
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        received = []
+
+        def receive():
+            conn, _ = listener.accept()
+
+            with conn, conn.makefile('r') as f:
+                received.extend(f)
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.outputs = [os.path.join(tmpdir, 'copy.ndjson'), 'tcp://127.0.0.1:%d' % listener.getsockname()[1]]
+        sigsci.writer_queue_size = 2
+        sigsci.authenticate()
+        sigsci.get_feed_requests2()
+        sigsci.close()
+        receiver.join(5)
+
+        lines = ['{"id": "a"}\n', '{"id": "b"}\n', '{"id": "c"}\n']
+        self.assertEqual(received, lines)
+
+        for name in ['feed.ndjson', 'copy.ndjson']:
+            with open(os.path.join(tmpdir, name)) as f:
+                self.assertEqual(f.readlines(), lines)
+
+    def test_writer_sync(self):
+        release = threading.Event()
+        written = []
+        sink = mock.Mock(path=None)
+        sink.write_record.side_effect = lambda text, record: release.wait(5) and written.append(text)
+        sink.sync.side_effect = lambda: written.append('synced')
+        writer = FanoutSink([sink], queue_size=4)
+        threading.Timer(0.2, release.set).start()
+
+        for text in ['a', 'b', 'c']:
+            writer.write_record(text)
+
+        # the barrier waits for the writer thread
+        writer.sync()
+        self.assertEqual(written, ['a', 'b', 'c', 'synced'])
+        writer.close()
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        archive = ArchiveSink(os.path.join(tmpdir, 'feed.ndjson'), 'gzip')
+        self.assertRaises(ValueError, archive.sync)
+        archive.close()
+
+    def test_writer_close_after_error(self):
+        failing = mock.Mock(path=None)
+        failing.write_record.side_effect = IOError('disk full')
+        other = mock.Mock(path=None)
+        writer = FanoutSink([failing, other], queue_size=1, batch_size=1)
+        writer.write_record('a')
+
+        # the writer thread stops and every sink is closed before the error is raised
+        self.assertRaises(IOError, writer.close)
+        self.assertIsNone(writer.thread)
+        self.assertEqual(failing.close.call_count, 1)
+        self.assertEqual(other.close.call_count, 1)
+
+    def test_writer_backpressure(self):
+        release = threading.Event()
+        written = []
+        sink = mock.Mock(path=None)
+        sink.write_record.side_effect = lambda text, record: release.wait(5) and written.append(text)
+        writer = FanoutSink([sink], queue_size=1, batch_size=1)
+        threading.Timer(0.2, release.set).start()
+
+        # the writer holds one call and the queue another, the third has to wait
+        for text in ['a', 'b', 'c']:
+            writer.write_record(text)
+
+        writer.close()
+        self.assertEqual(written, ['a', 'b', 'c'])
+        self.assertEqual(writer.stats()['max_depth'], 1)
+        self.assertGreater(writer.stats()['stalled'], 0.05)
+
+    def test_forwarder_reconnect(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        spill = os.path.join(tmpdir, 'spill')
+        forwarder = ForwarderSink('tcp://127.0.0.1:%d?format=rfc5424' % port, spill=spill)
+
+        # collector down, the batch is spilled to disk
+        forwarder.write_lines(['{"id": "a"}'], [{"id": "a", "timestamp": "2020-03-14T15:10:00Z"}])
+        forwarder.flush()
+        self.assertTrue(os.path.getsize(spill) > 0)
+
+        with mock.patch('os.fsync') as fsync:
+            forwarder.sync()
+
+        self.assertEqual(fsync.call_count, 1)
+
+        # without a spill file the records are only in memory, a checkpoint must not pass them
+        unspilled = ForwarderSink('tcp://127.0.0.1:%d' % port)
+        unspilled.write_lines(['{"id": "a"}'], [{"id": "a"}])
+        self.assertRaises(ValueError, unspilled.sync)
+
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', port))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        received = []
+
+        def receive():
+            conn, _ = listener.accept()
+
+            with conn:
+                received.append(b''.join(iter(lambda: conn.recv(65536), b'')))
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        forwarder.retry_at = 0
+        forwarder.write_record('{"id": "b"}\n', {"id": "b", "timestamp": "2020-03-14T15:11:00Z"})
+        forwarder.close()
+        receiver.join(5)
+        self.assertFalse(os.path.exists(spill))
+
+        # octet counted syslog messages, spilled ones first
+        data, messages = received[0], []
+
+        while data:
+            length, _, data = data.partition(b' ')
+            messages.append(data[:int(length)].decode('utf-8'))
+            data = data[int(length):]
+
+        self.assertEqual([m.split(' ', 7)[1:3] + m.split(' ', 7)[5:] for m in messages], [
+            ['2020-03-14T15:10:00Z', socket.gethostname(), 'request', '-', '{"id": "a"}'],
+            ['2020-03-14T15:11:00Z', socket.gethostname(), 'request', '-', '{"id": "b"}'],
+        ])
+        self.assertTrue(messages[0].startswith('<134>1 '))
+
+    def test_forwarder_cef(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        self.addCleanup(listener.close)
+        forwarder = ForwarderSink('udp://127.0.0.1:%d?format=cef' % listener.getsockname()[1], version='1.0')
+        record = {"id": "a", "timestamp": "2020-03-14T15:10:00Z", "remoteIP": "203.0.113.1", "uri": "/login?a=b", "agentResponseCode": 406, "tags": [{"type": "SQLI"}]}
+        forwarder.writerow(['a', '203.0.113.1'], record)
+        forwarder.close()
+
+        self.assertEqual(listener.recv(65536).decode('utf-8'),
+                         'CEF:0|Signal Sciences|SigSciApiPy|1.0|SQLI|request SQLI|7|rt=1584198600000 externalId=a src=203.0.113.1 request=/login?a\\=b cs1Label=signals cs1=SQLI')
+
+    @mock.patch("requests.Session.request")
+    def test_sqlite_store(self, mock_request):
+        pages = [
+            [{"id": "a", "timestamp": "2020-03-14T15:10:00Z", "remoteIP": "203.0.113.1", "path": "/login", "responseCode": 200, "tags": [{"type": "SQLI"}, {"type": "XSS"}]}],
+            [{"id": "a", "timestamp": "2020-03-14T15:10:00Z", "remoteIP": "203.0.113.1", "path": "/login", "responseCode": 406, "tags": [{"type": "SQLI"}]},
+             {"id": "b", "timestamp": "2020-03-14T15:11:00Z", "remoteIP": "203.0.113.2", "path": "/", "responseCode": 200, "tags": []}],
+        ]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = os.path.join(tmpdir, 'sigsci.db')
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.from_time = 1
+        sigsci.until_time = 2
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.outputs = ['sqlite://' + db]
+        sigsci.authenticate()
+
+        # overlapping exports leave one row per request, the latest copy
+        for page in pages:
+            mock_request.return_value = mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": page}))
+            sigsci.get_feed_requests2()
+            sigsci.close()
+
+        sigsci.outputs = None
+        sigsci.file = 'sqlite://' + db
+        sigsci.output_results({"data": [{"id": "e", "timestamp": "2020-03-14T15:00:00Z", "source": "203.0.113.1", "reasons": {"SQLI": 12}}]})
+        sigsci.close()
+
+        with sqlite3.connect(db) as conn:
+            self.assertEqual(conn.execute('SELECT id, kind, timestamp, remoteIP, responseCode FROM records ORDER BY id').fetchall(), [
+                ('a', 'request', 1584198600, '203.0.113.1', 406), ('b', 'request', 1584198660, '203.0.113.2', 200), ('e', 'event', 1584198000, '203.0.113.1', None)])
+            self.assertEqual(conn.execute('SELECT tag, id FROM tags ORDER BY tag, id').fetchall(), [('SQLI', 'a'), ('SQLI', 'e')])
+            self.assertEqual(json.loads(conn.execute("SELECT record FROM records WHERE id = 'b'").fetchone()[0])['path'], '/')
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM records WHERE remoteIP = '203.0.113.1'").fetchall()
+            self.assertIn('records_remoteIP', str(plan))
+
+    def test_offline_query(self):
+        def request(i, minute, ip, tags):
+            return {"id": "r%d" % i, "timestamp": "2020-03-14T15:%02d:00Z" % minute, "remoteIP": ip, "serverName": "www.example.com",
+                    "agentResponseCode": 406 if tags else 0, "tags": [{"type": tag} for tag in tags]}
+
+        archived = [request(1, 10, "203.0.113.1", ["SQLI"]), request(2, 20, "203.0.113.2", ["SQLI", "XSS"]), request(3, 30, "203.0.113.1", [])]
+        stored = [request(3, 30, "203.0.113.1", []), request(4, 25, "203.0.113.1", ["SQLI"]), request(5, 50, "203.0.113.1", ["SQLI"])]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sigsci = SigSciAPI()
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'archive', 'feed.ndjson')
+        os.mkdir(os.path.dirname(sigsci.file))
+        sigsci.compress = 'gzip'
+        sigsci.rotate_interval = 1200
+        sigsci.output_results({"data": archived})
+        sigsci.close()
+        db = 'sqlite://' + os.path.join(tmpdir, 'sigsci.db')
+        sigsci = SigSciAPI()
+        sigsci.format = 'ndjson'
+        sigsci.file = db
+        sigsci.output_results({"data": stored})
+        sigsci.close()
+        manifest = os.path.join(tmpdir, 'archive', 'feed.ndjson.manifest')
+        sources = [manifest, db]
+
+        # 15:15 to 15:45, SQLI from 203.0.113.1 without XSS, merged in time order
+        query = OfflineQuery('from:1584198900 until:1584200700 ip:203.0.113.1 tag:SQLI -tag:XSS sort:time-asc')
+        self.assertEqual([r['id'] for r in query.run(sources, workers=1)], ['r4'])
+        query = OfflineQuery('from:1584198000 until:1584201600 -tag:XSS sort:time-desc')
+        self.assertEqual([r['id'] for r in query.run(sources, workers=2)], ['r5', 'r3', 'r4', 'r1'])
+
+        # only the archives overlapping the range are opened
+        self.assertEqual(len(open(manifest).readlines()), 2)
+        self.assertEqual(list(OfflineQuery('from:1584200100 until:1584201600').files([manifest])), [])
+        self.assertRaises(ValueError, OfflineQuery, 'ip:203.0.113.1 path:/login')
+
+        # the search options select the records, output as for the API
+        sigsci = SigSciAPI()
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'out.ndjson')
+        sigsci.from_time = 1584198000
+        sigsci.until_time = 1584201600
+        sigsci.tags = ['SQLI']
+        sigsci.offline_workers = 1
+        sigsci.parse_init_time()
+        sigsci.query_offline([os.path.join(tmpdir, 'archive'), db])
+
+        with open(sigsci.file) as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], ['r1', 'r2', 'r4', 'r5'])
+
+        # matches are spooled in sorted chunks and merged, duplicates dropped per second
+        spread = [os.path.join(tmpdir, 'spread%d.ndjson' % n) for n in range(2)]
+
+        for n, path in enumerate(spread):
+            with open(path, 'w') as f:
+                for minute in (59, 7, 33, 12, 48, 21, 3):
+                    f.write(json.dumps(request(minute if minute % 2 else minute + n * 100, minute, "203.0.113.1", [])) + '\n')
+
+        query = OfflineQuery('from:1584198000 until:1584201600')
+        query.chunk_size = 2
+        spool_dir = tempfile.mkdtemp(dir=tmpdir)
+        self.assertEqual(len(query.scan(spread[0], spool_dir)), 4)
+        records = list(query.run(spread, workers=2))
+        self.assertEqual([r['timestamp'][14:16] for r in records], ['03', '07', '12', '12', '21', '33', '48', '48', '59'])
+        self.assertEqual(len(set(r['id'] for r in records)), 9)
+
+        # more spools than are merged at once take several passes
+        query.chunk_size = 1
+        query.merge_fan_in = 3
+        self.assertEqual(list(query.run(spread, workers=1)), records)
+
+        # json arrays and concatenated pages are decoded a record at a time
+        pages = os.path.join(tmpdir, 'pages.json.gz')
+
+        with gzip.open(pages, 'wt') as f:
+            f.write(json.dumps([request(6, 6, "203.0.113.1", [])]) + json.dumps({"data": [request(8, 8, "203.0.113.1", [])]}))
+
+        with open(os.path.join(tmpdir, 'cut.json'), 'w') as f:
+            f.write(json.dumps([request(9, 9, "203.0.113.1", []), request(11, 11, "203.0.113.1", [])])[:-1])
+
+        self.assertEqual([r['id'] for r in query.read_records(pages)], ['r6', 'r8'])
+        self.assertEqual([r['id'] for r in query.read_records(os.path.join(tmpdir, 'cut.json'))], ['r9', 'r11'])
+
+        if pyarrow is not None:
+            sigsci = SigSciAPI()
+            sigsci.format = 'parquet'
+            sigsci.file = os.path.join(tmpdir, 'feed.parquet')
+            sigsci.output_results({"data": archived})
+            sigsci.close()
+            query = OfflineQuery('from:1584198000 until:1584201600 ip:203.0.113.1 tag:SQLI')
+            self.assertEqual([r['id'] for r in query.run([sigsci.file], workers=1)], ['r1'])
+
+    @mock.patch("time.sleep", side_effect=KeyboardInterrupt)
+    @mock.patch("time.time", return_value=1584200000)
+    @mock.patch("requests.Session.request")
+    def test_poll_checkpoint(self, mock_request, mock_time, mock_sleep):
+        def timestamp(epoch):
+            return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+        windows = []
+
+        def feed_page(method, url, **kwargs):
+            params = dict(p.split('=') for p in url.split('?')[1].split('&'))
+            start, until = int(params['from']), int(params['until'])
+            windows.append((start, until))
+            data = [{"id": "m%d" % epoch, "timestamp": timestamp(epoch)} for epoch in range(start, until, 60)]
+            return mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": data}))
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        checkpoint = os.path.join(tmpdir, 'cursor.json')
+
+        # a poller stopped at 14:18 resumes there: 15:33:20 now, 15:28 the newest complete minute
+        with open(checkpoint, 'w') as f:
+            json.dump({"until": 1584195480, "seen": {"1584195420": [SeenIds.fingerprint("m1584195420")]}}, f)
+
+        mock_request.side_effect = feed_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.checkpoint = checkpoint
+        sigsci.writer_queue_size = 2
+        sigsci.authenticate()
+        saved = []
+        write_lines = OutputSink.write_lines
+        save = FeedCursor.save
+
+        def slow_write(sink, lines, records=None):
+            threading.Event().wait(0.01)
+            write_lines(sink, lines, records)
+
+        def save_cursor(cursor, until):
+            # the background writer has put the window on disk before the cursor moves
+            with open(sigsci.file) as f:
+                saved.append((until, len(f.readlines())))
+
+            save(cursor, until)
+
+        with mock.patch.object(OutputSink, 'write_lines', slow_write), mock.patch.object(FeedCursor, 'save', save_cursor):
+            self.assertRaises(KeyboardInterrupt, sigsci.poll_req_continuously)
+
+        sigsci.close()
+        self.assertEqual(saved, [(1584199020, 59), (1584199680, 70)])
+
+        # catches up in an hour window, then the rest, each starting at the previous boundary minute
+        self.assertEqual(windows, [(1584195420, 1584199020), (1584198960, 1584199680)])
+
+        with open(sigsci.file) as f:
+            ids = [json.loads(line)['id'] for line in f]
+
+        self.assertEqual(ids, ['m%d' % epoch for epoch in range(1584195480, 1584199680, 60)])
+
+        with open(checkpoint) as f:
+            cursor = json.load(f)
+
+        self.assertEqual((cursor['until'], cursor['seen']), (1584199680, {'1584199620': [SeenIds.fingerprint('m1584199620')]}))
+
+    @mock.patch("requests.Session.request")
+    def test_poll_events_dedup(self, mock_request):
+        clock = [1584200000]
+        sleeps = []
+        windows = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        # each window overlaps the last minute of the one before, and comes in pages
+        cycles = iter([[["a", "b"]], [["b"], ["c"]], [["a", "c"], ["d"]], [[]]])
+        pages = []
+
+        def events_page(method, url, **kwargs):
+            params = dict(p.split('=') for p in url.split('?')[1].split('&'))
+
+            if 'page' not in params:
+                pages[:] = next(cycles, [])
+
+                if not pages:
+                    raise KeyboardInterrupt
+
+                windows.append((int(params['from']), int(params['until'])))
+
+            ids = pages.pop(0)
+            next_uri = '/api/v0/corps/testcorp/sites/testsite/events?page=2' if pages else ''
+            return mock.Mock(status_code=200, text=json.dumps({"next": {"uri": next_uri}, "data": [{"id": i} for i in ids]}))
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_request.side_effect = events_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.poll_status = os.path.join(tmpdir, 'status.json')
+        sigsci.authenticate()
+
+        with mock.patch("time.time", side_effect=lambda: clock[0]), mock.patch("time.sleep", side_effect=sleep):
+            with mock.patch.object(sigsci, 'output_results') as output:
+                self.assertRaises(KeyboardInterrupt, sigsci.poll_ev_continuously)
+
+        self.assertEqual([c[0][0]['id'] for c in output.call_args_list], ['a', 'b', 'c', 'd'])
+        self.assertEqual(windows, [(1584199560, 1584199680), (1584199620, 1584199740), (1584199680, 1584199800), (1584199740, 1584199860)])
+
+        # waits end on minute boundaries, the fetch time is taken off, twice as long after an idle window
+        self.assertEqual(sleeps, [40, 60, 60, 120])
+
+        with open(sigsci.poll_status) as f:
+            self.assertEqual(json.load(f), {'lag': 0, 'until': 1584199860, 'interval': 120, 'cycles': 4, 'idle': 1})
+
+        seen = SeenIds()
+        self.assertTrue(seen.add('a', 1584195430))
+        self.assertTrue(seen.add('b', 1584195490))
+        self.assertFalse(seen.add('a', 1584195490))
+        seen.expire(1584195480)
+        self.assertEqual(len(seen), 1)
+        self.assertTrue(seen.add('a', 1584195490))
+
+    @mock.patch("requests.Session.request")
+    def test_poll_events_incremental(self, mock_request):
+        clock = [1584200000]
+        queries = []
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        def timestamp(epoch):
+            return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+        # every cycle asks from the newest detection seen, whose event comes again
+        cycles = iter([[("a", 1584199900), ("b", 1584199930)], [("b", 1584199930), ("c", 1584199990)], []])
+
+        def events_page(method, url, **kwargs):
+            params = dict(p.split('=') for p in url.split('?')[1].split('&'))
+            queries.append(params)
+            events = next(cycles, None)
+
+            if events is None:
+                raise KeyboardInterrupt
+
+            # events start before they are detected, the cursor follows detection
+            data = [{"id": i, "timestamp": timestamp(epoch - 600), "detectedTimestamp": timestamp(epoch)} for i, epoch in events]
+            return mock.Mock(status_code=200, text=json.dumps({"next": {"uri": ""}, "data": data}))
+
+        mock_request.side_effect = events_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.events_incremental = True
+        sigsci.authenticate()
+
+        with mock.patch("time.time", side_effect=lambda: clock[0]), mock.patch("time.sleep", side_effect=sleep):
+            with mock.patch.object(sigsci, 'output_results') as output:
+                self.assertRaises(KeyboardInterrupt, sigsci.poll_ev_continuously)
+
+        self.assertEqual([c[0][0]['id'] for c in output.call_args_list], ['a', 'b', 'c'])
+        self.assertEqual([q['from'] for q in queries], ['1584199560', '1584199930', '1584199990', '1584199990'])
+        self.assertFalse(any('until' in q for q in queries))
+
+    @mock.patch("requests.Session.request")
+    def test_list_events_pages(self, mock_request):
+        def events_page(method, url, **kwargs):
+            if 'page=2' in url:
+                data = {"next": {"uri": ""}, "data": [{"id": "c"}]}
+            else:
+                data = {"totalCount": 3, "next": {"uri": "/api/v0/corps/testcorp/sites/testsite/events?page=2"}, "data": [{"id": "a"}, {"id": "b"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        mock_request.side_effect = events_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.authenticate()
+
+        with mock.patch.object(sigsci, 'output_results') as output:
+            sigsci.get_list_events()
+
+        self.assertEqual([[e['id'] for e in c[0][0]['data']] for c in output.call_args_list], [['a', 'b'], ['c']])
+
+        async def list_events():
+            return await api.get_list_events()
+
+        api = AsyncSigSciAPI()
+        api.api_token = "testtoken"
+        api.corp = "testcorp"
+        api.site = "testsite"
+        api.authenticate()
+
+        with mock.patch.object(AsyncSigSciAPI, 'output_results') as output:
+            asyncio.run(list_events())
+
+        api.close()
+        self.assertEqual([[e['id'] for e in c[0][0]['data']] for c in output.call_args_list], [['a', 'b'], ['c']])
+
+    def test_poll_sites(self):
+        config = ConfigParser()
+        config.read_string(u"""
+[sigsci]
+corp = testcorp
+
+[poll:www]
+
+[poll:shop]
+corp = othercorp
+kind = events
+file = {dir}/{{corp}}-{{site}}.ndjson
+checkpoint = {dir}/{{site}}.cursor
+
+[poll:broken]
+""".format(dir='/data'))
+        targets = SigSciAPI.poll_targets(config)
+        self.assertEqual([t['site'] for t in targets], ['www', 'shop', 'broken'])
+        self.assertEqual(targets[1]['file'], '/data/{corp}-{site}.ndjson')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        targets[1]['file'] = os.path.join(tmpdir, '{corp}-{site}.ndjson')
+        targets[1]['checkpoint'] = os.path.join(tmpdir, '{site}.cursor')
+        calls = []
+
+        def window(api, cursor):
+            calls.append(api.site)
+
+            if api.site == 'broken':
+                raise ValueError('site not found')
+
+            if calls.count('www') == 5:
+                raise KeyboardInterrupt
+
+            # far behind, so the next window is due at once
+            api.until_time = 0
+            api.output_results({"site": api.site, "tagged": api.tag_site})
+            return 1
+
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.format = 'ndjson'
+        sigsci.file = os.path.join(tmpdir, 'feed.ndjson')
+        sigsci.site_workers = 2
+        sigsci.authenticate()
+
+        with mock.patch.object(SigSciAPI, 'poll_requests_window', side_effect=window, autospec=True), \
+                mock.patch.object(SigSciAPI, 'poll_events_window', side_effect=window, autospec=True), \
+                mock.patch('sys.stderr') as stderr:
+            self.assertRaises(KeyboardInterrupt, sigsci.poll_sites, targets)
+
+        sigsci.close()
+
+        # the failing site is retried later, the others go on
+        self.assertEqual(calls.count('broken'), 1)
+        self.assertIn('testcorp/broken: site not found', stderr.write.call_args_list[0][0][0])
+        self.assertGreaterEqual(calls.count('shop'), 3)
+
+        # sites sharing an output get a siteName
+        with open(sigsci.file) as f:
+            self.assertEqual(set((r['site'], r['tagged']) for r in map(json.loads, f)), set([('www', True)]))
+
+        with open(os.path.join(tmpdir, 'othercorp-shop.ndjson')) as f:
+            self.assertEqual(set((r['site'], r['tagged']) for r in map(json.loads, f)), set([('shop', False)]))
+
+    @mock.patch("requests.Session.request")
+    def test_feed_prefetch(self, mock_request):
+        second_page_requested = threading.Event()
+
+        def feed_page(method, url, **kwargs):
+            if 'page2' in url:
+                second_page_requested.set()
+                data = {"next": {"uri": ""}, "data": [{"id": "b"}]}
+            else:
+                data = {"next": {"uri": "/api/v0/page2"}, "data": [{"id": "a"}]}
+
+            return mock.Mock(status_code=200, text=json.dumps(data))
+
+        written = []
+
+        def output(record):
+            # the next page is already downloading while this one is written
+            if record['id'] == 'a':
+                written.append(second_page_requested.wait(5))
+
+            written.append(record['id'])
+
+        mock_request.side_effect = feed_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.prefetch = 2
+        sigsci.authenticate()
+
+        with mock.patch.object(sigsci, 'output_results', side_effect=output):
+            sigsci.get_feed_requests2()
+
+        self.assertEqual(written, [True, 'a', 'b'])
+
+    def test_background_iter_errors(self):
+        def produce(error):
+            yield 1
+            raise error
+
+        # the consumer gets every error of the producer thread instead of waiting forever
+        for error in (ValueError('bad page'), KeyboardInterrupt(), SystemExit(2)):
+            items = background_iter(produce(error), 1)
+            self.assertEqual(next(items), 1)
+            self.assertRaises(type(error), next, items)
+
+    def test_json_array_stream(self):
+        page = {"next": {"uri": "/x"}, "data": [{"id": "a", "path": "/caf\u00e9"}, {"id": "b", "n": 12345}, []], "totalCount": 1000}
+        body = json.dumps(page, ensure_ascii=False).encode('utf8')
+        envelope = {}
+        chunks = [body[i:i + 1] for i in range(len(body))]
+        records = list(JSONArrayStream(chunks).iter_array('data', envelope))
+        self.assertEqual(records, page['data'])
+        self.assertEqual(envelope, {"next": {"uri": "/x"}, "totalCount": 1000})
+
+        envelope = {}
+        self.assertEqual(list(JSONArrayStream([b'{"message": "bad"}']).iter_array('data', envelope)), [])
+        self.assertEqual(envelope, {"message": "bad"})
+
+    @mock.patch("requests.Session.request")
+    def test_feed_stream(self, mock_request):
+        def feed_page(method, url, **kwargs):
+            self.assertTrue(kwargs['stream'])
+            body = b'{"data": [{"id": "a"}, {"id": "b"}], "next": {"uri": ""}}'
+            return mock.Mock(status_code=200, iter_content=lambda chunk_size: [body[:10], body[10:]])
+
+        mock_request.side_effect = feed_page
+        sigsci = SigSciAPI()
+        sigsci.api_token = "testtoken"
+        sigsci.corp = "testcorp"
+        sigsci.site = "testsite"
+        sigsci.stream = True
+        sigsci.authenticate()
+
+        with mock.patch.object(sigsci, 'output_results') as output:
+            sigsci.get_feed_requests2()
+
+        self.assertEqual([c[0][0]['id'] for c in output.call_args_list], ['a', 'b'])
+
+    def test_json_codec(self):
+        record = {"id": "a", "path": "/caf\u00e9/x", "tags": [{"type": "SQLI"}], "responseCode": 200, "redacted": False, "value": None}
+
+        for backend in JSONCodec.available():
+            self.assertEqual(JSONCodec(backend).dumps(record), json.dumps(record))
+            self.assertEqual(JSONCodec(backend, compact=True).dumps(record), json.dumps(record, separators=(',', ':'), ensure_ascii=False))
+            self.assertEqual(JSONCodec(backend).loads(json.dumps(record)), record)
+
+        self.assertRaises(ValueError, JSONCodec, 'nosuchjson')
+
+        # floats keep their value, what a fast library cannot encode falls back to json
+        floats = {"ratio": 0.1, "big": 1e16, "small": 1.5e-7, "rate": -2.5}
+
+        for backend in JSONCodec.available():
+            codec = JSONCodec(backend, compact=True)
+            self.assertEqual(json.loads(codec.dumps(floats)), floats)
+            self.assertEqual(codec.dumps({1: "a", "n": 2 ** 70}), '{"1":"a","n":1180591620717411303424}')
+
+    @mock.patch("requests.Session.post", side_effect=mocked_requests_post)
+    def test_token_cache(self, mock_post):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        def client():
+            sigsci = SigSciAPI()
+            sigsci.email = "testemail"
+            sigsci.pword = "testpass"
+            sigsci.corp = "testcorp"
+            sigsci.token_cache = os.path.join(tmpdir, 'cache')
+            return sigsci
+
+        self.assertTrue(client().authenticate())
+        cache_file = client().token_cache_file()
+        self.assertEqual(stat.S_IMODE(os.stat(cache_file).st_mode), 0o600)
+
+        # a second run reuses the cached token without logging in
+        sigsci = client()
+        self.assertTrue(sigsci.authenticate())
+        self.assertEqual(sigsci.token, "testtoken")
+        self.assertEqual(mock_post.call_count, 1)
+
+        # a token about to expire is renewed before the next request
+        sigsci.token_expires = int(time.time()) + 10
+
+        with mock.patch("requests.Session.request", return_value=mock.Mock(status_code=200, text='{}')):
+            sigsci.request_json('GET', 'https://example.com/')
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertGreater(sigsci.token_expires, time.time() + sigsci.token_refresh_margin)
+
+    @mock.patch("requests.Session.post", side_effect=mocked_requests_post)
+    def test_site_copies_share_token(self, mock_post):
+        sigsci = SigSciAPI()
+        sigsci.email = "testemail"
+        sigsci.pword = "testpass"
+        sigsci.corp = "testcorp"
+        self.assertTrue(sigsci.authenticate())
+        sigsci.token_expires = int(time.time()) + 10
+        sites = [sigsci.for_site('site%d' % i) for i in range(5)]
+
+        # the refresher renews the parent's token, the copies pick it up
+        self.assertTrue(sigsci.refresh_token())
+        self.assertEqual(mock_post.call_count, 2)
+
+        with mock.patch("requests.Session.request", return_value=mock.Mock(status_code=200, text='{}')):
+            for api in sites:
+                api.request_json('GET', 'https://example.com/')
+                self.assertEqual(api.token_expires, sigsci.token_expires)
+
+        self.assertEqual(mock_post.call_count, 2)
+
     def test_build_search_query(self):
         sigsci = SigSciAPI()
         sigsci.tags = ['SQLI', 'XSS']